@@ -1,9 +1,21 @@
 """
 數據庫連接和初始化模塊
 """
+import asyncio
 import asyncpg
+import json
 import os
-from typing import Optional
+import re
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+
+def _parse_partition_bound(value: str) -> Optional[datetime]:
+    """解析 pg_get_expr 輸出的分區邊界，例如 '2025-01-01 00:00:00' 或 MINVALUE"""
+    value = value.strip()
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
 
 
 class Database:
@@ -26,6 +38,40 @@ class Database:
         # 初始化數據表
         await self.init_tables()
     
+    async def gather_queries(self, *queries, concurrency: int = None) -> List[Any]:
+        """
+        以多個連接並行執行互不相依的查詢（例如 Dashboard 的各個區塊）
+        
+        Args:
+            queries: (method, sql, *args)，method 為 'fetch' / 'fetchrow' / 'fetchval'
+            concurrency: 單次請求最多同時佔用的連接數（預設 DB_QUERY_CONCURRENCY，4）
+        
+        Returns:
+            與 queries 順序相同的結果
+        """
+        if concurrency is None:
+            concurrency = int(os.getenv("DB_QUERY_CONCURRENCY", "4"))
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run(method: str, sql: str, *args):
+            async with semaphore:
+                async with self.pool.acquire() as conn:
+                    return await getattr(conn, method)(sql, *args)
+        
+        return await asyncio.gather(*(run(*query) for query in queries))
+    
+    async def estimate_count(self, conn, sql: str, *args) -> int:
+        """
+        以查詢計劃的估計列數代替 COUNT(*)（不掃描資料，準確度取決於 ANALYZE 的統計資訊）
+        
+        Args:
+            sql: 要估計列數的 SELECT 查詢
+        """
+        plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *args)
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    
     async def disconnect(self):
         """關閉數據庫連接池"""
         if self.pool:
@@ -47,7 +93,6 @@ class Database:
                     scopes TEXT[] NOT NULL,
                     created_at TIMESTAMP NOT NULL DEFAULT NOW(),
                     expires_at TIMESTAMP,
-                    last_used TIMESTAMP,
                     is_active BOOLEAN NOT NULL DEFAULT TRUE
                 )
             """)
@@ -154,6 +199,41 @@ class Database:
                 ON tokens(team_id)
             """)
             
+            # Token 活動表（窄表，只存高頻更新的 last_used / call_count）
+            # 與寬的 tokens 表分開，避免每次更新都複製整列 tokens 並更新其索引
+            # fillfactor 70 預留頁內空間，讓更新可以走 HOT（不動索引）
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS token_activity (
+                    token_hash VARCHAR(64) PRIMARY KEY
+                        REFERENCES tokens(token_hash) ON DELETE CASCADE,
+                    last_used TIMESTAMP,
+                    call_count BIGINT NOT NULL DEFAULT 0
+                ) WITH (fillfactor = 70)
+            """)
+            
+            # 遷移：將 tokens.last_used 搬到 token_activity 後移除舊欄位
+            last_used_exists = await conn.fetchval("""
+                SELECT EXISTS (
+                    SELECT 1 FROM information_schema.columns 
+                    WHERE table_name='tokens' AND column_name='last_used'
+                )
+            """)
+            
+            if last_used_exists:
+                print("🔄 Moving tokens.last_used to token_activity table...")
+                async with conn.transaction():
+                    await conn.execute("""
+                        INSERT INTO token_activity (token_hash, last_used)
+                        SELECT token_hash, last_used FROM tokens
+                        WHERE last_used IS NOT NULL
+                        ON CONFLICT (token_hash) DO UPDATE
+                        SET last_used = GREATEST(token_activity.last_used, EXCLUDED.last_used)
+                    """)
+                    await conn.execute("""
+                        ALTER TABLE tokens DROP COLUMN IF EXISTS last_used
+                    """)
+                print("✅ Token activity migration completed")
+            
             # Routes 表
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS routes (
@@ -196,38 +276,19 @@ class Database:
                 """)
                 print("✅ Backend authentication support added to routes")
             
-            # Token 使用記錄表（詳細記錄每次調用）
+            # 路由的成本權重（團隊用量分攤：成本 = 調用數 × 權重）
             await conn.execute("""
-                CREATE TABLE IF NOT EXISTS token_usage_logs (
-                    id SERIAL PRIMARY KEY,
-                    token_hash VARCHAR(64) NOT NULL,
-                    route_path VARCHAR(255),
-                    used_at TIMESTAMP NOT NULL DEFAULT NOW(),
-                    response_status INTEGER,
-                    response_time_ms INTEGER,
-                    ip_address VARCHAR(45),
-                    user_agent TEXT,
-                    request_method VARCHAR(10),
-                    error_message TEXT
-                )
+                ALTER TABLE routes 
+                ADD COLUMN IF NOT EXISTS cost_weight DOUBLE PRECISION NOT NULL DEFAULT 1
             """)
             
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_usage_token_hash 
-                ON token_usage_logs(token_hash)
-            """)
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_usage_used_at 
-                ON token_usage_logs(used_at DESC)
-            """)
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_usage_route 
-                ON token_usage_logs(route_path)
-            """)
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_usage_composite
-                ON token_usage_logs(token_hash, used_at DESC)
-            """)
+            # Token 使用記錄表（詳細記錄每次調用，字典編碼、按天分區）
+            await self.init_usage_logs_table(conn)
+            await self.ensure_usage_partitions(conn)
+            await self.init_usage_rollup_tables(conn)
+            await self.init_usage_team_rollup_table(conn)
+            await self.init_usage_anomaly_tables(conn)
+            await self.init_usage_aggregate_batches_table(conn)
             
             print("✅ Token usage logs table initialized")
             
@@ -243,10 +304,21 @@ class Database:
                 )
             """)
             
+            # 審計日誌以 (created_at, id) 游標分頁，篩選 action / entity_type 時走對應的複合索引
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_audit_logs_created_id 
+                ON audit_logs(created_at DESC, id DESC)
+            """)
             await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_audit_logs_created 
-                ON audit_logs(created_at DESC)
+                CREATE INDEX IF NOT EXISTS idx_audit_logs_action_created 
+                ON audit_logs(action, created_at DESC, id DESC)
             """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_audit_logs_entity_created 
+                ON audit_logs(entity_type, created_at DESC, id DESC)
+            """)
+            # 舊的單欄索引已被 idx_audit_logs_created_id 取代
+            await conn.execute("DROP INDEX IF EXISTS idx_audit_logs_created")
             
             # Teams 表
             await conn.execute("""
@@ -270,6 +342,626 @@ class Database:
             # 初始化系統必需的團隊
             await self.init_system_teams(conn)
     
+    async def init_usage_logs_table(self, conn):
+        """
+        初始化使用記錄表（usage_logs）
+
+        usage_logs 採用緊湊的字典編碼格式：
+        - token_hash / route_path / user_agent 只存整數 id（對應 usage_dict_* 字典表）
+        - request_method、response_status 以 SMALLINT 儲存，ip_address 為 INET
+        - 以 used_at 做 RANGE 分區（每天一個分區），過期數據直接 DROP 分區
+        usage_log_entries 視圖解碼回原本的欄位，供查詢使用
+
+        舊版的 token_usage_logs（一般表或分區表）會改名為 token_usage_logs_v1，
+        由背景維護任務分批轉換到 usage_logs，轉換完成後移除
+        """
+        # 維護任務的進度記錄（key-value），視圖與回填都會用到
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_maintenance_state (
+                key VARCHAR(100) PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        
+        async with conn.transaction():
+            await self._create_usage_dictionaries(conn)
+            
+            exists = await conn.fetchval("SELECT to_regclass('usage_logs') IS NOT NULL")
+            if exists:
+                # 事件 id（用於重送去重）
+                await conn.execute("ALTER TABLE usage_logs ADD COLUMN IF NOT EXISTS event_id UUID")
+                await self._create_usage_log_indexes(conn)
+                await self.create_usage_log_view(conn, await self.has_legacy_usage_logs(conn))
+                return
+            
+            legacy_kind = await conn.fetchval("""
+                SELECT relkind::text FROM pg_class 
+                WHERE oid = to_regclass('token_usage_logs')
+            """)
+            legacy_max_id = None
+            if legacy_kind in ('r', 'p'):
+                print("🔄 Migrating token_usage_logs to the compact usage_logs table...")
+                await conn.execute("ALTER TABLE token_usage_logs RENAME TO token_usage_logs_v1")
+                legacy_max_id = await conn.fetchval("SELECT MAX(id) FROM token_usage_logs_v1")
+                if not legacy_max_id:
+                    await conn.execute("DROP TABLE token_usage_logs_v1")
+            
+            # 主鍵必須包含分區鍵；欄位依寬度排列，減少對齊填充
+            await conn.execute("CREATE SEQUENCE IF NOT EXISTS usage_logs_id_seq AS BIGINT")
+            await conn.execute("""
+                CREATE TABLE usage_logs (
+                    id BIGINT NOT NULL DEFAULT nextval('usage_logs_id_seq'),
+                    used_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                    token_id INTEGER NOT NULL,
+                    route_id INTEGER,
+                    user_agent_id INTEGER,
+                    response_time_ms INTEGER,
+                    response_status SMALLINT,
+                    method_code SMALLINT,
+                    ip_address INET,
+                    error_message TEXT,
+                    event_id UUID,
+                    PRIMARY KEY (id, used_at)
+                ) PARTITION BY RANGE (used_at)
+            """)
+            await conn.execute("ALTER SEQUENCE usage_logs_id_seq OWNED BY usage_logs.id")
+            await self._create_usage_log_indexes(conn)
+            
+            if legacy_max_id:
+                # 沿用舊記錄的 id（回填彙總以 id 範圍追蹤進度），新記錄從其後開始編號
+                await conn.execute("SELECT setval('usage_logs_id_seq', $1)", legacy_max_id)
+                
+                # 舊記錄的日期範圍用一個歷史分區接住，避免全部落到預設分區
+                cutover = await conn.fetchval("""
+                    SELECT GREATEST(
+                        DATE_TRUNC('day', NOW() AT TIME ZONE 'UTC'),
+                        DATE_TRUNC('day', MAX(used_at))
+                    ) + INTERVAL '1 day'
+                    FROM token_usage_logs_v1
+                """)
+                await conn.execute(f"""
+                    CREATE TABLE usage_logs_legacy 
+                    PARTITION OF usage_logs
+                    FOR VALUES FROM (MINVALUE) TO ('{cutover.isoformat()}')
+                """)
+                await self.set_usage_state(conn, 'usage_logs_migration_target_id', legacy_max_id)
+                await self.set_usage_state(conn, 'usage_logs_migration_done_id', 0)
+                print(f"🔄 {legacy_max_id} legacy usage log ids queued for conversion (until {cutover.date()})")
+            
+            # 預設分區：接住沒有對應分區的事件（例如時間異常的事件）
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_logs_default 
+                PARTITION OF usage_logs DEFAULT
+            """)
+            
+            await self.create_usage_log_view(conn, bool(legacy_max_id))
+    
+    async def _create_usage_dictionaries(self, conn):
+        """使用記錄的字典表：把重複出現的長字串換成整數 id"""
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_dict_tokens (
+                id SERIAL PRIMARY KEY,
+                token_hash VARCHAR(64) NOT NULL UNIQUE
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_dict_routes (
+                id SERIAL PRIMARY KEY,
+                route_path VARCHAR(255) NOT NULL UNIQUE
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_dict_user_agents (
+                id SERIAL PRIMARY KEY,
+                user_agent VARCHAR(512) NOT NULL UNIQUE
+            )
+        """)
+        
+        # HTTP 方法代碼（與 usage_ingest.HTTP_METHOD_CODES 一致，0 表示其他方法）
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_http_methods (
+                code SMALLINT PRIMARY KEY,
+                method VARCHAR(10) NOT NULL UNIQUE
+            )
+        """)
+        await conn.execute("""
+            INSERT INTO usage_http_methods (code, method) VALUES
+                (0, 'OTHER'), (1, 'GET'), (2, 'POST'), (3, 'PUT'), (4, 'DELETE'),
+                (5, 'PATCH'), (6, 'HEAD'), (7, 'OPTIONS'), (8, 'CONNECT'), (9, 'TRACE')
+            ON CONFLICT (code) DO NOTHING
+        """)
+        
+        # 舊記錄的 ip_address 是自由文字，轉換時無效值存為 NULL
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION usage_try_inet(value TEXT) RETURNS INET AS $$
+            BEGIN
+                RETURN value::inet;
+            EXCEPTION WHEN others THEN
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql IMMUTABLE
+        """)
+    
+    async def _create_usage_log_indexes(self, conn):
+        """usage_logs 的索引（建在分區表上，會自動套用到每個分區）"""
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_logs_used_at 
+            ON usage_logs(used_at DESC)
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_logs_route 
+            ON usage_logs(route_id, used_at DESC)
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_logs_token
+            ON usage_logs(token_id, used_at DESC)
+        """)
+        # 唯一索引必須包含分區鍵；重送的事件 event_id 與 timestamp 相同，會被擋下
+        await conn.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_usage_logs_event
+            ON usage_logs(event_id, used_at)
+            WHERE event_id IS NOT NULL
+        """)
+    
+    async def has_legacy_usage_logs(self, conn) -> bool:
+        """舊版 token_usage_logs 是否仍在轉換中"""
+        return await conn.fetchval("SELECT to_regclass('token_usage_logs_v1') IS NOT NULL")
+    
+    async def create_usage_log_view(self, conn, include_legacy: bool):
+        """
+        usage_log_entries：解碼後的使用記錄（欄位與舊版 token_usage_logs 相同）
+        
+        舊表轉換期間一併讀取 token_usage_logs_v1 中尚未轉換的記錄（id > 轉換進度），兩者不重疊
+        """
+        legacy_branch = ""
+        if include_legacy:
+            legacy_branch = """
+                UNION ALL
+                SELECT 
+                    o.id::bigint, o.token_hash::varchar(64), o.route_path::varchar(255), o.used_at,
+                    o.response_status, o.response_time_ms, o.ip_address::text,
+                    o.user_agent::text, o.request_method::varchar(10), o.error_message,
+                    NULL::uuid
+                FROM token_usage_logs_v1 o
+                WHERE o.id > COALESCE(
+                    (SELECT value::bigint FROM usage_maintenance_state WHERE key = 'usage_logs_migration_done_id'),
+                    0
+                )
+            """
+        
+        await conn.execute(f"""
+            CREATE OR REPLACE VIEW usage_log_entries AS
+            SELECT 
+                l.id, t.token_hash, r.route_path, l.used_at,
+                l.response_status::integer AS response_status, l.response_time_ms,
+                host(l.ip_address) AS ip_address, ua.user_agent::text AS user_agent,
+                m.method AS request_method, l.error_message, l.event_id
+            FROM usage_logs l
+            JOIN usage_dict_tokens t ON t.id = l.token_id
+            LEFT JOIN usage_dict_routes r ON r.id = l.route_id
+            LEFT JOIN usage_dict_user_agents ua ON ua.id = l.user_agent_id
+            LEFT JOIN usage_http_methods m ON m.code = l.method_code
+            {legacy_branch}
+        """)
+    
+    async def init_usage_rollup_tables(self, conn):
+        """
+        初始化使用統計的彙總表
+        
+        usage_rollup_hourly：每小時 × Token × 路由 一列，由寫入緩衝在 COPY 的同一個 transaction 內累加；
+        統計 API 讀這張表，不需要掃描原始記錄。
+        usage_rollup_daily：每日彙總，由背景任務從每小時彙總降採樣，永久保留；
+        usage_rollup_combined 視圖合併兩者供全期間統計使用。
+        首次建立時若已有原始記錄，會記下要回填的 id 範圍，由背景維護任務分批回填。
+        """
+        rollup_exists = await conn.fetchval("""
+            SELECT to_regclass('usage_rollup_hourly') IS NOT NULL
+        """)
+        
+        async with conn.transaction():
+            await self._create_latency_histogram_functions(conn)
+            
+            # route_path 為主鍵的一部分，沒有路由的事件以 '' 表示
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_rollup_hourly (
+                    hour TIMESTAMP NOT NULL,
+                    token_hash VARCHAR(64) NOT NULL,
+                    route_path VARCHAR(255) NOT NULL DEFAULT '',
+                    calls BIGINT NOT NULL DEFAULT 0,
+                    errors BIGINT NOT NULL DEFAULT 0,
+                    timed_calls BIGINT NOT NULL DEFAULT 0,
+                    sum_ms BIGINT NOT NULL DEFAULT 0,
+                    max_ms INTEGER,
+                    first_at TIMESTAMP,
+                    last_at TIMESTAMP,
+                    latency_buckets BIGINT[],
+                    PRIMARY KEY (hour, token_hash, route_path)
+                )
+            """)
+            await conn.execute("""
+                ALTER TABLE usage_rollup_hourly ADD COLUMN IF NOT EXISTS latency_buckets BIGINT[]
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_rollup_hourly_token 
+                ON usage_rollup_hourly(token_hash, hour DESC)
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_rollup_hourly_route 
+                ON usage_rollup_hourly(route_path, hour DESC)
+            """)
+            
+            # usage_distinct_hourly：每小時 × Token / 路由 的不同 IP 與 User-Agent 的 HyperLogLog sketch
+            # （dimension：t = token_hash，r = route_path；sketch 格式見 usage_sketch.py）
+            await conn.execute("""
+                CREATE OR REPLACE FUNCTION usage_hll_merge(a BYTEA, b BYTEA) RETURNS BYTEA AS $$
+                    SELECT CASE
+                        WHEN a IS NULL THEN b
+                        WHEN b IS NULL THEN a
+                        ELSE (
+                            SELECT string_agg(
+                                set_byte('\\x00'::bytea, 0, GREATEST(get_byte(a, i), get_byte(b, i))),
+                                ''::bytea ORDER BY i
+                            )
+                            FROM generate_series(0, LEAST(length(a), length(b)) - 1) AS i
+                        )
+                    END
+                $$ LANGUAGE sql IMMUTABLE
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_distinct_hourly (
+                    hour TIMESTAMP NOT NULL,
+                    dimension CHAR(1) NOT NULL,
+                    key VARCHAR(255) NOT NULL,
+                    ip_sketch BYTEA,
+                    user_agent_sketch BYTEA,
+                    PRIMARY KEY (dimension, key, hour)
+                )
+            """)
+            
+            # usage_error_hourly：每小時 × 錯誤指紋 × 路由 的錯誤次數（指紋見 usage_ingest.error_fingerprint）
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_error_hourly (
+                    hour TIMESTAMP NOT NULL,
+                    fingerprint CHAR(16) NOT NULL,
+                    route_path VARCHAR(255) NOT NULL DEFAULT '',
+                    template TEXT NOT NULL,
+                    sample_message TEXT,
+                    last_status INTEGER,
+                    count BIGINT NOT NULL DEFAULT 0,
+                    first_seen TIMESTAMP NOT NULL,
+                    last_seen TIMESTAMP NOT NULL,
+                    PRIMARY KEY (fingerprint, route_path, hour)
+                )
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_usage_error_hourly_hour 
+                ON usage_error_hourly(hour)
+            """)
+
+            # usage_rollup_daily：由背景任務從每小時彙總降採樣，永久保留
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_rollup_daily (
+                    day DATE NOT NULL,
+                    token_hash VARCHAR(64) NOT NULL,
+                    route_path VARCHAR(255) NOT NULL DEFAULT '',
+                    calls BIGINT NOT NULL DEFAULT 0,
+                    errors BIGINT NOT NULL DEFAULT 0,
+                    timed_calls BIGINT NOT NULL DEFAULT 0,
+                    sum_ms BIGINT NOT NULL DEFAULT 0,
+                    max_ms INTEGER,
+                    first_at TIMESTAMP,
+                    last_at TIMESTAMP,
+                    latency_buckets BIGINT[],
+                    PRIMARY KEY (day, token_hash, route_path)
+                )
+            """)
+            await conn.execute("""
+                ALTER TABLE usage_rollup_daily ADD COLUMN IF NOT EXISTS latency_buckets BIGINT[]
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_rollup_daily_token 
+                ON usage_rollup_daily(token_hash, day DESC)
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_rollup_daily_route 
+                ON usage_rollup_daily(route_path, day DESC)
+            """)
+            
+            # 降採樣之後又寫入小時統計的日期（延遲送達、日誌回放），由維護任務重新降採樣
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS usage_rollup_dirty_days (
+                    day DATE PRIMARY KEY,
+                    marked_at TIMESTAMP NOT NULL DEFAULT NOW()
+                )
+            """)
+            
+            # 全期間彙總：已降採樣的日期（rollup_daily_folded_until 之前）讀每日彙總，
+            # 之後讀每小時彙總，兩者不重疊
+            await conn.execute("""
+                CREATE OR REPLACE VIEW usage_rollup_combined AS
+                SELECT 
+                    d.day::timestamp AS bucket, d.token_hash, d.route_path, d.calls, d.errors,
+                    d.timed_calls, d.sum_ms, d.max_ms, d.first_at, d.last_at, d.latency_buckets
+                FROM usage_rollup_daily d
+                WHERE d.day < COALESCE(
+                    (SELECT value::date FROM usage_maintenance_state WHERE key = 'rollup_daily_folded_until'),
+                    '-infinity'::date
+                )
+                UNION ALL
+                SELECT 
+                    h.hour AS bucket, h.token_hash, h.route_path, h.calls, h.errors,
+                    h.timed_calls, h.sum_ms, h.max_ms, h.first_at, h.last_at, h.latency_buckets
+                FROM usage_rollup_hourly h
+                WHERE h.hour >= COALESCE(
+                    (SELECT value::timestamp FROM usage_maintenance_state WHERE key = 'rollup_daily_folded_until'),
+                    '-infinity'::timestamp
+                )
+            """)
+            
+            if not rollup_exists:
+                max_id = await conn.fetchval("SELECT MAX(id) FROM usage_log_entries")
+                if max_id:
+                    await self.set_usage_state(conn, 'rollup_backfill_target_id', max_id)
+                    await self.set_usage_state(conn, 'rollup_backfill_done_id', 0)
+                    print(f"🔄 Hourly usage rollup created, {max_id} existing log ids queued for backfill")
+
+    async def init_usage_team_rollup_table(self, conn):
+        """
+        初始化按團隊的每小時彙總表（usage_rollup_team_hourly）
+
+        寫入使用記錄時以 tokens 的 token → team 對應決定團隊（之後 Token 換團隊不影響已計入的用量），
+        團隊用量 API 讀這張表，不需要把彙總表或原始記錄 JOIN tokens。沒有團隊（或已刪除）的 Token 以 '' 表示。
+        首次建立時以目前的對應從 usage_rollup_combined 一次性回填（已降採樣的日期以當天 00:00 為一筆）
+        """
+        table_exists = await conn.fetchval("""
+            SELECT to_regclass('usage_rollup_team_hourly') IS NOT NULL
+        """)
+        if table_exists:
+            return
+
+        async with conn.transaction():
+            await conn.execute("""
+                CREATE TABLE usage_rollup_team_hourly (
+                    hour TIMESTAMP NOT NULL,
+                    team_id VARCHAR(50) NOT NULL DEFAULT '',
+                    route_path VARCHAR(255) NOT NULL DEFAULT '',
+                    calls BIGINT NOT NULL DEFAULT 0,
+                    errors BIGINT NOT NULL DEFAULT 0,
+                    timed_calls BIGINT NOT NULL DEFAULT 0,
+                    sum_ms BIGINT NOT NULL DEFAULT 0,
+                    max_ms INTEGER,
+                    latency_buckets BIGINT[],
+                    PRIMARY KEY (team_id, hour, route_path)
+                )
+            """)
+            result = await conn.execute("""
+                INSERT INTO usage_rollup_team_hourly (
+                    hour, team_id, route_path, calls, errors, timed_calls, sum_ms, max_ms, latency_buckets
+                )
+                SELECT
+                    c.bucket, COALESCE(t.team_id, ''), c.route_path, SUM(c.calls), SUM(c.errors),
+                    SUM(c.timed_calls), SUM(c.sum_ms), MAX(c.max_ms), usage_sum_buckets(c.latency_buckets)
+                FROM usage_rollup_combined c
+                LEFT JOIN tokens t ON t.token_hash = c.token_hash
+                GROUP BY 1, 2, 3
+            """)
+            print(f"✅ Team usage rollup created ({result.split()[-1]} rows backfilled)")
+
+    async def init_usage_aggregate_batches_table(self, conn):
+        """
+        初始化已寫入的 Worker 彙總批次表（usage_aggregate_batches）
+        
+        與計數在同一個交易寫入 batch_id，重送的批次插入衝突即略過；
+        超過 USAGE_AGGREGATE_BATCH_RETENTION_HOURS 小時的記錄由 usage_maintenance 刪除
+        """
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_aggregate_batches (
+                batch_id VARCHAR(100) PRIMARY KEY,
+                received_at TIMESTAMP NOT NULL DEFAULT (NOW() AT TIME ZONE 'UTC')
+            )
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_aggregate_batches_received
+            ON usage_aggregate_batches(received_at)
+        """)
+
+    async def init_usage_anomaly_tables(self, conn):
+        """
+        初始化使用異常偵測的狀態表（見 usage_anomaly.py）
+        
+        usage_anomaly_baselines：每個 Token 的 EWMA 基準線，定期 checkpoint，重啟後從這裡繼續
+        usage_anomalies：偵測到的異常（進行中的 resolved_at 為 NULL）
+        """
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_anomaly_baselines (
+                token_hash VARCHAR(64) PRIMARY KEY,
+                rate_mean DOUBLE PRECISION NOT NULL,
+                rate_var DOUBLE PRECISION NOT NULL,
+                error_rate_mean DOUBLE PRECISION NOT NULL,
+                observations INTEGER NOT NULL,
+                updated_at TIMESTAMP NOT NULL
+            )
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage_anomalies (
+                id UUID PRIMARY KEY,
+                token_hash VARCHAR(64) NOT NULL,
+                kind VARCHAR(20) NOT NULL,
+                started_at TIMESTAMP NOT NULL,
+                last_seen_at TIMESTAMP NOT NULL,
+                resolved_at TIMESTAMP,
+                observed DOUBLE PRECISION,
+                expected DOUBLE PRECISION,
+                score DOUBLE PRECISION
+            )
+        """)
+        await conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_usage_anomalies_started
+            ON usage_anomalies(started_at DESC)
+        """)
+    
+    async def _create_latency_histogram_functions(self, conn):
+        """
+        延遲直方圖（BIGINT[]，分桶方式見 usage_ingest.latency_bucket）的 SQL 函數
+        
+        - usage_latency_bucket(ms)：延遲所屬的桶（0 起算）
+        - usage_latency_histogram(ms)：只有一筆延遲的直方圖（回填原始記錄時使用）
+        - usage_merge_buckets(a, b) / usage_sum_buckets(...)：逐桶相加（長度不同時補 0）
+        """
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION usage_latency_bucket(ms DOUBLE PRECISION) RETURNS INTEGER AS $$
+                SELECT CASE WHEN ms <= 1 THEN 0 ELSE LEAST(CEIL(LN(ms) / LN(1.25)), 50)::integer END
+            $$ LANGUAGE sql IMMUTABLE
+        """)
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION usage_latency_histogram(ms DOUBLE PRECISION) RETURNS BIGINT[] AS $$
+                SELECT CASE WHEN ms IS NULL THEN NULL
+                    ELSE array_fill(0::bigint, ARRAY[usage_latency_bucket(ms)]) || 1::bigint END
+            $$ LANGUAGE sql IMMUTABLE
+        """)
+        await conn.execute("""
+            CREATE OR REPLACE FUNCTION usage_merge_buckets(a BIGINT[], b BIGINT[]) RETURNS BIGINT[] AS $$
+                SELECT CASE 
+                    WHEN a IS NULL THEN b
+                    WHEN b IS NULL THEN a
+                    ELSE ARRAY(
+                        SELECT COALESCE(a[i], 0) + COALESCE(b[i], 0)
+                        FROM generate_series(1, GREATEST(cardinality(a), cardinality(b))) AS i
+                    )
+                END
+            $$ LANGUAGE sql IMMUTABLE
+        """)
+        await conn.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (SELECT 1 FROM pg_proc WHERE proname = 'usage_sum_buckets') THEN
+                    CREATE AGGREGATE usage_sum_buckets(BIGINT[]) (
+                        SFUNC = usage_merge_buckets,
+                        STYPE = BIGINT[]
+                    );
+                END IF;
+            END
+            $$
+        """)
+    
+    async def get_usage_state(self, conn, key: str) -> Optional[str]:
+        """讀取維護任務的進度記錄"""
+        return await conn.fetchval(
+            "SELECT value FROM usage_maintenance_state WHERE key = $1", key
+        )
+    
+    async def set_usage_state(self, conn, key: str, value: Any):
+        """寫入維護任務的進度記錄"""
+        await conn.execute("""
+            INSERT INTO usage_maintenance_state (key, value, updated_at)
+            VALUES ($1, $2, NOW())
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
+        """, key, str(value))
+    
+    async def list_usage_partitions(self, conn) -> List[Dict[str, Any]]:
+        """
+        列出 usage_logs 的所有分區及其範圍
+        
+        Returns:
+            [{"name", "lower", "upper", "is_default"}]，lower/upper 為 None 表示 MINVALUE/MAXVALUE
+        """
+        rows = await conn.fetch("""
+            SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'usage_logs'::regclass
+        """)
+        
+        partitions = []
+        for row in rows:
+            bound = row['bound']
+            if bound == 'DEFAULT':
+                partitions.append({"name": row['name'], "lower": None, "upper": None, "is_default": True})
+                continue
+            
+            match = re.match(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound)
+            if not match:
+                continue
+            partitions.append({
+                "name": row['name'],
+                "lower": _parse_partition_bound(match.group(1)),
+                "upper": _parse_partition_bound(match.group(2)),
+                "is_default": False
+            })
+        return partitions
+    
+    async def ensure_usage_partitions(self, conn, days_ahead: int = None):
+        """
+        預先建立今天起 days_ahead 天內的每日分區（已被其他分區涵蓋的日期會跳過）
+        """
+        if days_ahead is None:
+            days_ahead = int(os.getenv("USAGE_PARTITION_PRECREATE_DAYS", "7"))
+        
+        partitions = [p for p in await self.list_usage_partitions(conn) if not p['is_default']]
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        
+        created = []
+        for offset in range(days_ahead + 1):
+            day_start = today + timedelta(days=offset)
+            day_end = day_start + timedelta(days=1)
+            
+            overlaps = any(
+                (p['lower'] is None or p['lower'] < day_end) and
+                (p['upper'] is None or p['upper'] > day_start)
+                for p in partitions
+            )
+            if overlaps:
+                continue
+            
+            name = f"usage_logs_p{day_start.strftime('%Y%m%d')}"
+            try:
+                await conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {name}
+                    PARTITION OF usage_logs
+                    FOR VALUES FROM ('{day_start.isoformat()}') TO ('{day_end.isoformat()}')
+                """)
+                created.append(name)
+            except asyncpg.PostgresError as e:
+                # 例如預設分區已有該日期的數據，需要人工處理
+                print(f"⚠️  Failed to create usage partition {name}: {e}")
+        
+        if created:
+            print(f"✅ Created usage partitions: {', '.join(created)}")
+        return created
+    
+    async def drop_expired_usage_partitions(self, conn, retention_days: int = None):
+        """
+        移除整個範圍都早於保留期限的分區
+        
+        USAGE_LOG_RETENTION_DAYS：原始記錄保留天數（0 表示永久保留）
+        USAGE_PARTITION_EXPIRE_ACTION：drop（直接刪除）或 detach（只卸載，保留為獨立表）
+        """
+        if retention_days is None:
+            retention_days = int(os.getenv("USAGE_LOG_RETENTION_DAYS", "0"))
+        if retention_days <= 0:
+            return []
+        
+        action = os.getenv("USAGE_PARTITION_EXPIRE_ACTION", "drop").lower()
+        cutoff = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=retention_days)
+        
+        removed = []
+        for partition in await self.list_usage_partitions(conn):
+            if partition['is_default'] or partition['upper'] is None or partition['upper'] > cutoff:
+                continue
+            
+            name = partition['name']
+            if action == 'detach':
+                await conn.execute(f"ALTER TABLE usage_logs DETACH PARTITION {name}")
+            else:
+                await conn.execute(f"DROP TABLE IF EXISTS {name}")
+            removed.append(name)
+        
+        if removed:
+            verb = "Detached" if action == 'detach' else "Dropped"
+            print(f"🗑️  {verb} expired usage partitions: {', '.join(removed)}")
+        return removed
+    
     async def init_system_teams(self, conn):
         """
         初始化系統必需的團隊
@@ -1,10 +1,12 @@
 """
 Token Manager - FastAPI 主應用
 """
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
-from datetime import datetime, timedelta
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from typing import Dict, List, Optional
+from datetime import datetime, timedelta, timezone
 import secrets
 import hashlib
 import os
@@ -19,6 +21,22 @@ from models import (
 )
 from database import db
 from cloudflare import get_cf_kv
+from usage_ingest import (
+    parse_usage_event, parse_usage_batch, parse_usage_counters, write_hourly_rollups, write_team_rollups,
+    latency_percentiles, add_to_histogram,
+    fetch_distinct_counts, DISTINCT_DIMENSION_TOKEN, DISTINCT_DIMENSION_ROUTE,
+    usage_buffer, UsageBufferFull
+)
+from usage_maintenance import usage_maintenance
+from usage_asgi import usage_ingest_endpoint
+from snapshot_cache import usage_stats_cache
+from usage_heavy_hitters import heavy_hitters, WINDOWS as HEAVY_HITTER_WINDOWS
+from usage_anomaly import usage_anomaly_detector
+from usage_export import usage_exporter, EXPORT_FIELDS, EXPORT_FORMATS, PARQUET_AVAILABLE
+from usage_series import (
+    SERIES_RESOLUTIONS, SERIES_DEFAULT_RANGE, SERIES_MAX_RANGE, SERIES_METRICS, SERIES_MAX_POINTS,
+    truncate_to_resolution, fill_series, downsample_series
+)
 from user_routes import router as user_router
 from team_routes import router as team_router
 from invite_routes import router as invite_router
@@ -60,11 +78,40 @@ async def startup():
     except Exception as e:
         print(f"❌ Database connection failed: {e}")
         raise
+    
+    # 開始接受事件前先從數據庫重建 Top Token / 路由的即時統計，失敗時統計 API 改用 SQL
+    try:
+        async with db.pool.acquire() as conn:
+            await heavy_hitters.load(conn)
+    except Exception as e:
+        print(f"Warning: Failed to load usage heavy hitters: {e}")
+    try:
+        async with db.pool.acquire() as conn:
+            await usage_anomaly_detector.load(conn)
+    except Exception as e:
+        print(f"Warning: Failed to load usage anomaly baselines: {e}")
+    
+    # 啟動使用記錄的背景批量寫入與分區維護
+    usage_buffer.start()
+    usage_maintenance.start()
+    usage_anomaly_detector.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
     """應用關閉時清理資源"""
+    await usage_maintenance.stop()
+    
+    # 先把緩衝區內的使用記錄寫入，再關閉連接池
+    try:
+        await usage_buffer.stop()
+    except Exception as e:
+        print(f"❌ Failed to drain usage buffer: {e}")
+    try:
+        await usage_anomaly_detector.stop()
+    except Exception as e:
+        print(f"❌ Failed to checkpoint usage anomaly baselines: {e}")
+    
     await db.disconnect()
     print("👋 Database disconnected")
 
@@ -264,6 +311,9 @@ async def create_token(data: TokenCreate, request: Request):
         email_addresses = user.get("email_addresses", [])
         created_by_email = email_addresses[0].get("email_address", "unknown") if email_addresses else "unknown"
         
+        # 統計快照含 Token 名稱與團隊，變更後清除
+        usage_stats_cache.invalidate()
+        
         await log_audit("create", "token", token_id, {
             "name": data.name, 
             "team_id": data.team_id,
@@ -304,10 +354,12 @@ async def list_tokens(request: Request):
         if global_role == "ADMIN":
             # 全局 ADMIN 可以看到所有 Token
             rows = await conn.fetch("""
-                SELECT id, name, team_id, created_by, description, token_encrypted, scopes, created_at, expires_at, last_used
-                FROM tokens
-                WHERE is_active = TRUE
-                ORDER BY created_at DESC
+                SELECT t.id, t.name, t.team_id, t.created_by, t.description, t.token_encrypted, 
+                       t.scopes, t.created_at, t.expires_at, ta.last_used
+                FROM tokens t
+                LEFT JOIN token_activity ta ON ta.token_hash = t.token_hash
+                WHERE t.is_active = TRUE
+                ORDER BY t.created_at DESC
             """)
         else:
             # 普通用戶只能看到自己所屬團隊的 Token
@@ -316,10 +368,12 @@ async def list_tokens(request: Request):
                 return []  # 用戶不屬於任何團隊
             
             rows = await conn.fetch("""
-                SELECT id, name, team_id, created_by, description, token_encrypted, scopes, created_at, expires_at, last_used
-                FROM tokens
-                WHERE is_active = TRUE AND team_id = ANY($1)
-                ORDER BY created_at DESC
+                SELECT t.id, t.name, t.team_id, t.created_by, t.description, t.token_encrypted, 
+                       t.scopes, t.created_at, t.expires_at, ta.last_used
+                FROM tokens t
+                LEFT JOIN token_activity ta ON ta.token_hash = t.token_hash
+                WHERE t.is_active = TRUE AND t.team_id = ANY($1)
+                ORDER BY t.created_at DESC
             """, user_teams)
     
     # 為每個 Token 生成預覽字串
@@ -390,7 +444,12 @@ async def update_token(token_id: int, data: TokenUpdate, request: Request):
         query = f"UPDATE tokens SET {', '.join(updates)} WHERE id = ${param_count}"
         
         await conn.execute(query, *params)
-        updated_token = await conn.fetchrow("SELECT * FROM tokens WHERE id = $1", token_id)
+        updated_token = await conn.fetchrow("""
+            SELECT t.*, ta.last_used
+            FROM tokens t
+            LEFT JOIN token_activity ta ON ta.token_hash = t.token_hash
+            WHERE t.id = $1
+        """, token_id)
     
     # 如果 scopes 更新了，需要同步到 KV
     if data.scopes is not None:
@@ -414,6 +473,9 @@ async def update_token(token_id: int, data: TokenUpdate, request: Request):
     email_addresses = user.get("email_addresses", [])
     updated_by_email = email_addresses[0].get("email_address", "unknown") if email_addresses else "unknown"
     
+    # 統計快照含 Token 名稱與團隊，變更後清除
+    usage_stats_cache.invalidate()
+    
     await log_audit("update", "token", token_id, {
         "name": data.name,
         "team_id": token_info['team_id'] if token_info else None,
@@ -511,6 +573,9 @@ async def delete_token(token_id: int, request: Request):
     email_addresses = user.get("email_addresses", [])
     deleted_by_email = email_addresses[0].get("email_address", "unknown") if email_addresses else "unknown"
     
+    # 統計快照含 Token 名稱與團隊，變更後清除
+    usage_stats_cache.invalidate()
+    
     await log_audit("delete", "token", token_id, {
         "name": token['name'],
         "team_id": token['team_id'],
@@ -545,12 +610,13 @@ async def create_route(data: RouteCreate, request: Request):
     async with db.pool.acquire() as conn:
         try:
             route_id = await conn.fetchval("""
-                INSERT INTO routes (name, path, backend_url, description, tags, backend_auth_type, backend_auth_config)
-                VALUES ($1, $2, $3, $4, $5, $6, $7::jsonb)
+                INSERT INTO routes (name, path, backend_url, description, tags, backend_auth_type, backend_auth_config, cost_weight)
+                VALUES ($1, $2, $3, $4, $5, $6, $7::jsonb, $8)
                 RETURNING id
             """, data.name, data.path, data.backend_url, data.description, data.tags or [], 
                 data.backend_auth_type or 'none', 
-                json.dumps(data.backend_auth_config) if data.backend_auth_config else None)
+                json.dumps(data.backend_auth_config) if data.backend_auth_config else None,
+                data.cost_weight if data.cost_weight is not None else 1.0)
             
             created_at = await conn.fetchval(
                 "SELECT created_at FROM routes WHERE id = $1", route_id
@@ -567,6 +633,9 @@ async def create_route(data: RouteCreate, request: Request):
     email_addresses = user.get("email_addresses", [])
     created_by_email = email_addresses[0].get("email_address", "unknown") if email_addresses else "unknown"
     
+    # 統計快照含路由名稱，變更後清除
+    usage_stats_cache.invalidate()
+    
     await log_audit("create", "route", route_id, {
         "name": data.name,
         "path": data.path,
@@ -593,6 +662,7 @@ async def create_route(data: RouteCreate, request: Request):
         tags=data.tags or [],
         backend_auth_type=data.backend_auth_type or 'none',
         backend_auth_config=auth_config_for_response,
+        cost_weight=data.cost_weight if data.cost_weight is not None else 1.0,
         created_at=created_at
     )
 
@@ -607,7 +677,7 @@ async def list_routes(request: Request):
         async with db.pool.acquire() as conn:
             rows = await conn.fetch("""
                 SELECT id, name, path, backend_url, description, tags, 
-                       backend_auth_type, backend_auth_config, created_at
+                       backend_auth_type, backend_auth_config, cost_weight, created_at
                 FROM routes
                 ORDER BY created_at DESC
             """)
@@ -702,6 +772,11 @@ async def update_route(route_id: int, data: RouteUpdate, request: Request):
             params.append(json.dumps(data.backend_auth_config) if data.backend_auth_config else None)
             param_count += 1
         
+        if data.cost_weight is not None:
+            updates.append(f"cost_weight = ${param_count}")
+            params.append(data.cost_weight)
+            param_count += 1
+        
         if not updates:
             raise HTTPException(400, "No fields to update")
         
@@ -718,12 +793,16 @@ async def update_route(route_id: int, data: RouteUpdate, request: Request):
     email_addresses = user.get("email_addresses", [])
     updated_by_email = email_addresses[0].get("email_address", "unknown") if email_addresses else "unknown"
     
+    # 統計快照含路由名稱，變更後清除
+    usage_stats_cache.invalidate()
+    
     await log_audit("update", "route", route_id, {
         "name": data.name,
         "path": route['path'],
         "backend_url": data.backend_url,
         "description": data.description,
         "tags": data.tags,
+        "cost_weight": data.cost_weight,
         "updated_by": user["id"],
         "updated_by_email": updated_by_email
     })
@@ -779,6 +858,9 @@ async def delete_route(route_id: int, request: Request):
     email_addresses = user.get("email_addresses", [])
     deleted_by_email = email_addresses[0].get("email_address", "unknown") if email_addresses else "unknown"
     
+    # 統計快照含路由名稱，變更後清除
+    usage_stats_cache.invalidate()
+    
     await log_audit("delete", "route", route_id, {
         "name": route['name'],
         "path": route['path'],
@@ -870,25 +952,29 @@ async def get_dashboard_overview(request: Request):
     """
     user = await verify_clerk_token(request)
     
-    async with db.pool.acquire() as conn:
+    # 進行中的使用異常（記憶體中的偵測狀態，見 usage_anomaly.py）
+    active_anomalies = usage_anomaly_detector.active()
+    
+    # 各區塊互不相依，以多個連接並行查詢
+    counts, tokens_by_team, token_trend, recent_logs_raw, expiring_soon, anomaly_tokens = await db.gather_queries(
         # 1. 基礎統計
-        total_tokens = await conn.fetchval(
-            "SELECT COUNT(*) FROM tokens WHERE is_active = TRUE"
-        )
-        total_routes = await conn.fetchval("SELECT COUNT(*) FROM routes")
-        total_teams = await conn.fetchval("SELECT COUNT(*) FROM teams")
-        
-        # 2. 按團隊分組的 Token 統計
-        tokens_by_team = await conn.fetch("""
-            SELECT team_id, COUNT(*) as count
-            FROM tokens
-            WHERE is_active = TRUE AND team_id IS NOT NULL
-            GROUP BY team_id
+        ("fetchrow", """
+            SELECT 
+                (SELECT COUNT(*) FROM tokens WHERE is_active = TRUE) as total_tokens,
+                (SELECT COUNT(*) FROM routes) as total_routes,
+                (SELECT COUNT(*) FROM teams) as total_teams
+        """),
+        # 2. 按團隊分組的 Token 統計（JOIN teams 獲取名稱）
+        ("fetch", """
+            SELECT t.team_id, COALESCE(tm.name, t.team_id) as team_name, COUNT(*) as count
+            FROM tokens t
+            LEFT JOIN teams tm ON tm.id = t.team_id
+            WHERE t.is_active = TRUE AND t.team_id IS NOT NULL
+            GROUP BY t.team_id, tm.name
             ORDER BY count DESC
-        """)
-        
+        """),
         # 3. 最近 7 天的 Token 創建趨勢
-        token_trend = await conn.fetch("""
+        ("fetch", """
             SELECT 
                 DATE(created_at) as date,
                 COUNT(*) as count
@@ -896,10 +982,9 @@ async def get_dashboard_overview(request: Request):
             WHERE created_at >= NOW() - INTERVAL '7 days'
             GROUP BY DATE(created_at)
             ORDER BY date DESC
-        """)
-        
+        """),
         # 4. 最近 10 條審計日誌（使用 LEFT JOIN 補充名稱）
-        recent_logs_raw = await conn.fetch("""
+        ("fetch", """
             SELECT 
                 al.action, 
                 al.entity_type, 
@@ -914,60 +999,62 @@ async def get_dashboard_overview(request: Request):
             LEFT JOIN routes r ON al.entity_type = 'route' AND al.entity_id = r.id
             ORDER BY al.created_at DESC
             LIMIT 10
-        """)
+        """),
+        # 5. 即將過期的 Token（30 天內，JOIN teams 獲取名稱）
+        ("fetch", """
+            SELECT t.id, t.name, t.team_id, COALESCE(tm.name, t.team_id) as team_name, t.expires_at
+            FROM tokens t
+            LEFT JOIN teams tm ON tm.id = t.team_id
+            WHERE t.is_active = TRUE 
+                AND t.expires_at IS NOT NULL
+                AND t.expires_at <= NOW() + INTERVAL '30 days'
+                AND t.expires_at > NOW()
+            ORDER BY t.expires_at ASC
+            LIMIT 5
+        """),
+        # 6. 有進行中異常的 Token 名稱
+        ("fetch", """
+            SELECT id, name, team_id, token_hash FROM tokens WHERE token_hash = ANY($1::text[])
+        """, list({anomaly['token_hash'] for anomaly in active_anomalies})),
+    )
+    total_tokens = counts['total_tokens']
+    total_routes = counts['total_routes']
+    total_teams = counts['total_teams']
+    
+    # 將 JOIN 的結果合併到 details 中
+    recent_logs = []
+    for log in recent_logs_raw:
+        log_dict = {
+            'action': log['action'],
+            'entity_type': log['entity_type'],
+            'entity_id': log['entity_id'],
+            'created_at': log['created_at']
+        }
         
-        # 將 JOIN 的結果合併到 details 中
-        import json
-        recent_logs = []
-        for log in recent_logs_raw:
-            log_dict = {
-                'action': log['action'],
-                'entity_type': log['entity_type'],
-                'entity_id': log['entity_id'],
-                'created_at': log['created_at']
-            }
-            
-            # 處理 details（JSONB 轉為 dict）
-            if log['details']:
-                details = dict(log['details']) if isinstance(log['details'], dict) else json.loads(log['details'])
-            else:
-                details = {}
-            
-            # 補充 name（優先使用 JOIN 的結果，其次才用 details 中的）
-            if not details.get('name'):
-                if log['entity_type'] == 'token' and log.get('token_name'):
-                    details['name'] = log['token_name']
-                elif log['entity_type'] == 'route':
-                    # 路由優先用 route_name，否則用 path
-                    details['name'] = log.get('route_name') or log.get('route_path')
-                    if log.get('route_path') and not details.get('path'):
-                        details['path'] = log['route_path']
-            
-            log_dict['details'] = details
-            recent_logs.append(log_dict)
+        # 處理 details（JSONB 轉為 dict）
+        if log['details']:
+            details = dict(log['details']) if isinstance(log['details'], dict) else json.loads(log['details'])
+        else:
+            details = {}
         
-        # 5. 即將過期的 Token（30 天內）
-        expiring_soon = await conn.fetch("""
-            SELECT id, name, team_id, expires_at
-            FROM tokens
-            WHERE is_active = TRUE 
-                AND expires_at IS NOT NULL
-                AND expires_at <= NOW() + INTERVAL '30 days'
-                AND expires_at > NOW()
-            ORDER BY expires_at ASC
-            LIMIT 5
-        """)
-    
-    # 獲取團隊名稱映射
-    async with db.pool.acquire() as conn:
-        teams_data = await conn.fetch("SELECT id, name FROM teams")
-        team_names = {team['id']: team['name'] for team in teams_data}
+        # 補充 name（優先使用 JOIN 的結果，其次才用 details 中的）
+        if not details.get('name'):
+            if log['entity_type'] == 'token' and log.get('token_name'):
+                details['name'] = log['token_name']
+            elif log['entity_type'] == 'route':
+                # 路由優先用 route_name，否則用 path
+                details['name'] = log.get('route_name') or log.get('route_path')
+                if log.get('route_path') and not details.get('path'):
+                    details['path'] = log['route_path']
+        
+        log_dict['details'] = details
+        recent_logs.append(log_dict)
     
-    # 處理團隊統計（添加團隊名稱）
+    # 處理團隊統計
     tokens_by_team_with_names = [
         {
             "team_id": row['team_id'],
-            "team_name": team_names.get(row['team_id'], row['team_id']),
+            "team_name": row['team_name'],
             "count": row['count']
         }
         for row in tokens_by_team
@@ -993,27 +1080,45 @@ async def get_dashboard_overview(request: Request):
                 "id": row['id'],
                 "name": row['name'],
                 "team_id": row['team_id'],
-                "team_name": team_names.get(row['team_id'], row['team_id']),
+                "team_name": row['team_name'],
                 "expires_at": row['expires_at'].isoformat()
             }
             for row in expiring_soon
-        ]
+        ],
+        "anomalies": {
+            "active": len(active_anomalies),
+            "items": usage_anomaly_items(active_anomalies, anomaly_tokens)[:10]
+        }
     }
 
 
+AUDIT_LOG_COUNT_MODES = ("exact", "estimate", "none")
+AUDIT_LOG_MAX_LIMIT = 500
+
+
 @app.get("/api/dashboard/audit-logs")
 async def get_audit_logs(
     request: Request,
     limit: int = 50,
     offset: int = 0,
     action: str = None,
-    entity_type: str = None
+    entity_type: str = None,
+    cursor: Optional[str] = None,
+    count: str = "exact"
 ):
     """
     獲取審計日誌（帶分頁和篩選）
+    
+    - 依 (created_at, id) 由新到舊排序；帶 cursor=next_cursor 取得下一頁（游標分頁，深度翻頁不需要 OFFSET），
+      仍可用 offset 翻頁（帶 cursor 時忽略 offset）
+    - count：exact（COUNT(*)，預設）/ estimate（查詢計劃的估計值，不掃描資料）/ none（不計算，total 為 null）
     """
     user = await verify_clerk_token(request)
     
+    if count not in AUDIT_LOG_COUNT_MODES:
+        raise HTTPException(400, f"count must be one of: {', '.join(AUDIT_LOG_COUNT_MODES)}")
+    limit = max(1, min(limit, AUDIT_LOG_MAX_LIMIT))
+    
     # 構建查詢條件
     conditions = []
     params = []
@@ -1033,26 +1138,49 @@ async def get_audit_logs(
     if conditions:
         where_clause = "WHERE " + " AND ".join(conditions)
     
+    # 游標條件只影響這一頁的資料，不影響總數
+    page_conditions = list(conditions)
+    page_params = list(params)
+    if cursor:
+        created_at, log_id = decode_keyset_cursor(cursor)
+        page_conditions.append(f"(created_at, id) < (${param_count}, ${param_count + 1})")
+        page_params.extend([created_at, log_id])
+        param_count += 2
+        offset = 0
+    page_where_clause = ""
+    if page_conditions:
+        page_where_clause = "WHERE " + " AND ".join(page_conditions)
+    
     async with db.pool.acquire() as conn:
         # 獲取總數
-        count_query = f"SELECT COUNT(*) FROM audit_logs {where_clause}"
-        total = await conn.fetchval(count_query, *params)
+        total = None
+        if count == "exact":
+            total = await conn.fetchval(f"SELECT COUNT(*) FROM audit_logs {where_clause}", *params)
+        elif count == "estimate":
+            total = await db.estimate_count(conn, f"SELECT 1 FROM audit_logs {where_clause}", *params)
         
-        # 獲取數據
-        params.extend([limit, offset])
+        # 獲取數據（多取一筆判斷是否還有下一頁）
+        page_params.extend([limit + 1, offset])
         data_query = f"""
             SELECT id, action, entity_type, entity_id, details, created_at
             FROM audit_logs
-            {where_clause}
-            ORDER BY created_at DESC
+            {page_where_clause}
+            ORDER BY created_at DESC, id DESC
             LIMIT ${param_count} OFFSET ${param_count + 1}
         """
-        logs = await conn.fetch(data_query, *params)
+        logs = await conn.fetch(data_query, *page_params)
+    
+    next_cursor = None
+    if len(logs) > limit:
+        logs = logs[:limit]
+        next_cursor = encode_keyset_cursor(logs[-1]['created_at'], logs[-1]['id'])
     
     return {
         "total": total,
+        "total_is_estimate": count == "estimate",
         "limit": limit,
         "offset": offset,
+        "next_cursor": next_cursor,
         "data": [dict(log) for log in logs]
     }
 
@@ -1101,7 +1229,17 @@ async def health_detailed():
             "message": f"Database connection failed: {str(e)}"
         }
     
-    # 2. 檢查 Cloudflare KV（如果已配置）
+    # 2. 使用記錄寫入緩衝（接近上限時標記為 warning）
+    buffer_stats = usage_buffer.stats()
+    buffer_status = "healthy"
+    if buffer_stats["buffered"] >= usage_buffer.high_water:
+        buffer_status = "warning"
+    health_status["checks"]["usage_buffer"] = {
+        "status": buffer_status,
+        **buffer_stats
+    }
+    
+    # 3. 檢查 Cloudflare KV（如果已配置）
     try:
         cf_kv = get_cf_kv()
         if not cf_kv.is_dummy:
@@ -1129,7 +1267,7 @@ async def health_detailed():
             "message": f"Cloudflare KV check failed: {str(e)}"
         }
     
-    # 3. 檢查 Clerk 連接
+    # 4. 檢查 Clerk 連接
     try:
         from clerk_auth import clerk_client
         # 嘗試獲取用戶計數（limit 1 不會消耗太多資源）
@@ -1147,114 +1285,310 @@ async def health_detailed():
     return health_status
 
 
+def enqueue_usage_records(records: list) -> dict:
+    """
+    將使用記錄放入寫入緩衝
+    緩衝區已滿時返回 429 + Retry-After，讓 Worker 立即得到明確的過載信號；
+    重複的 event_id 視為已接受（count 不包含），Worker 可以安全重送
+    """
+    try:
+        added = usage_buffer.add(records)
+    except UsageBufferFull as e:
+        raise HTTPException(
+            429,
+            "Usage ingestion is overloaded, retry later",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    
+    result = {"status": "queued", "count": added["queued"]}
+    if added["dropped"]:
+        result["dropped"] = added["dropped"]
+    if added["duplicates"]:
+        result["duplicates"] = added["duplicates"]
+    return result
+
+
 @app.post("/api/usage-log")
 async def log_token_usage(request: Request):
     """
     記錄 Token 使用情況（由 Cloudflare Worker 調用）
     不需要認證，因為是內部調用
+    事件先放入緩衝區並立即返回，由背景任務批量寫入數據庫
     """
     try:
         data = await request.json()
-        token_hash = data.get('token_hash')
-        route_path = data.get('route')
-        timestamp = data.get('timestamp')
-        response_status = data.get('response_status')
-        response_time_ms = data.get('response_time_ms')
-        ip_address = data.get('ip_address')
-        user_agent = data.get('user_agent')
-        request_method = data.get('request_method')
-        error_message = data.get('error_message')
-        
-        if not token_hash:
-            raise HTTPException(400, "token_hash is required")
-        
+    except Exception:
+        raise HTTPException(400, "Invalid JSON body")
+    
+    try:
+        record = parse_usage_event(data)
+    except (ValueError, TypeError) as e:
+        raise HTTPException(400, str(e))
+    
+    return enqueue_usage_records([record])
+
+
+@app.post("/api/usage-log/batch")
+async def log_token_usage_batch(request: Request):
+    """
+    批量記錄 Token 使用情況（由 Cloudflare Worker 調用）
+    Body 可為 JSON 陣列或 NDJSON，每個事件格式與 /api/usage-log 相同
+    與單筆記錄共用緩衝區，由背景任務以 COPY 批量寫入
+    """
+    body = await request.body()
+
+    try:
+        events = parse_usage_batch(body, request.headers.get("content-type", ""))
+        records = []
+        for index, event in enumerate(events):
+            try:
+                records.append(parse_usage_event(event))
+            except (ValueError, TypeError) as e:
+                raise HTTPException(400, f"events[{index}]: {str(e)}")
+    except UnicodeDecodeError:
+        raise HTTPException(400, "Body must be UTF-8 encoded")
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    return enqueue_usage_records(records)
+
+
+@app.post("/api/usage-aggregate")
+async def log_usage_aggregate(request: Request):
+    """
+    寫入 Worker 預先彙總的使用計數（由 Cloudflare Worker 調用）
+    
+    每個計數為 (token_hash, route, status_class, minute) 一組，帶調用次數、延遲總和與直方圖，
+    直接累加到 usage_rollup_hourly（不產生原始記錄）。
+    可帶 batch_id，重送相同的 batch_id 不會重複計數（batch_id 保留 USAGE_AGGREGATE_BATCH_RETENTION_HOURS 小時）
+    """
+    try:
+        data = await request.json()
+    except Exception:
+        raise HTTPException(400, "Invalid JSON body")
+    
+    try:
+        rows, activity = parse_usage_counters(data)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    
+    batch_id = data.get('batch_id')
+    if batch_id is not None:
+        if not isinstance(batch_id, str) or not batch_id or len(batch_id) > 100:
+            raise HTTPException(400, "batch_id must be a non-empty string of at most 100 characters")
+        # 近期見過的批次直接返回，不必連線資料庫
+        if f"aggregate:{batch_id}" in usage_buffer.seen_event_ids:
+            return {"status": "duplicate", "rows": 0}
+    
+    duplicate = False
+    try:
         async with db.pool.acquire() as conn:
-            # 1. 更新 Token 的 last_used 時間
-            await conn.execute("""
-                UPDATE tokens 
-                SET last_used = NOW()
-                WHERE token_hash = $1
-            """, token_hash)
-            
-            # 2. 記錄詳細使用日誌
-            await conn.execute("""
-                INSERT INTO token_usage_logs (
-                    token_hash, route_path, used_at, response_status, 
-                    response_time_ms, ip_address, user_agent, request_method, error_message
-                )
-                VALUES ($1, $2, to_timestamp($3::double precision / 1000), $4, $5, $6, $7, $8, $9)
-            """, token_hash, route_path, timestamp, response_status, 
-                response_time_ms, ip_address, user_agent, request_method, error_message)
-        
-        return {"status": "logged"}
+            async with conn.transaction():
+                # batch_id 與計數在同一個交易寫入：重啟或多個實例之間也不會重複累加；
+                # 並發送達的相同批次會等前一個交易結束，之後插入衝突而略過
+                if batch_id is not None:
+                    inserted = await conn.fetchval("""
+                        INSERT INTO usage_aggregate_batches (batch_id) VALUES ($1)
+                        ON CONFLICT (batch_id) DO NOTHING
+                        RETURNING batch_id
+                    """, batch_id)
+                    duplicate = inserted is None
+                if not duplicate:
+                    await write_hourly_rollups(conn, rows)
+                    await write_team_rollups(conn, rows)
     except Exception as e:
-        # 記錄錯誤但不影響 Worker 的正常運作
-        print(f"Warning: Failed to log token usage: {e}")
-        import traceback
-        print(traceback.format_exc())
-        return {"status": "error", "message": str(e)}
+        print(f"Error writing usage aggregate: {e}")
+        raise HTTPException(
+            503,
+            "Usage aggregate could not be stored, retry later",
+            headers={"Retry-After": str(usage_buffer.retry_after)}
+        )
+    
+    if batch_id is not None:
+        usage_buffer.seen_event_ids.add(f"aggregate:{batch_id}")
+    if duplicate:
+        return {"status": "duplicate", "rows": 0}
+    
+    usage_buffer.record_activity(activity)
+    for row in rows:
+        heavy_hitters.add(row[1], row[2], row[9], row[3])
+        usage_anomaly_detector.add(row[1], row[3], row[4])
+    
+    return {
+        "status": "merged",
+        "calls": sum(row[3] for row in rows),
+        "rows": len(rows)
+    }
+
+
+# 高吞吐量寫入端點：不經過 FastAPI 的請求處理，直接以 ASGI handler 解析（見 usage_asgi.py）
+app.add_route("/api/usage-ingest", usage_ingest_endpoint, methods=["POST"])
+
+
+@app.get("/api/usage-log/metrics")
+async def get_usage_log_metrics():
+    """
+    使用記錄寫入緩衝的狀態（內部監控用）
+    包含緩衝中的事件數與 queued / flushed / dropped / rejected 累計計數，以及統計快照快取的命中情況
+    """
+    return {
+        **usage_buffer.stats(),
+        "stats_cache": usage_stats_cache.stats(),
+        "heavy_hitters": heavy_hitters.stats(),
+        "anomalies": usage_anomaly_detector.stats()
+    }
 
 
 @app.get("/api/usage/stats")
 async def get_usage_stats(request: Request):
     """
-    獲取整體使用統計
+    獲取整體使用統計（經由快照快取，見 snapshot_cache.py）
     """
     user = await verify_clerk_token(request)
-    
-    async with db.pool.acquire() as conn:
-        # 1. 總體統計
-        total_calls = await conn.fetchval("SELECT COUNT(*) FROM token_usage_logs")
-        total_errors = await conn.fetchval("SELECT COUNT(*) FROM token_usage_logs WHERE response_status >= 400")
-        avg_response_time = await conn.fetchval("SELECT AVG(response_time_ms) FROM token_usage_logs WHERE response_time_ms IS NOT NULL")
-        
-        # 2. 最近 24 小時的調用趨勢
-        hourly_usage = await conn.fetch("""
-            SELECT 
-                DATE_TRUNC('hour', used_at) as hour,
-                COUNT(*) as call_count,
-                AVG(response_time_ms) as avg_response_time
-            FROM token_usage_logs
-            WHERE used_at >= NOW() - INTERVAL '24 hours'
-            GROUP BY hour
-            ORDER BY hour DESC
-        """)
-        
-        # 3. Top 10 最常使用的 Token
-        top_tokens = await conn.fetch("""
+    return await usage_stats_cache.get(("usage_stats",), compute_usage_stats)
+
+
+async def compute_usage_stats():
+    """計算整體使用統計（所有使用者共用同一份結果）"""
+    # Top 10 Token / 路由：即時統計（usage_heavy_hitters）已載入時由記憶體排名，
+    # 只查詢排名內 key 的名稱與延遲；否則在每小時彙總上 GROUP BY 最近 7 天
+    if heavy_hitters.loaded:
+        # 多取一些，已刪除的 Token 在 JOIN 後會被排除
+        top_token_counts = {key: count for key, count, _ in heavy_hitters.top("token", "7d", 20)}
+        top_route_counts = {key: count for key, count, _ in heavy_hitters.top("route", "7d", 10)}
+        top_tokens_query = ("fetch", """
             SELECT 
                 t.id,
                 t.token_hash,
                 t.name,
                 t.team_id,
-                COUNT(ul.id) as usage_count,
-                MAX(ul.used_at) as last_used
+                u.max_response_time,
+                u.latency_buckets,
+                ta.last_used
             FROM tokens t
-            INNER JOIN token_usage_logs ul ON t.token_hash = ul.token_hash AND ul.used_at >= NOW() - INTERVAL '7 days'
-            GROUP BY t.id, t.token_hash, t.name, t.team_id
-            ORDER BY usage_count DESC
+            LEFT JOIN (
+                SELECT 
+                    token_hash,
+                    MAX(max_ms) as max_response_time,
+                    usage_sum_buckets(latency_buckets) as latency_buckets
+                FROM usage_rollup_hourly
+                WHERE token_hash = ANY($1::text[])
+                  AND hour >= DATE_TRUNC('hour', NOW() - INTERVAL '7 days')
+                GROUP BY token_hash
+            ) u ON u.token_hash = t.token_hash
+            LEFT JOIN token_activity ta ON ta.token_hash = t.token_hash
+            WHERE t.token_hash = ANY($1::text[])
+        """, list(top_token_counts))
+        top_routes_query = ("fetch", """
+            SELECT 
+                k.route_path,
+                r.name as route_name,
+                r.id as route_id,
+                u.avg_response_time,
+                u.max_response_time,
+                u.latency_buckets,
+                COALESCE(u.error_count, 0) as error_count
+            FROM unnest($1::text[]) AS k(route_path)
+            LEFT JOIN (
+                SELECT 
+                    route_path,
+                    SUM(sum_ms)::float / NULLIF(SUM(timed_calls), 0) as avg_response_time,
+                    MAX(max_ms) as max_response_time,
+                    usage_sum_buckets(latency_buckets) as latency_buckets,
+                    SUM(errors)::bigint as error_count
+                FROM usage_rollup_hourly
+                WHERE route_path = ANY($1::text[])
+                  AND hour >= DATE_TRUNC('hour', NOW() - INTERVAL '7 days')
+                GROUP BY route_path
+            ) u ON u.route_path = k.route_path
+            LEFT JOIN routes r ON r.path = k.route_path
+        """, list(top_route_counts))
+    else:
+        top_token_counts = top_route_counts = None
+        top_tokens_query = ("fetch", """
+            SELECT 
+                t.id,
+                t.token_hash,
+                t.name,
+                t.team_id,
+                u.usage_count,
+                u.max_response_time,
+                u.latency_buckets,
+                ta.last_used
+            FROM (
+                SELECT 
+                    token_hash,
+                    SUM(calls)::bigint as usage_count,
+                    MAX(max_ms) as max_response_time,
+                    usage_sum_buckets(latency_buckets) as latency_buckets
+                FROM usage_rollup_hourly
+                WHERE hour >= DATE_TRUNC('hour', NOW() - INTERVAL '7 days')
+                GROUP BY token_hash
+            ) u
+            INNER JOIN tokens t ON t.token_hash = u.token_hash
+            LEFT JOIN token_activity ta ON ta.token_hash = t.token_hash
+            ORDER BY u.usage_count DESC
             LIMIT 10
         """)
-        
-        # 4. Top 10 最常訪問的路由（JOIN routes 獲取名稱）
-        top_routes = await conn.fetch("""
+        top_routes_query = ("fetch", """
             SELECT 
-                ul.route_path,
+                u.route_path,
                 r.name as route_name,
                 r.id as route_id,
-                COUNT(*) as call_count,
-                AVG(ul.response_time_ms) as avg_response_time,
-                COUNT(CASE WHEN ul.response_status >= 400 THEN 1 END) as error_count
-            FROM token_usage_logs ul
-            LEFT JOIN routes r ON ul.route_path = r.path
-            WHERE ul.used_at >= NOW() - INTERVAL '7 days'
-            GROUP BY ul.route_path, r.name, r.id
-            ORDER BY call_count DESC
+                u.call_count,
+                u.avg_response_time,
+                u.max_response_time,
+                u.latency_buckets,
+                u.error_count
+            FROM (
+                SELECT 
+                    NULLIF(route_path, '') as route_path,
+                    SUM(calls)::bigint as call_count,
+                    SUM(sum_ms)::float / NULLIF(SUM(timed_calls), 0) as avg_response_time,
+                    MAX(max_ms) as max_response_time,
+                    usage_sum_buckets(latency_buckets) as latency_buckets,
+                    SUM(errors)::bigint as error_count
+                FROM usage_rollup_hourly
+                WHERE hour >= DATE_TRUNC('hour', NOW() - INTERVAL '7 days')
+                GROUP BY route_path
+            ) u
+            LEFT JOIN routes r ON u.route_path = r.path
+            ORDER BY u.call_count DESC
             LIMIT 10
         """)
     
+    # 全期間統計讀取 usage_rollup_combined（每日 + 每小時彙總），最近區間讀取 usage_rollup_hourly，時間區間以整點對齊
+    # 各區塊互不相依，以多個連接並行查詢
+    overview, hourly_usage, top_tokens, top_routes, recent_logs = await db.gather_queries(
+        # 1. 總體統計
+        ("fetchrow", """
+            SELECT 
+                COALESCE(SUM(calls), 0)::bigint as total_calls,
+                COALESCE(SUM(errors), 0)::bigint as total_errors,
+                SUM(sum_ms)::float / NULLIF(SUM(timed_calls), 0) as avg_response_time,
+                MAX(max_ms) as max_response_time,
+                usage_sum_buckets(latency_buckets) as latency_buckets
+            FROM usage_rollup_combined
+        """),
+        # 2. 最近 24 小時的調用趨勢
+        ("fetch", """
+            SELECT 
+                hour,
+                SUM(calls)::bigint as call_count,
+                SUM(sum_ms)::float / NULLIF(SUM(timed_calls), 0) as avg_response_time,
+                MAX(max_ms) as max_response_time,
+                usage_sum_buckets(latency_buckets) as latency_buckets
+            FROM usage_rollup_hourly
+            WHERE hour >= DATE_TRUNC('hour', NOW() - INTERVAL '24 hours')
+            GROUP BY hour
+            ORDER BY hour DESC
+        """),
+        # 3. Top 10 最常使用的 Token
+        top_tokens_query,
+        # 4. Top 10 最常訪問的路由（JOIN routes 獲取名稱）
+        top_routes_query,
         # 5. 最近 100 條調用記錄（JOIN tokens 獲取名稱）
-        recent_logs = await conn.fetch("""
+        ("fetch", """
             SELECT 
                 ul.token_hash,
                 t.id as token_id,
@@ -1265,24 +1599,40 @@ async def get_usage_stats(request: Request):
                 ul.response_time_ms,
                 ul.ip_address,
                 ul.used_at
-            FROM token_usage_logs ul
+            FROM usage_log_entries ul
             LEFT JOIN tokens t ON ul.token_hash = t.token_hash
             ORDER BY ul.used_at DESC
             LIMIT 100
-        """)
+        """),
+    )
+    if top_token_counts is not None:
+        top_tokens = sorted(
+            (dict(row, usage_count=top_token_counts[row['token_hash']]) for row in top_tokens),
+            key=lambda row: row['usage_count'], reverse=True
+        )[:10]
+        top_routes = sorted(
+            (dict(row, call_count=top_route_counts[row['route_path']]) for row in top_routes),
+            key=lambda row: row['call_count'], reverse=True
+        )
+    
+    total_calls = overview['total_calls']
+    total_errors = overview['total_errors']
+    avg_response_time = overview['avg_response_time']
     
     return {
         "overview": {
             "total_calls": total_calls,
             "total_errors": total_errors,
             "avg_response_time": float(avg_response_time) if avg_response_time else 0,
+            **latency_percentiles(overview['latency_buckets'], overview['max_response_time']),
             "success_rate": ((total_calls - total_errors) / total_calls * 100) if total_calls > 0 else 0
         },
         "hourly_usage": [
             {
                 "hour": row['hour'].isoformat(),
                 "call_count": row['call_count'],
-                "avg_response_time": float(row['avg_response_time']) if row['avg_response_time'] else 0
+                "avg_response_time": float(row['avg_response_time']) if row['avg_response_time'] else 0,
+                **latency_percentiles(row['latency_buckets'], row['max_response_time'])
             }
             for row in hourly_usage
         ],
@@ -1292,6 +1642,7 @@ async def get_usage_stats(request: Request):
                 "name": row['name'],
                 "team_id": row['team_id'],
                 "usage_count": row['usage_count'],
+                **latency_percentiles(row['latency_buckets'], row['max_response_time']),
                 "last_used": row['last_used'].isoformat() if row['last_used'] else None
             }
             for row in top_tokens
@@ -1303,6 +1654,7 @@ async def get_usage_stats(request: Request):
                 "route_id": row['route_id'],
                 "call_count": row['call_count'],
                 "avg_response_time": float(row['avg_response_time']) if row['avg_response_time'] else 0,
+                **latency_percentiles(row['latency_buckets'], row['max_response_time']),
                 "error_count": row['error_count'],
                 "success_rate": ((row['call_count'] - row['error_count']) / row['call_count'] * 100) if row['call_count'] > 0 else 0
             }
@@ -1325,61 +1677,367 @@ async def get_usage_stats(request: Request):
     }
 
 
+@app.get("/api/usage/top")
+async def get_usage_top(request: Request, dimension: str = "token", window: str = "24h", limit: int = 10):
+    """
+    最常使用的 Token / 路由（由記憶體中的即時統計返回，見 usage_heavy_hitters.py）
+    
+    dimension: token / route；window: 1h / 24h / 7d。
+    count 為估計次數，真實次數介於 count - error 與 count 之間
+    """
+    user = await verify_clerk_token(request)
+    
+    if dimension not in ("token", "route"):
+        raise HTTPException(400, "dimension must be 'token' or 'route'")
+    if window not in HEAVY_HITTER_WINDOWS:
+        raise HTTPException(400, f"window must be one of: {', '.join(HEAVY_HITTER_WINDOWS)}")
+    if not heavy_hitters.loaded:
+        raise HTTPException(503, "Real-time usage ranking is not available")
+    limit = max(1, min(limit, heavy_hitters.capacity))
+    
+    if dimension == "route":
+        ranked = heavy_hitters.top("route", window, limit)
+        async with db.pool.acquire() as conn:
+            routes = await conn.fetch(
+                "SELECT id, name, path FROM routes WHERE path = ANY($1::text[])",
+                [key for key, _, _ in ranked]
+            )
+        names = {row['path']: row for row in routes}
+        items = [
+            {
+                "route_path": key,
+                "route_name": names[key]['name'] if key in names else key,
+                "route_id": names[key]['id'] if key in names else None,
+                "count": count,
+                "error": error
+            }
+            for key, count, error in ranked
+        ]
+    else:
+        # 多取一些，已刪除的 Token 會被排除
+        ranked = heavy_hitters.top("token", window, limit * 2)
+        async with db.pool.acquire() as conn:
+            tokens = await conn.fetch(
+                "SELECT id, name, team_id, token_hash FROM tokens WHERE token_hash = ANY($1::text[])",
+                [key for key, _, _ in ranked]
+            )
+        names = {row['token_hash']: row for row in tokens}
+        items = [
+            {
+                "id": names[key]['id'],
+                "name": names[key]['name'],
+                "team_id": names[key]['team_id'],
+                "count": count,
+                "error": error
+            }
+            for key, count, error in ranked if key in names
+        ][:limit]
+    
+    return {"dimension": dimension, "window": window, "items": items}
+
+
+def usage_anomaly_items(anomalies, tokens) -> List[dict]:
+    """異常記錄補上 Token 名稱（已刪除的 Token 會被排除）"""
+    names = {row['token_hash']: row for row in tokens}
+    return [
+        {
+            "id": anomaly['id'],
+            "token_id": names[anomaly['token_hash']]['id'],
+            "token_name": names[anomaly['token_hash']]['name'],
+            "team_id": names[anomaly['token_hash']]['team_id'],
+            "kind": anomaly['kind'],
+            "started_at": anomaly['started_at'],
+            "last_seen_at": anomaly['last_seen_at'],
+            "resolved_at": anomaly['resolved_at'],
+            "observed": anomaly['observed'],
+            "expected": anomaly['expected'],
+            "score": anomaly['score']
+        }
+        for anomaly in anomalies if anomaly['token_hash'] in names
+    ]
+
+
+@app.get("/api/usage/anomalies")
+async def get_usage_anomalies(
+    request: Request,
+    token_id: Optional[int] = None,
+    include_resolved: bool = True,
+    limit: int = 50
+):
+    """
+    Token 的使用異常（調用量突增 / 驟降、錯誤率突增，偵測方式見 usage_anomaly.py）
+    
+    active 由記憶體返回；include_resolved 時另從數據庫返回最近結束的 limit 筆。
+    spike / drop 的 observed / expected 為每分鐘調用數，error_spike 為錯誤率；
+    指定 token_id 時同時返回該 Token 目前的基準線
+    """
+    user = await verify_clerk_token(request)
+    limit = max(1, min(limit, 500))
+    
+    token_hashes = None
+    token_hash = None
+    if token_id is not None:
+        async with db.pool.acquire() as conn:
+            token_hash = await conn.fetchval("SELECT token_hash FROM tokens WHERE id = $1", token_id)
+        if not token_hash:
+            raise HTTPException(404, "Token not found")
+        token_hashes = {token_hash}
+    
+    active = usage_anomaly_detector.active(token_hashes)
+    resolved = []
+    async with db.pool.acquire() as conn:
+        if include_resolved:
+            if token_hash:
+                resolved = await conn.fetch("""
+                    SELECT id::text as id, token_hash, kind, started_at, last_seen_at, resolved_at,
+                           observed, expected, score
+                    FROM usage_anomalies
+                    WHERE resolved_at IS NOT NULL AND token_hash = $1
+                    ORDER BY started_at DESC
+                    LIMIT $2
+                """, token_hash, limit)
+            else:
+                resolved = await conn.fetch("""
+                    SELECT id::text as id, token_hash, kind, started_at, last_seen_at, resolved_at,
+                           observed, expected, score
+                    FROM usage_anomalies
+                    WHERE resolved_at IS NOT NULL
+                    ORDER BY started_at DESC
+                    LIMIT $1
+                """, limit)
+        tokens = await conn.fetch(
+            "SELECT id, name, team_id, token_hash FROM tokens WHERE token_hash = ANY($1::text[])",
+            list({row['token_hash'] for row in [*active, *resolved]})
+        )
+    
+    result = {
+        "active": usage_anomaly_items(active, tokens),
+        "resolved": usage_anomaly_items(resolved, tokens)
+    }
+    if token_hash:
+        result["baseline"] = usage_anomaly_detector.baseline(token_hash)
+    return result
+
+
+def usage_rollup_row(row) -> dict:
+    """彙總查詢的結果列轉為 dict，latency_buckets 換成 p50 / p95 / p99 估計值"""
+    data = dict(row)
+    data.update(latency_percentiles(data.pop('latency_buckets', None), data.get('max_response_time')))
+    return data
+
+
+def to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """帶時區的時間轉為 naive UTC（與 used_at 一致）"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def usage_time_window(date_from: Optional[datetime], date_to: Optional[datetime], default_days: int = 7):
+    """
+    查詢的時間區間 [from, to)，轉為 naive UTC
+
+    未指定 to 時為現在，未指定 from 時為 to 往前 default_days 天
+    """
+    end = to_naive_utc(date_to) or datetime.utcnow()
+    start = to_naive_utc(date_from) or end - timedelta(days=default_days)
+    if start >= end:
+        raise HTTPException(400, "'from' must be earlier than 'to'")
+    return start, end
+
+
+# 使用記錄列表可選的欄位（fields 參數），id 與 used_at 用於分頁游標，一定會返回
+USAGE_HISTORY_FIELDS = (
+    'id', 'token_hash', 'route_path', 'used_at', 'response_status', 'response_time_ms',
+    'ip_address', 'user_agent', 'request_method', 'error_message', 'event_id'
+)
+USAGE_HISTORY_MAX_LIMIT = 1000
+
+
+def encode_keyset_cursor(timestamp: datetime, row_id: int) -> str:
+    """分頁游標：最後一筆記錄的 (時間, id)（使用記錄為 used_at，審計日誌為 created_at）"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode()).decode()
+
+
+def decode_keyset_cursor(cursor: str):
+    try:
+        timestamp, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise HTTPException(400, "Invalid cursor")
+
+
+class UsageHistoryQuery:
+    """
+    使用記錄列表的查詢參數（游標分頁、時間區間、欄位投影）
+
+    以 (used_at, id) 由新到舊排序，下一頁從游標之後繼續，
+    走 usage_logs 的 (token_id, used_at) / (route_id, used_at) 索引，深度翻頁不需要 OFFSET
+    """
+
+    def __init__(
+        self,
+        limit: int,
+        date_from: Optional[datetime],
+        date_to: Optional[datetime],
+        cursor: Optional[str],
+        fields: Optional[str],
+        joined_fields: tuple
+    ):
+        if limit < 1 or limit > USAGE_HISTORY_MAX_LIMIT:
+            raise HTTPException(400, f"limit must be between 1 and {USAGE_HISTORY_MAX_LIMIT}")
+        self.limit = limit
+        self.start = to_naive_utc(date_from)
+        self.end = to_naive_utc(date_to)
+        if self.start and self.end and self.start >= self.end:
+            raise HTTPException(400, "'from' must be earlier than 'to'")
+        self.cursor = decode_keyset_cursor(cursor) if cursor else None
+        
+        allowed = USAGE_HISTORY_FIELDS + joined_fields
+        if fields:
+            requested = [field.strip() for field in fields.split(",") if field.strip()]
+            unknown = [field for field in requested if field not in allowed]
+            if unknown:
+                raise HTTPException(400, f"Unknown fields: {', '.join(unknown)}")
+        else:
+            requested = list(allowed)
+        self.fields = list(dict.fromkeys(['id', 'used_at'] + requested))
+        self.joined_fields = [field for field in self.fields if field in joined_fields]
+    
+    def cache_key(self):
+        return (self.limit, self.start, self.end, self.cursor, tuple(self.fields))
+    
+    async def fetch(self, conn, filter_column: str, value: str, join_sql: str, join_columns: Dict[str, str]):
+        """
+        查詢一頁記錄
+        
+        Returns:
+            (記錄列表, 下一頁游標；沒有下一頁時為 None)
+        """
+        columns = [f"ul.{field}" for field in self.fields if field not in join_columns]
+        columns += [f"{join_columns[field]} as {field}" for field in self.joined_fields]
+        conditions = [f"ul.{filter_column} = $1"]
+        params = [value]
+        if self.start:
+            params.append(self.start)
+            conditions.append(f"ul.used_at >= ${len(params)}")
+        if self.end:
+            params.append(self.end)
+            conditions.append(f"ul.used_at < ${len(params)}")
+        if self.cursor:
+            params.extend(self.cursor)
+            # 多加一個 used_at 條件，讓 (token_id, used_at) 索引可以直接定位到游標位置
+            conditions.append(f"ul.used_at <= ${len(params) - 1}")
+            conditions.append(f"(ul.used_at, ul.id) < (${len(params) - 1}, ${len(params)})")
+        params.append(self.limit + 1)
+        
+        rows = await conn.fetch(f"""
+            SELECT {', '.join(columns)}
+            FROM usage_log_entries ul
+            {join_sql if self.joined_fields else ''}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY ul.used_at DESC, ul.id DESC
+            LIMIT ${len(params)}
+        """, *params)
+        
+        next_cursor = None
+        if len(rows) > self.limit:
+            rows = rows[:self.limit]
+            next_cursor = encode_keyset_cursor(rows[-1]['used_at'], rows[-1]['id'])
+        return [dict(row) for row in rows], next_cursor
+
+
+TOKEN_HISTORY_JOIN = "LEFT JOIN routes r ON ul.route_path = r.path"
+TOKEN_HISTORY_JOIN_COLUMNS = {"route_name": "r.name", "route_id": "r.id"}
+ROUTE_HISTORY_JOIN = "LEFT JOIN tokens t ON ul.token_hash = t.token_hash"
+ROUTE_HISTORY_JOIN_COLUMNS = {"token_name": "t.name", "token_id": "t.id"}
+
+
 @app.get("/api/usage/token/{token_id}")
-async def get_token_usage(token_id: int, request: Request, limit: int = 50):
+async def get_token_usage(
+    token_id: int,
+    request: Request,
+    limit: int = 50,
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
     """
     獲取特定 Token 的使用記錄
+    
+    - recent_usage：[from, to) 內由新到舊的記錄（未指定時不限），fields 可指定返回的欄位（逗號分隔）
+    - next_cursor：還有更早的記錄時，帶 cursor=next_cursor 取得下一頁（翻頁請求只返回記錄）
+    - distinct_clients：[from, to)（預設最近 7 天）內不同 IP / User-Agent 數的估計值
     """
     user = await verify_clerk_token(request)
     
     async with db.pool.acquire() as conn:
         # 獲取 Token 資訊
         token = await conn.fetchrow("SELECT * FROM tokens WHERE id = $1", token_id)
-        if not token:
-            raise HTTPException(404, "Token not found")
-        
-        # 檢查權限
-        await check_team_token_permission(user, token['team_id'], "edit")
-        
+    if not token:
+        raise HTTPException(404, "Token not found")
+    
+    # 檢查權限
+    await check_team_token_permission(user, token['team_id'], "edit")
+    
+    history = UsageHistoryQuery(limit, date_from, date_to, cursor, fields, tuple(TOKEN_HISTORY_JOIN_COLUMNS))
+    if history.cursor:
+        async with db.pool.acquire() as conn:
+            usage_logs, next_cursor = await history.fetch(
+                conn, "token_hash", token['token_hash'], TOKEN_HISTORY_JOIN, TOKEN_HISTORY_JOIN_COLUMNS
+            )
+        return {"recent_usage": usage_logs, "next_cursor": next_cursor}
+    
+    start, end = usage_time_window(date_from, date_to)
+    return await usage_stats_cache.get(
+        ("token_usage", token_id, history.cache_key()),
+        lambda: compute_token_usage(token, history, start, end)
+    )
+
+
+async def compute_token_usage(token, history: UsageHistoryQuery, start: datetime, end: datetime):
+    """計算特定 Token 的使用記錄與統計"""
+    async with db.pool.acquire() as conn:
         # 獲取使用記錄（JOIN routes 獲取名稱）
-        usage_logs = await conn.fetch("""
-            SELECT 
-                ul.*,
-                r.name as route_name,
-                r.id as route_id
-            FROM token_usage_logs ul
-            LEFT JOIN routes r ON ul.route_path = r.path
-            WHERE ul.token_hash = $1
-            ORDER BY ul.used_at DESC
-            LIMIT $2
-        """, token['token_hash'], limit)
+        usage_logs, next_cursor = await history.fetch(
+            conn, "token_hash", token['token_hash'], TOKEN_HISTORY_JOIN, TOKEN_HISTORY_JOIN_COLUMNS
+        )
         
-        # 統計數據
+        # 統計數據（讀取全期間彙總）
         stats = await conn.fetchrow("""
             SELECT 
-                COUNT(*) as total_calls,
-                COUNT(CASE WHEN response_status >= 400 THEN 1 END) as error_count,
-                AVG(response_time_ms) as avg_response_time,
-                MIN(used_at) as first_used,
-                MAX(used_at) as last_used
-            FROM token_usage_logs
+                COALESCE(SUM(calls), 0)::bigint as total_calls,
+                COALESCE(SUM(errors), 0)::bigint as error_count,
+                SUM(sum_ms)::float / NULLIF(SUM(timed_calls), 0) as avg_response_time,
+                MAX(max_ms) as max_response_time,
+                usage_sum_buckets(latency_buckets) as latency_buckets,
+                MIN(first_at) as first_used,
+                MAX(last_at) as last_used
+            FROM usage_rollup_combined
             WHERE token_hash = $1
         """, token['token_hash'])
-    
-    # 獲取路由分佈（帶名稱）
-    async with db.pool.acquire() as conn:
+        
+        # 獲取路由分佈（帶名稱）
         route_distribution = await conn.fetch("""
             SELECT 
                 r.id as route_id,
                 r.name as route_name,
                 r.path as route_path,
-                COUNT(*) as count
-            FROM token_usage_logs ul
-            LEFT JOIN routes r ON ul.route_path = r.path
-            WHERE ul.token_hash = $1
+                SUM(u.calls)::bigint as count,
+                MAX(u.max_ms) as max_response_time,
+                usage_sum_buckets(u.latency_buckets) as latency_buckets
+            FROM usage_rollup_combined u
+            LEFT JOIN routes r ON NULLIF(u.route_path, '') = r.path
+            WHERE u.token_hash = $1
             GROUP BY r.id, r.name, r.path
             ORDER BY count DESC
         """, token['token_hash'])
+        
+        # 不同 IP / User-Agent 數（合併每小時的 HyperLogLog sketch）
+        distinct_clients = await fetch_distinct_counts(
+            conn, DISTINCT_DIMENSION_TOKEN, token['token_hash'], start, end
+        )
     
     return {
         "token": {
@@ -1387,40 +2045,68 @@ async def get_token_usage(token_id: int, request: Request, limit: int = 50):
             "name": token['name'],
             "team_id": token['team_id']
         },
-        "stats": dict(stats) if stats else {},
-        "recent_usage": [dict(log) for log in usage_logs],
-        "route_distribution": [dict(d) for d in route_distribution]
+        "stats": usage_rollup_row(stats) if stats else {},
+        "distinct_clients": distinct_clients,
+        "recent_usage": usage_logs,
+        "next_cursor": next_cursor,
+        "route_distribution": [usage_rollup_row(d) for d in route_distribution]
     }
 
 
 @app.get("/api/usage/route")
-async def get_route_usage(request: Request, route_path: str = None, limit: int = 50):
+async def get_route_usage(
+    request: Request,
+    route_path: str = None,
+    limit: int = 50,
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None
+):
     """
     獲取路由的使用記錄
+    
+    指定路由時：
+    - usage_logs：[from, to) 內由新到舊的記錄（未指定時不限），fields 可指定返回的欄位（逗號分隔）
+    - next_cursor：還有更早的記錄時，帶 cursor=next_cursor 取得下一頁（翻頁請求只返回記錄）
+    - distinct_clients：[from, to)（預設最近 7 天）內不同 IP / User-Agent 數的估計值
     """
     user = await verify_clerk_token(request)
     
+    history = UsageHistoryQuery(limit, date_from, date_to, cursor, fields, tuple(ROUTE_HISTORY_JOIN_COLUMNS))
+    if route_path and history.cursor:
+        async with db.pool.acquire() as conn:
+            usage_logs, next_cursor = await history.fetch(
+                conn, "route_path", route_path, ROUTE_HISTORY_JOIN, ROUTE_HISTORY_JOIN_COLUMNS
+            )
+        return {"usage_logs": usage_logs, "next_cursor": next_cursor}
+    
+    start, end = usage_time_window(date_from, date_to)
+    return await usage_stats_cache.get(
+        ("route_usage", route_path, history.cache_key()),
+        lambda: compute_route_usage(route_path, history, start, end)
+    )
+
+
+async def compute_route_usage(route_path: str, history: UsageHistoryQuery, start: datetime, end: datetime):
+    """計算路由的使用記錄與統計"""
+    next_cursor = None
     async with db.pool.acquire() as conn:
         if route_path:
             # 特定路由的使用記錄（JOIN tokens 獲取名稱）
-            usage_logs = await conn.fetch("""
-                SELECT 
-                    ul.*,
-                    t.name as token_name,
-                    t.id as token_id
-                FROM token_usage_logs ul
-                LEFT JOIN tokens t ON ul.token_hash = t.token_hash
-                WHERE ul.route_path = $1
-                ORDER BY ul.used_at DESC
-                LIMIT $2
-            """, route_path, limit)
+            usage_logs, next_cursor = await history.fetch(
+                conn, "route_path", route_path, ROUTE_HISTORY_JOIN, ROUTE_HISTORY_JOIN_COLUMNS
+            )
             
+            # 統計數據（讀取全期間彙總）
             stats = await conn.fetchrow("""
                 SELECT 
-                    COUNT(*) as total_calls,
-                    COUNT(CASE WHEN response_status >= 400 THEN 1 END) as error_count,
-                    AVG(response_time_ms) as avg_response_time
-                FROM token_usage_logs
+                    COALESCE(SUM(calls), 0)::bigint as total_calls,
+                    COALESCE(SUM(errors), 0)::bigint as error_count,
+                    SUM(sum_ms)::float / NULLIF(SUM(timed_calls), 0) as avg_response_time,
+                    MAX(max_ms) as max_response_time,
+                    usage_sum_buckets(latency_buckets) as latency_buckets
+                FROM usage_rollup_combined
                 WHERE route_path = $1
             """, route_path)
             
@@ -1429,41 +2115,494 @@ async def get_route_usage(request: Request, route_path: str = None, limit: int =
                 SELECT 
                     t.id as token_id,
                     t.name as token_name,
-                    COUNT(*) as count
-                FROM token_usage_logs ul
-                LEFT JOIN tokens t ON ul.token_hash = t.token_hash
-                WHERE ul.route_path = $1
+                    SUM(u.calls)::bigint as count,
+                    MAX(u.max_ms) as max_response_time,
+                    usage_sum_buckets(u.latency_buckets) as latency_buckets
+                FROM usage_rollup_combined u
+                LEFT JOIN tokens t ON u.token_hash = t.token_hash
+                WHERE u.route_path = $1
                 GROUP BY t.id, t.name
                 ORDER BY count DESC
                 LIMIT 5
             """, route_path)
+            
+            # 不同 IP / User-Agent 數（合併每小時的 HyperLogLog sketch）
+            distinct_clients = await fetch_distinct_counts(
+                conn, DISTINCT_DIMENSION_ROUTE, route_path, start, end
+            )
         else:
-            # 所有路由的統計
+            # 所有路由的統計（讀取全期間彙總）
             usage_logs = await conn.fetch("""
                 SELECT 
-                    route_path,
-                    COUNT(*) as call_count,
-                    AVG(response_time_ms) as avg_response_time,
-                    MAX(used_at) as last_used
-                FROM token_usage_logs
+                    NULLIF(route_path, '') as route_path,
+                    SUM(calls)::bigint as call_count,
+                    SUM(sum_ms)::float / NULLIF(SUM(timed_calls), 0) as avg_response_time,
+                    MAX(max_ms) as max_response_time,
+                    usage_sum_buckets(latency_buckets) as latency_buckets,
+                    MAX(last_at) as last_used
+                FROM usage_rollup_combined
                 GROUP BY route_path
                 ORDER BY call_count DESC
                 LIMIT $1
-            """, limit)
+            """, history.limit)
             stats = None
             token_distribution = None
+            distinct_clients = None
     
     result = {
-        "stats": dict(stats) if stats else None,
-        "usage_logs": [dict(log) for log in usage_logs]
+        "stats": usage_rollup_row(stats) if stats else None,
+        # 指定路由時為原始記錄，否則為各路由的彙總
+        "usage_logs": usage_logs if route_path else [usage_rollup_row(row) for row in usage_logs]
     }
+    if route_path:
+        result["next_cursor"] = next_cursor
     
     if route_path and token_distribution:
-        result["token_distribution"] = [dict(d) for d in token_distribution]
+        result["token_distribution"] = [usage_rollup_row(d) for d in token_distribution]
+    if distinct_clients is not None:
+        result["distinct_clients"] = distinct_clients
     
     return result
 
 
+USAGE_TEAM_BUCKETS = ("hour", "day", "week", "month")
+
+
+def check_team_usage_permission(user: dict, team_id: str):
+    """團隊的使用統計：全局 ADMIN 或該團隊的成員可查看"""
+    if user.get("public_metadata", {}).get("tokenManager:globalRole") == "ADMIN":
+        return
+    if team_id not in get_user_teams(user):
+        raise HTTPException(403, f"You are not a member of team '{team_id}'")
+
+
+@app.get("/api/usage/teams")
+async def get_team_usage(
+    request: Request,
+    team_id: Optional[str] = None,
+    bucket: str = "day",
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to")
+):
+    """
+    按團隊的使用統計與成本分攤（讀 usage_rollup_team_hourly，寫入時已按團隊彙總）
+    
+    - teams：[from, to)（預設最近 30 天）內每個團隊的調用數、錯誤數、延遲與成本，
+      以及每個時間桶（bucket：hour / day / week / month）與每個路由的明細
+    - 成本 = 調用數 × 路由的 cost_weight（未設定的路由為 1）
+    - 全局 ADMIN 可查看所有團隊（team_id 為 '' 表示沒有團隊的 Token），其他用戶只能查看自己所屬的團隊
+    """
+    user = await verify_clerk_token(request)
+    
+    if bucket not in USAGE_TEAM_BUCKETS:
+        raise HTTPException(400, f"bucket must be one of: {', '.join(USAGE_TEAM_BUCKETS)}")
+    
+    if team_id is not None:
+        check_team_usage_permission(user, team_id)
+        team_ids = [team_id]
+    elif user.get("public_metadata", {}).get("tokenManager:globalRole") == "ADMIN":
+        team_ids = None
+    else:
+        team_ids = sorted(get_user_teams(user))
+        if not team_ids:
+            return {"bucket": bucket, "teams": []}
+    
+    start, end = usage_time_window(date_from, date_to, default_days=30)
+    return await usage_stats_cache.get(
+        ("team_usage", tuple(team_ids) if team_ids is not None else None, bucket, date_from, date_to),
+        lambda: compute_team_usage(team_ids, bucket, start, end)
+    )
+
+
+async def compute_team_usage(team_ids: Optional[List[str]], bucket: str, start: datetime, end: datetime):
+    """get_team_usage 的查詢（團隊 × 時間桶、團隊 × 路由兩組彙總並行查詢）"""
+    conditions = "u.hour >= DATE_TRUNC('hour', $1::timestamp) AND u.hour < $2"
+    params = [start, end]
+    if team_ids is not None:
+        conditions += " AND u.team_id = ANY($3::text[])"
+        params.append(team_ids)
+    
+    series_rows, route_rows, teams = await db.gather_queries(
+        ("fetch", f"""
+            SELECT 
+                u.team_id,
+                DATE_TRUNC('{bucket}', u.hour) as bucket,
+                SUM(u.calls) as calls,
+                SUM(u.errors) as errors,
+                SUM(u.timed_calls) as timed_calls,
+                SUM(u.sum_ms) as sum_ms,
+                SUM(u.calls * COALESCE(r.cost_weight, 1)) as cost
+            FROM usage_rollup_team_hourly u
+            LEFT JOIN routes r ON r.path = u.route_path
+            WHERE {conditions}
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+        """, *params),
+        ("fetch", f"""
+            SELECT 
+                u.team_id,
+                u.route_path,
+                r.name as route_name,
+                COALESCE(r.cost_weight, 1) as cost_weight,
+                SUM(u.calls) as calls,
+                SUM(u.errors) as errors,
+                SUM(u.timed_calls) as timed_calls,
+                SUM(u.sum_ms) as sum_ms,
+                MAX(u.max_ms) as max_ms,
+                usage_sum_buckets(u.latency_buckets) as latency_buckets
+            FROM usage_rollup_team_hourly u
+            LEFT JOIN routes r ON r.path = u.route_path
+            WHERE {conditions}
+            GROUP BY u.team_id, u.route_path, r.name, r.cost_weight
+            ORDER BY u.team_id, calls DESC
+        """, *params),
+        ("fetch", "SELECT id, name FROM teams"),
+    )
+    team_names = {row['id']: row['name'] for row in teams}
+    
+    def average(row) -> Optional[float]:
+        return round(row['sum_ms'] / row['timed_calls'], 2) if row['timed_calls'] else None
+    
+    result: Dict[str, dict] = {}
+    histograms: Dict[str, List[int]] = {}
+    for row in route_rows:
+        team = result.get(row['team_id'])
+        if team is None:
+            team = result[row['team_id']] = {
+                "team_id": row['team_id'],
+                "team_name": team_names.get(row['team_id'], row['team_id'] or None),
+                "calls": 0, "errors": 0, "timed_calls": 0, "sum_ms": 0,
+                "max_response_time": None, "cost": 0.0,
+                "buckets": [], "routes": []
+            }
+            histograms[row['team_id']] = []
+        cost = row['calls'] * row['cost_weight']
+        team["calls"] += row['calls']
+        team["errors"] += row['errors']
+        team["timed_calls"] += row['timed_calls']
+        team["sum_ms"] += row['sum_ms']
+        team["cost"] += cost
+        if row['max_ms'] is not None and (team["max_response_time"] is None or row['max_ms'] > team["max_response_time"]):
+            team["max_response_time"] = row['max_ms']
+        for index, count in enumerate(row['latency_buckets'] or []):
+            if count:
+                add_to_histogram(histograms[row['team_id']], index, count)
+        team["routes"].append({
+            "route_path": row['route_path'] or None,
+            "route_name": row['route_name'],
+            "calls": row['calls'],
+            "errors": row['errors'],
+            "avg_response_time": average(row),
+            "cost_weight": row['cost_weight'],
+            "cost": round(cost, 4)
+        })
+    
+    for row in series_rows:
+        # 兩個查詢之間才寫入的團隊略過
+        if row['team_id'] not in result:
+            continue
+        result[row['team_id']]["buckets"].append({
+            "bucket": row['bucket'].isoformat(),
+            "calls": row['calls'],
+            "errors": row['errors'],
+            "avg_response_time": average(row),
+            "cost": round(row['cost'], 4)
+        })
+    
+    teams_usage = []
+    for team_id, team in result.items():
+        team["error_rate"] = round(team["errors"] / team["calls"], 4) if team["calls"] else 0
+        team["avg_response_time"] = average(team)
+        team.update(latency_percentiles(histograms[team_id], team["max_response_time"]))
+        team["cost"] = round(team["cost"], 4)
+        del team["timed_calls"], team["sum_ms"]
+        teams_usage.append(team)
+    teams_usage.sort(key=lambda team: team["cost"], reverse=True)
+    
+    return {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "bucket": bucket,
+        "teams": teams_usage
+    }
+
+
+# 時間序列的資料來源：(解析度, 對象) → (表, 時間欄位, 篩選條件)
+# minute 讀原始記錄；hour 讀每小時彙總；day 讀 usage_rollup_combined（含已降採樣的每日彙總）；團隊讀按團隊的彙總
+USAGE_SERIES_RAW_AGGREGATES = """
+    COUNT(*) as calls,
+    COUNT(*) FILTER (WHERE response_status >= 400) as errors,
+    COUNT(response_time_ms) as timed_calls,
+    COALESCE(SUM(response_time_ms), 0) as sum_ms
+"""
+USAGE_SERIES_ROLLUP_AGGREGATES = """
+    SUM(calls) as calls,
+    SUM(errors) as errors,
+    SUM(timed_calls) as timed_calls,
+    SUM(sum_ms) as sum_ms
+"""
+USAGE_SERIES_SOURCES = {
+    ("minute", "token"): ("usage_log_entries", "used_at", "token_hash = $1"),
+    ("minute", "route"): ("usage_log_entries", "used_at", "route_path = $1"),
+    ("minute", "team"): (
+        "usage_log_entries", "used_at", "token_hash = ANY(SELECT token_hash FROM tokens WHERE team_id = $1)"
+    ),
+    ("hour", "token"): ("usage_rollup_hourly", "hour", "token_hash = $1"),
+    ("hour", "route"): ("usage_rollup_hourly", "hour", "route_path = $1"),
+    ("hour", "team"): ("usage_rollup_team_hourly", "hour", "team_id = $1"),
+    ("day", "token"): ("usage_rollup_combined", "bucket", "token_hash = $1"),
+    ("day", "route"): ("usage_rollup_combined", "bucket", "route_path = $1"),
+    ("day", "team"): ("usage_rollup_team_hourly", "hour", "team_id = $1"),
+}
+
+
+@app.get("/api/usage/timeseries")
+async def get_usage_timeseries(
+    request: Request,
+    token_id: Optional[int] = None,
+    route_path: Optional[str] = None,
+    team_id: Optional[str] = None,
+    resolution: str = "hour",
+    metric: str = "calls",
+    max_points: int = SERIES_MAX_POINTS,
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to")
+):
+    """
+    Token / 路由 / 團隊（三擇一）的使用量時間序列（見 usage_series.py）
+    
+    - resolution：minute / hour / day，[from, to) 內每個時間桶一點（沒有調用的桶為 0），
+      未指定 from 時分別為最近 1 / 7 / 90 天；minute 最長 7 天
+    - 點數超過 max_points（最多 1000）時依 metric（calls / errors / avg_response_time）的形狀以 LTTB 降採樣
+    """
+    user = await verify_clerk_token(request)
+    
+    targets = [
+        (kind, value)
+        for kind, value in (("token", token_id), ("route", route_path), ("team", team_id))
+        if value is not None
+    ]
+    if len(targets) != 1:
+        raise HTTPException(400, "Exactly one of token_id, route_path or team_id is required")
+    if resolution not in SERIES_RESOLUTIONS:
+        raise HTTPException(400, f"resolution must be one of: {', '.join(SERIES_RESOLUTIONS)}")
+    if metric not in SERIES_METRICS:
+        raise HTTPException(400, f"metric must be one of: {', '.join(SERIES_METRICS)}")
+    max_points = max(3, min(max_points, SERIES_MAX_POINTS))
+    
+    kind, key = targets[0]
+    if kind == "token":
+        async with db.pool.acquire() as conn:
+            token = await conn.fetchrow("SELECT team_id, token_hash FROM tokens WHERE id = $1", token_id)
+        if not token:
+            raise HTTPException(404, "Token not found")
+        await check_team_token_permission(user, token['team_id'], "edit")
+        key = token['token_hash']
+    elif kind == "team":
+        check_team_usage_permission(user, team_id)
+    
+    start, end = usage_time_window(date_from, date_to, default_days=SERIES_DEFAULT_RANGE[resolution].days)
+    max_range = SERIES_MAX_RANGE[resolution]
+    if max_range is not None and end - start > max_range:
+        raise HTTPException(400, f"Range too long for '{resolution}' resolution (max {max_range.days} days)")
+    
+    return await usage_stats_cache.get(
+        ("usage_timeseries", kind, key, resolution, metric, max_points, date_from, date_to),
+        lambda: compute_usage_timeseries(kind, key, resolution, metric, max_points, start, end)
+    )
+
+
+async def compute_usage_timeseries(
+    kind: str, key: str, resolution: str, metric: str, max_points: int, start: datetime, end: datetime
+):
+    """get_usage_timeseries 的查詢"""
+    table, time_column, condition = USAGE_SERIES_SOURCES[(resolution, kind)]
+    aggregates = USAGE_SERIES_RAW_AGGREGATES if table == "usage_log_entries" else USAGE_SERIES_ROLLUP_AGGREGATES
+    async with db.pool.acquire() as conn:
+        rows = await conn.fetch(f"""
+            SELECT DATE_TRUNC('{resolution}', {time_column}) as bucket, {aggregates}
+            FROM {table}
+            WHERE {condition} AND {time_column} >= $2 AND {time_column} < $3
+            GROUP BY 1
+        """, key, truncate_to_resolution(start, resolution), end)
+    
+    points = fill_series(rows, start, end, resolution)
+    sampled = downsample_series(points, metric, max_points)
+    return {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "resolution": resolution,
+        "metric": metric,
+        "total_points": len(points),
+        "downsampled": len(sampled) < len(points),
+        "points": sampled
+    }
+
+
+@app.get("/api/usage/errors")
+async def get_usage_errors(
+    request: Request,
+    route_path: Optional[str] = None,
+    limit: int = 50,
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to")
+):
+    """
+    按錯誤指紋彙總的錯誤（讀 usage_error_hourly，指紋見 usage_ingest.error_fingerprint）
+    
+    - total_errors：區間內的錯誤總數
+    - errors：[from, to)（預設最近 7 天，以整點對齊）內次數最多的 limit 組 (指紋, 路由)，
+      含正規化後的樣板、範例訊息與最後的狀態碼
+    - first_seen 為該指紋在此路由第一次出現的時間（不限於查詢區間），is_new 表示第一次出現在區間內
+    """
+    user = await verify_clerk_token(request)
+    limit = max(1, min(limit, 500))
+    
+    start, end = usage_time_window(date_from, date_to)
+    return await usage_stats_cache.get(
+        ("usage_errors", route_path, limit, date_from, date_to),
+        lambda: compute_usage_errors(route_path, limit, start, end)
+    )
+
+
+async def compute_usage_errors(route_path: Optional[str], limit: int, start: datetime, end: datetime):
+    """get_usage_errors 的查詢"""
+    conditions = "e.hour >= DATE_TRUNC('hour', $1::timestamp) AND e.hour < $2"
+    params = [start, end, limit]
+    if route_path:
+        conditions += " AND e.route_path = $4"
+        params.append(route_path)
+    
+    async with db.pool.acquire() as conn:
+        rows = await conn.fetch(f"""
+            SELECT 
+                e.fingerprint,
+                e.route_path,
+                r.name as route_name,
+                SUM(e.count) as count,
+                MAX(e.last_seen) as last_seen,
+                (ARRAY_AGG(e.template ORDER BY e.hour DESC))[1] as template,
+                (ARRAY_AGG(e.sample_message ORDER BY e.hour DESC))[1] as sample_message,
+                (ARRAY_AGG(e.last_status ORDER BY e.last_seen DESC))[1] as last_status,
+                SUM(SUM(e.count)) OVER () as total_errors
+            FROM usage_error_hourly e
+            LEFT JOIN routes r ON r.path = e.route_path
+            WHERE {conditions}
+            GROUP BY e.fingerprint, e.route_path, r.name
+            ORDER BY count DESC
+            LIMIT $3
+        """, *params)
+        # 第一次出現的時間（不限區間，走主鍵索引）
+        first_seen_rows = await conn.fetch("""
+            SELECT fingerprint, route_path, MIN(first_seen) as first_seen
+            FROM usage_error_hourly
+            WHERE fingerprint = ANY($1::bpchar[])
+            GROUP BY fingerprint, route_path
+        """, list({row['fingerprint'] for row in rows}))
+    
+    first_seen = {(row['fingerprint'], row['route_path']): row['first_seen'] for row in first_seen_rows}
+    errors = []
+    for row in rows:
+        seen = first_seen.get((row['fingerprint'], row['route_path']))
+        errors.append({
+            "fingerprint": row['fingerprint'],
+            "template": row['template'],
+            "sample_message": row['sample_message'],
+            "route_path": row['route_path'] or None,
+            "route_name": row['route_name'],
+            "count": row['count'],
+            "last_status": row['last_status'],
+            "first_seen": seen.isoformat() if seen else None,
+            "last_seen": row['last_seen'].isoformat(),
+            "is_new": seen is not None and seen >= start
+        })
+    
+    return {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "total_errors": rows[0]['total_errors'] if rows else 0,
+        "errors": errors
+    }
+
+
+@app.get("/api/usage/export")
+async def export_usage(
+    request: Request,
+    format: str = "csv",
+    token_id: Optional[int] = None,
+    team_id: Optional[str] = None,
+    route_path: Optional[str] = None,
+    date_from: Optional[datetime] = Query(None, alias="from"),
+    date_to: Optional[datetime] = Query(None, alias="to"),
+    fields: Optional[str] = None
+):
+    """
+    串流匯出使用記錄（CSV / NDJSON / Parquet，見 usage_export.py）
+    
+    可依 Token、團隊、路由與時間區間 [from, to) 篩選，fields 可指定匯出的欄位（逗號分隔）。
+    指定 Token 或團隊時需要該團隊的 ADMIN / MANAGER 權限，不指定時只有全局 ADMIN 可以匯出全部記錄
+    """
+    user = await verify_clerk_token(request)
+    
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(400, f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    if format == "parquet" and not PARQUET_AVAILABLE:
+        raise HTTPException(406, "Parquet export is not supported on this server")
+    
+    if fields:
+        export_fields = list(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+        unknown = [field for field in export_fields if field not in EXPORT_FIELDS]
+        if unknown:
+            raise HTTPException(400, f"Unknown fields: {', '.join(unknown)}")
+    else:
+        export_fields = list(EXPORT_FIELDS)
+    
+    start, end = to_naive_utc(date_from), to_naive_utc(date_to)
+    if start and end and start >= end:
+        raise HTTPException(400, "'from' must be earlier than 'to'")
+    
+    token_hashes = None
+    async with db.pool.acquire() as conn:
+        if token_id is not None:
+            token = await conn.fetchrow("SELECT token_hash, team_id FROM tokens WHERE id = $1", token_id)
+            if not token:
+                raise HTTPException(404, "Token not found")
+            await check_team_token_permission(user, token['team_id'], "edit")
+            if team_id and token['team_id'] != team_id:
+                raise HTTPException(400, "Token does not belong to the given team")
+            token_hashes = [token['token_hash']]
+        elif team_id:
+            await check_team_token_permission(user, team_id, "edit")
+            rows = await conn.fetch("SELECT token_hash FROM tokens WHERE team_id = $1", team_id)
+            token_hashes = [row['token_hash'] for row in rows]
+        elif user.get("public_metadata", {}).get("tokenManager:globalRole") != "ADMIN":
+            raise HTTPException(403, "Exporting all usage requires global ADMIN; filter by token_id or team_id")
+    
+    # 每個匯出在整個串流期間佔用一個連接，名額在這裡就佔用（之後才開始串流）
+    slot = usage_exporter.try_acquire()
+    if slot is None:
+        raise HTTPException(
+            429,
+            "Too many exports in progress, retry later",
+            headers={"Retry-After": "30"}
+        )
+    
+    try:
+        sql, params = usage_exporter.build_query(export_fields, token_hashes, route_path, start, end)
+        media_type, extension = EXPORT_FORMATS[format]
+        filename = f"usage-export-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.{extension}"
+        return StreamingResponse(
+            usage_exporter.stream(slot, format, export_fields, sql, params),
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+            # 串流沒有開始（例如客戶端先斷線）時 generator 的 finally 不會執行，回應結束後再釋放一次
+            background=BackgroundTask(slot.release)
+        )
+    except Exception:
+        slot.release()
+        raise
+
+
 @app.get("/api/usage/test-data")
 async def get_test_usage_data():
     """
@@ -1474,7 +2613,7 @@ async def get_test_usage_data():
         logs = await conn.fetch("""
             SELECT token_hash, route_path, request_method, response_status, 
                    response_time_ms, ip_address, used_at
-            FROM token_usage_logs
+            FROM usage_log_entries
             ORDER BY used_at DESC
             LIMIT 10
         """)
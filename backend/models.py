@@ -55,6 +55,7 @@ class RouteCreate(BaseModel):
     backend_auth_type: Optional[str] = Field(default="none", description="後端認證類型: none, bearer, api-key, basic")
     backend_auth_config: Optional[dict] = Field(default=None, description="後端認證配置（包含環境變數名稱）")
     backend_auth_secrets: Optional[dict] = Field(default=None, description="實際的密鑰（不會儲存到資料庫）")
+    cost_weight: Optional[float] = Field(default=1.0, ge=0, description="成本權重（團隊用量分攤：成本 = 調用數 × 權重）")
 
 
 class RouteUpdate(BaseModel):
@@ -66,6 +67,7 @@ class RouteUpdate(BaseModel):
     backend_auth_type: Optional[str] = Field(None, description="後端認證類型")
     backend_auth_config: Optional[dict] = Field(None, description="後端認證配置")
     backend_auth_secrets: Optional[dict] = Field(None, description="實際的密鑰（不會儲存到資料庫）")
+    cost_weight: Optional[float] = Field(None, ge=0, description="成本權重")
 
 
 class RouteResponse(BaseModel):
@@ -78,6 +80,7 @@ class RouteResponse(BaseModel):
     tags: List[str]
     backend_auth_type: Optional[str]
     backend_auth_config: Optional[dict]
+    cost_weight: float = 1.0
     created_at: datetime
 
 
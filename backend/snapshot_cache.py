@@ -0,0 +1,128 @@
+"""
+統計 API 的快照快取
+
+同一組參數的統計結果對所有使用者都相同，快照在 TTL 內直接返回；
+過期後仍在 stale 期限內時立即返回舊快照，並在背景刷新一次（stale-while-revalidate）。
+沒有可用快照時，同一個 key 的並發請求只會觸發一次計算（single-flight）。
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+
+class _Snapshot:
+    __slots__ = ("value", "computed_at")
+
+    def __init__(self, value: Any, computed_at: float):
+        self.value = value
+        self.computed_at = computed_at
+
+
+class SnapshotCache:
+    """
+    以 (endpoint, 參數) 為 key 的快照快取
+
+    - 快照未超過 ttl 秒：直接返回
+    - 超過 ttl 但未超過 stale_ttl 秒：返回舊快照，背景刷新（同一 key 同時只有一個刷新）
+    - 沒有快照或超過 stale_ttl：等待計算，並發請求共用同一次計算
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, max_entries: int = 1000):
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.max_entries = max_entries
+        self.counters = {"hits": 0, "stale_hits": 0, "misses": 0, "refresh_errors": 0}
+        self._snapshots: "OrderedDict[Hashable, _Snapshot]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        # invalidate() 時遞增；清除前開始的計算結果不寫入快照
+        self._generation = 0
+
+    async def get(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        """取得 key 的快照，必要時以 compute() 計算"""
+        if self.ttl <= 0:
+            return await compute()
+
+        snapshot = self._snapshots.get(key)
+        now = time.monotonic()
+        if snapshot is not None:
+            age = now - snapshot.computed_at
+            if age < self.ttl:
+                self.counters["hits"] += 1
+                self._snapshots.move_to_end(key)
+                return snapshot.value
+            if age < self.stale_ttl:
+                self.counters["stale_hits"] += 1
+                self._snapshots.move_to_end(key)
+                self._refresh(key, compute, background=True)
+                return snapshot.value
+
+        self.counters["misses"] += 1
+        # shield：單一請求被取消時不影響其他等待同一次計算的請求
+        return await asyncio.shield(self._refresh(key, compute))
+
+    def _refresh(self, key: Hashable, compute: Callable[[], Awaitable[Any]], background: bool = False) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._compute(key, compute))
+            self._inflight[key] = task
+            if background:
+                task.add_done_callback(lambda done: self._refresh_done(key, done))
+        return task
+
+    def _refresh_done(self, key: Hashable, task: asyncio.Task):
+        # 背景刷新失敗時保留舊快照，下次請求再試
+        if not task.cancelled() and task.exception() is not None:
+            self.counters["refresh_errors"] += 1
+            print(f"Warning: Failed to refresh snapshot {key}: {task.exception()}")
+
+    async def _compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]):
+        generation = self._generation
+        try:
+            value = await compute()
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                self._inflight.pop(key, None)
+
+        if generation != self._generation:
+            return value
+        self._snapshots[key] = _Snapshot(value, time.monotonic())
+        self._snapshots.move_to_end(key)
+        while len(self._snapshots) > self.max_entries:
+            self._snapshots.popitem(last=False)
+        return value
+
+    def invalidate(self, endpoint: Optional[str] = None):
+        """
+        清除快照（指定 endpoint 時只清除 key 以該 endpoint 開頭的快照）
+
+        Token / 路由 / 團隊變更後呼叫；進行中的計算可能讀到變更前的資料，結果不寫入快照，
+        之後的請求重新計算
+        """
+        self._generation += 1
+        if endpoint is None:
+            self._inflight.clear()
+            self._snapshots.clear()
+            return
+        for key in [key for key in self._inflight if isinstance(key, tuple) and key and key[0] == endpoint]:
+            del self._inflight[key]
+        for key in [key for key in self._snapshots if isinstance(key, tuple) and key and key[0] == endpoint]:
+            del self._snapshots[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._snapshots),
+            "refreshing": len(self._inflight),
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            **self.counters
+        }
+
+
+# 使用統計 API 共用的快照快取
+usage_stats_cache = SnapshotCache(
+    ttl=float(os.getenv("USAGE_STATS_CACHE_TTL_SECONDS", "15")),
+    stale_ttl=float(os.getenv("USAGE_STATS_CACHE_STALE_SECONDS", "300")),
+    max_entries=int(os.getenv("USAGE_STATS_CACHE_MAX_ENTRIES", "1000"))
+)
@@ -7,6 +7,7 @@ from pydantic import BaseModel
 from datetime import datetime
 from clerk_auth import verify_clerk_token, get_highest_role, get_user_role_in_team, NAMESPACE
 from database import db
+from snapshot_cache import usage_stats_cache
 
 router = APIRouter(prefix="/api/teams", tags=["teams"])
 
@@ -159,6 +160,9 @@ async def create_team(
         print(f"⚠️ Failed to add creator as ADMIN: {e}")
         # 不拋錯，團隊已創建
     
+    # 統計快照含團隊名稱，變更後清除
+    usage_stats_cache.invalidate()
+    
     # 獲取創建的團隊
     async with db.pool.acquire() as conn:
         row = await conn.fetchrow("""
@@ -268,6 +272,8 @@ async def update_team(
     async with db.pool.acquire() as conn:
         query = f"UPDATE teams SET {', '.join(updates)} WHERE id = ${param_count}"
         await conn.execute(query, *params)
+        # 統計快照含團隊名稱，變更後清除
+        usage_stats_cache.invalidate()
         
         row = await conn.fetchrow("""
             SELECT id, name, description, color, icon, created_at, created_by
@@ -339,6 +345,8 @@ async def delete_team(
         if result == "DELETE 0":
             raise HTTPException(status_code=404, detail="Team not found")
     
+    # 統計快照含團隊名稱，變更後清除
+    usage_stats_cache.invalidate()
     print(f"✅ Deleted team: {team_id}")
     
     return {"success": True, "team_id": team_id}
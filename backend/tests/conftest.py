@@ -0,0 +1,9 @@
+"""
+後端單元測試
+
+後端模組以頂層模組互相 import（from database import db），測試時把 backend/ 加入 sys.path
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
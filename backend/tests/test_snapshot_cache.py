@@ -0,0 +1,191 @@
+"""統計 API 的快照快取（TTL、stale-while-revalidate、single-flight）"""
+import asyncio
+import types
+
+import pytest
+
+import snapshot_cache
+from snapshot_cache import SnapshotCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # 只替換 snapshot_cache 看到的時鐘，事件迴圈仍用真實的 time.monotonic
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(snapshot_cache, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+class _Compute:
+    """計算次數與結果；gate 設定時等到 gate.set() 才返回"""
+
+    def __init__(self, gate: asyncio.Event = None):
+        self.calls = 0
+        self.gate = gate
+        self.error = None
+
+    async def __call__(self):
+        self.calls += 1
+        call = self.calls
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        return call
+
+
+async def _settle(cache):
+    """等背景刷新結束（含完成回呼）"""
+    while cache.stats()["refreshing"]:
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+def test_hit_within_ttl(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=10, stale_ttl=60)
+        compute = _Compute()
+        assert await cache.get(("stats",), compute) == 1
+        clock.now += 9
+        assert await cache.get(("stats",), compute) == 1
+        assert compute.calls == 1
+        assert cache.counters["hits"] == 1 and cache.counters["misses"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_stale_served_with_single_background_refresh(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=10, stale_ttl=60)
+        compute = _Compute()
+        await cache.get(("stats",), compute)
+
+        clock.now += 30
+        compute.gate = asyncio.Event()
+        results = await asyncio.gather(*(cache.get(("stats",), compute) for _ in range(5)))
+        assert results == [1] * 5
+        await asyncio.sleep(0)
+        assert compute.calls == 2
+        assert cache.counters["stale_hits"] == 5
+
+        compute.gate.set()
+        await _settle(cache)
+        assert await cache.get(("stats",), compute) == 2
+        assert compute.calls == 2
+
+        # 背景刷新失敗時保留舊快照
+        clock.now += 30
+        compute.error = RuntimeError("db down")
+        assert await cache.get(("stats",), compute) == 2
+        await _settle(cache)
+        assert cache.counters["refresh_errors"] == 1
+        assert await cache.get(("stats",), compute) == 2
+
+    asyncio.run(scenario())
+
+
+def test_expired_beyond_stale_ttl_recomputes(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=10, stale_ttl=60)
+        compute = _Compute()
+        await cache.get(("stats",), compute)
+        clock.now += 61
+        assert await cache.get(("stats",), compute) == 2
+        assert cache.counters["misses"] == 2
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_misses_share_one_computation(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=10, stale_ttl=60)
+        compute = _Compute(asyncio.Event())
+        waiters = [asyncio.create_task(cache.get(("stats",), compute)) for _ in range(5)]
+        await asyncio.sleep(0)
+        compute.gate.set()
+        assert await asyncio.gather(*waiters) == [1] * 5
+        assert compute.calls == 1
+        assert cache.stats()["refreshing"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_computation(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=10, stale_ttl=60)
+        compute = _Compute(asyncio.Event())
+        first = asyncio.create_task(cache.get(("stats",), compute))
+        second = asyncio.create_task(cache.get(("stats",), compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        compute.gate.set()
+        assert await second == 1
+        assert compute.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_invalidate(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=10, stale_ttl=60)
+        stats, routes = _Compute(), _Compute()
+        await cache.get(("stats", 7), stats)
+        await cache.get(("routes",), routes)
+
+        cache.invalidate("stats")
+        assert await cache.get(("stats", 7), stats) == 2
+        assert await cache.get(("routes",), routes) == 1
+
+        cache.invalidate()
+        assert await cache.get(("routes",), routes) == 2
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_discards_inflight_result(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=10, stale_ttl=60)
+        compute = _Compute(asyncio.Event())
+        waiter = asyncio.create_task(cache.get(("stats",), compute))
+        while not compute.calls:
+            await asyncio.sleep(0)
+
+        cache.invalidate()
+        compute.gate.set()
+        # 清除前開始的計算照常返回給等待者，但不寫入快照
+        assert await waiter == 1
+        assert await cache.get(("stats",), compute) == 2
+        assert compute.calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_max_entries_evicts_least_recently_used(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=10, stale_ttl=60, max_entries=2)
+        computes = {key: _Compute() for key in "abc"}
+        await cache.get(("a",), computes["a"])
+        await cache.get(("b",), computes["b"])
+        await cache.get(("a",), computes["a"])
+        await cache.get(("c",), computes["c"])
+        assert cache.stats()["entries"] == 2
+
+        await cache.get(("a",), computes["a"])
+        await cache.get(("b",), computes["b"])
+        assert computes["a"].calls == 1
+        assert computes["b"].calls == 2
+        assert computes["c"].calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_disabled_when_ttl_is_zero(clock):
+    async def scenario():
+        cache = SnapshotCache(ttl=0, stale_ttl=0)
+        compute = _Compute()
+        await cache.get(("stats",), compute)
+        await cache.get(("stats",), compute)
+        assert compute.calls == 2
+        assert cache.stats()["entries"] == 0
+
+    asyncio.run(scenario())
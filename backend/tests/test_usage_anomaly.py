@@ -0,0 +1,212 @@
+"""Token 使用異常偵測（EWMA 基準線、異常判斷與 checkpoint）"""
+import asyncio
+
+import pytest
+
+import usage_anomaly
+from usage_anomaly import UsageAnomalyDetector
+
+TOKEN = "a" * 64
+START = 29000000
+
+
+class _Clock:
+    def __init__(self, minute: int):
+        self.minute = minute
+
+    def time(self) -> float:
+        return self.minute * 60 + 1
+
+
+class _Transaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class _FakeConn:
+    """記錄 checkpoint 的寫入；during_write 在寫入（await）期間執行，模擬同時送達的事件"""
+
+    def __init__(self, during_write=None):
+        self.during_write = during_write
+        self.baselines = []
+        self.anomalies = []
+        self.deleted = []
+
+    def transaction(self):
+        return _Transaction()
+
+    async def _yield(self):
+        if self.during_write is not None:
+            during_write, self.during_write = self.during_write, None
+            during_write()
+        await asyncio.sleep(0)
+
+    async def execute(self, sql, *args):
+        await self._yield()
+        if "DELETE" in sql:
+            self.deleted.extend(args[0])
+        else:
+            self.baselines.extend(zip(*args[:5]))
+
+    async def executemany(self, sql, rows):
+        await self._yield()
+        self.anomalies.extend(rows)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock(START)
+    monkeypatch.setattr(usage_anomaly.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def detector(clock):
+    detector = UsageAnomalyDetector()
+    detector.enabled = True
+    detector.alpha = 0.5
+    detector.warmup_minutes = 5
+    detector.z_threshold = 4
+    detector.min_calls = 20
+    detector.drop_ratio = 0.2
+    detector.drop_min_rate = 5
+    detector.error_rate_delta = 0.2
+    return detector
+
+
+def _warm_up(detector, clock, calls=10, minutes=10):
+    for _ in range(minutes):
+        detector.add(TOKEN, calls)
+        clock.minute += 1
+        detector.tick()
+
+
+def test_ewma_update_counts_empty_minutes(detector, clock):
+    detector.add(TOKEN, 10, errors=2)
+    clock.minute += 1
+    detector.tick()
+    baseline = detector._baselines[TOKEN]
+    assert baseline.observations == 1
+    assert baseline.rate_mean == pytest.approx(5)
+    assert baseline.rate_var == pytest.approx(25)
+    assert baseline.error_rate_mean == pytest.approx(0.1)
+
+    # 沒有調用的分鐘也是一次觀測（調用數 0，錯誤率不變）
+    clock.minute += 2
+    detector.tick()
+    assert baseline.observations == 3
+    assert baseline.rate_mean == pytest.approx(1.25)
+    assert baseline.error_rate_mean == pytest.approx(0.1)
+
+
+def test_no_anomaly_during_warmup(detector, clock):
+    _warm_up(detector, clock, minutes=3)
+    detector.add(TOKEN, 1000)
+    clock.minute += 1
+    detector.tick()
+    assert detector.active() == []
+
+
+def test_spike_detected_and_resolved(detector, clock):
+    _warm_up(detector, clock)
+    detector.add(TOKEN, 100)
+    clock.minute += 1
+    detector.tick()
+
+    [anomaly] = detector.active()
+    assert anomaly["kind"] == "spike"
+    assert anomaly["observed"] == 100
+    assert anomaly["expected"] == pytest.approx(10, abs=0.1)
+    assert anomaly["resolved_at"] is None
+    started_at = anomaly["started_at"]
+
+    # 持續期間只有一筆記錄
+    detector.add(TOKEN, 100)
+    clock.minute += 1
+    detector.tick()
+    [anomaly] = detector.active()
+    assert anomaly["started_at"] == started_at
+    assert anomaly["last_seen_at"] > started_at
+
+    detector.add(TOKEN, 10)
+    clock.minute += 1
+    detector.tick()
+    assert detector.active() == []
+    [resolved] = detector._pending.values()
+    assert resolved["resolved_at"] is not None
+
+
+def test_drop_and_error_spike(detector, clock):
+    _warm_up(detector, clock, calls=30)
+    clock.minute += 1
+    detector.tick()
+    assert [anomaly["kind"] for anomaly in detector.active()] == ["drop"]
+
+    detector.add(TOKEN, 30, errors=15)
+    clock.minute += 1
+    detector.tick()
+    assert [anomaly["kind"] for anomaly in detector.active()] == ["error_spike"]
+
+
+def test_checkpoint_writes_and_clears_changes(detector, clock):
+    _warm_up(detector, clock)
+    detector.add(TOKEN, 100)
+    clock.minute += 1
+    detector.tick()
+
+    conn = _FakeConn()
+    asyncio.run(detector.checkpoint(conn))
+    baseline = detector._baselines[TOKEN]
+    assert conn.baselines == [(TOKEN, baseline.rate_mean, baseline.rate_var,
+                               baseline.error_rate_mean, baseline.observations)]
+    assert [row[2] for row in conn.anomalies] == ["spike"]
+    assert not baseline.dirty
+    assert detector._pending == {}
+
+    # 沒有變動時不寫入
+    conn = _FakeConn()
+    asyncio.run(detector.checkpoint(conn))
+    assert conn.baselines == [] and conn.anomalies == []
+
+
+def test_checkpoint_keeps_changes_made_during_write(detector, clock):
+    _warm_up(detector, clock)
+    detector.add(TOKEN, 100)
+    clock.minute += 1
+    detector.tick()
+    written_observations = detector._baselines[TOKEN].observations
+
+    def next_minute():
+        detector.add(TOKEN, 100)
+        clock.minute += 1
+        detector.tick()
+
+    conn = _FakeConn(during_write=next_minute)
+    asyncio.run(detector.checkpoint(conn))
+    # 寫入的是 await 之前的值，之後的更新留到下次
+    assert conn.baselines[0][4] == written_observations
+    assert detector._baselines[TOKEN].dirty
+    [anomaly] = detector._pending.values()
+    assert anomaly["last_seen_at"] > conn.anomalies[0][4]
+
+    conn = _FakeConn()
+    asyncio.run(detector.checkpoint(conn))
+    assert conn.baselines[0][4] == written_observations + 1
+    assert conn.anomalies[0][4] == anomaly["last_seen_at"]
+    assert not detector._baselines[TOKEN].dirty
+    assert detector._pending == {}
+
+
+def test_idle_token_evicted_and_deleted(detector, clock):
+    detector.add(TOKEN, 1)
+    clock.minute += 30
+    detector.tick()
+    assert TOKEN not in detector._baselines
+
+    conn = _FakeConn()
+    asyncio.run(detector.checkpoint(conn))
+    assert conn.deleted == [TOKEN]
+    assert detector._evicted == set()
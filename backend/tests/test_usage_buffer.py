@@ -0,0 +1,72 @@
+"""UsageBuffer 寫入失敗時的拆批隔離"""
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+
+import usage_ingest
+from usage_ingest import UsageBuffer, UsageWriteInterrupted
+from usage_journal import QUARANTINE_FILE, usage_journal
+
+
+class _FakePool:
+    @asynccontextmanager
+    async def acquire(self):
+        yield None
+
+
+def _record(index: int):
+    return ("hash", "/r", datetime(2024, 1, 1), 200, index, None, None, "GET", None, None)
+
+
+@pytest.fixture
+def buffer(monkeypatch, tmp_path):
+    monkeypatch.setattr(usage_ingest.db, "pool", _FakePool())
+    monkeypatch.setattr(usage_journal, "directory", str(tmp_path))
+    return UsageBuffer()
+
+
+def test_write_batch_quarantines_only_bad_record(buffer, monkeypatch):
+    written = []
+
+    async def write(conn, records):
+        if any(record[4] == 7 for record in records):
+            raise ValueError("bad record")
+        written.extend(records)
+        return 0
+
+    monkeypatch.setattr(usage_ingest, "write_usage_records", write)
+    records = [_record(index) for index in range(20)]
+    assert asyncio.run(buffer._write_batch(records)) == 19
+    assert [record[4] for record in written] == [index for index in range(20) if index != 7]
+
+    quarantined = list(usage_journal.read_frames(QUARANTINE_FILE))
+    assert [record[4] for _, frame in quarantined for record in frame] == [7]
+
+
+def test_write_batch_reports_unwritten_records_when_interrupted(buffer, monkeypatch):
+    calls = []
+
+    async def write(conn, records):
+        calls.append(len(records))
+        if len(calls) == 1:
+            raise ValueError("bad record")
+        if len(calls) == 3:
+            raise ConnectionError("database went away")
+        return 0
+
+    monkeypatch.setattr(usage_ingest, "write_usage_records", write)
+    records = [_record(index) for index in range(8)]
+    with pytest.raises(UsageWriteInterrupted) as info:
+        asyncio.run(buffer._write_batch(records))
+    assert info.value.remaining == records[4:]
+
+
+def test_write_batch_reraises_connection_errors_untouched(buffer, monkeypatch):
+    async def write(conn, records):
+        raise ConnectionError("database went away")
+
+    monkeypatch.setattr(usage_ingest, "write_usage_records", write)
+    with pytest.raises(ConnectionError):
+        asyncio.run(buffer._write_batch([_record(0)]))
@@ -0,0 +1,75 @@
+"""使用記錄匯出的並發名額"""
+import asyncio
+from contextlib import asynccontextmanager
+
+import usage_export
+from usage_export import UsageExporter
+
+
+class _FakeCursor:
+    def __init__(self, rows):
+        self._rows = rows
+
+    async def fetch(self, count):
+        rows, self._rows = self._rows[:count], self._rows[count:]
+        return rows
+
+
+class _FakeConn:
+    @asynccontextmanager
+    async def transaction(self, **kwargs):
+        yield
+
+    async def cursor(self, sql, *params):
+        return _FakeCursor([{"id": 1}, {"id": 2}])
+
+
+class _FakePool:
+    @asynccontextmanager
+    async def acquire(self):
+        yield _FakeConn()
+
+
+def _exporter(limit=2):
+    exporter = UsageExporter()
+    exporter.max_concurrent = limit
+    return exporter
+
+
+def test_try_acquire_reserves_until_limit():
+    exporter = _exporter(2)
+    first, second = exporter.try_acquire(), exporter.try_acquire()
+    assert first is not None and second is not None
+    assert exporter.try_acquire() is None
+
+    # 重複釋放只算一次
+    first.release()
+    first.release()
+    assert exporter._active == 1
+    assert exporter.try_acquire() is not None
+    assert exporter.try_acquire() is None
+
+
+def test_stream_releases_slot_when_finished(monkeypatch):
+    monkeypatch.setattr(usage_export.db, "pool", _FakePool())
+    exporter = _exporter(1)
+    slot = exporter.try_acquire()
+
+    async def consume():
+        return [chunk async for chunk in exporter.stream(slot, "ndjson", ["id"], "SELECT 1", [])]
+
+    chunks = asyncio.run(consume())
+    assert b"".join(chunks).count(b"\n") == 2
+    assert exporter._active == 0
+    # 回應結束後的 BackgroundTask 再釋放一次也不會多釋放
+    slot.release()
+    assert exporter._active == 0
+
+
+def test_stream_never_iterated_is_released_by_caller():
+    exporter = _exporter(1)
+    slot = exporter.try_acquire()
+    exporter.stream(slot, "csv", ["id"], "SELECT 1", [])
+    assert exporter.try_acquire() is None
+    slot.release()
+    assert exporter.try_acquire() is not None
@@ -0,0 +1,54 @@
+"""Space-Saving top-k 摘要"""
+import random
+from collections import Counter
+
+from usage_heavy_hitters import SpaceSaving
+
+
+def test_exact_while_under_capacity():
+    summary = SpaceSaving(10)
+    for key in "aabbbc":
+        summary.add(key)
+    summary.add("c", 4)
+    assert summary.counts == {"a": 2, "b": 3, "c": 5}
+    assert summary.errors == {"a": 0, "b": 0, "c": 0}
+
+
+def test_evicts_minimum_and_inherits_its_count():
+    summary = SpaceSaving(2)
+    summary.add("a", 5)
+    summary.add("b", 2)
+    summary.add("a", 1)
+    summary.add("c")
+    assert summary.counts == {"a": 6, "c": 3}
+    assert summary.errors == {"a": 0, "c": 2}
+
+
+def test_evicts_by_current_count_after_increments():
+    summary = SpaceSaving(3)
+    for key in "abc":
+        summary.add(key)
+    # a 的堆中計數已過時（1），實際最小的是 b
+    summary.add("a", 10)
+    summary.add("c", 5)
+    summary.add("d")
+    assert set(summary.counts) == {"a", "c", "d"}
+    assert summary.counts["d"] == 2
+
+
+def test_guarantees_on_skewed_stream():
+    rng = random.Random(7)
+    stream = [f"k{min(int(rng.paretovariate(1.1)), 500)}" for _ in range(20000)]
+    truth = Counter(stream)
+    summary = SpaceSaving(50)
+    for key in stream:
+        summary.add(key, 1)
+
+    assert len(summary.counts) == 50
+    assert sum(summary.counts.values()) == len(stream)
+    for key, count in summary.counts.items():
+        assert count - summary.errors[key] <= truth[key] <= count
+    # 真實次數超過 N / capacity 的 key 一定在摘要中
+    for key, count in truth.items():
+        if count > len(stream) / 50:
+            assert key in summary.counts
@@ -0,0 +1,171 @@
+"""使用事件與預彙總計數的解析、錯誤指紋"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from usage_ingest import (
+    ERROR_TEMPLATE_MAX_LENGTH, EVENT_MAX_AGE_DAYS, EVENT_MAX_FUTURE_DAYS, RESPONSE_TIME_MAX_MS,
+    USAGE_EVENT_FIELDS, error_fingerprint, parse_usage_counters, parse_usage_event
+)
+
+
+def _millis(value: datetime) -> int:
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def test_parse_usage_event_fields():
+    used_at = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+    record = parse_usage_event({
+        "token_hash": "abc",
+        "route": "/api/test",
+        "timestamp": _millis(used_at),
+        "response_status": "404",
+        "response_time_ms": 12,
+        "ip_address": " 10.0.0.1 ",
+        "user_agent": "curl/8",
+        "request_method": "get",
+        "error_message": "HTTP 404",
+        "event_id": "batch-1",
+    })
+    fields = dict(zip(USAGE_EVENT_FIELDS, record))
+    assert fields["token_hash"] == "abc"
+    assert fields["used_at"] == used_at
+    assert fields["response_status"] == 404
+    assert fields["ip_address"] == "10.0.0.1"
+    assert fields["request_method"] == "get"
+    # 非 UUID 的 event_id 以 uuid5 轉換，相同字串得到相同 id
+    assert fields["event_id"] == parse_usage_event({"token_hash": "abc", "event_id": "batch-1"})[9]
+
+
+def test_parse_usage_event_requires_token_hash():
+    with pytest.raises(ValueError):
+        parse_usage_event({"route": "/"})
+    with pytest.raises(ValueError):
+        parse_usage_event(["not", "an", "object"])
+
+
+@pytest.mark.parametrize("timestamp", [1e20, -1e20, "1e400", float("nan")])
+def test_parse_usage_event_rejects_out_of_range_timestamp(timestamp):
+    with pytest.raises(ValueError):
+        parse_usage_event({"token_hash": "abc", "timestamp": timestamp})
+
+
+def test_parse_usage_event_bounds_event_time():
+    now = datetime.utcnow()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    last_allowed = today + timedelta(days=EVENT_MAX_FUTURE_DAYS) - timedelta(seconds=1)
+    assert parse_usage_event({"token_hash": "abc", "timestamp": _millis(last_allowed)})[2] == last_allowed
+
+    # 超出已預先建立分區的未來時間（例如時鐘偏差、2100 年）會落入預設分區，直接拒絕
+    for used_at in (today + timedelta(days=EVENT_MAX_FUTURE_DAYS), datetime(2100, 1, 1)):
+        with pytest.raises(ValueError, match="future"):
+            parse_usage_event({"token_hash": "abc", "timestamp": _millis(used_at)})
+
+    with pytest.raises(ValueError, match="older"):
+        parse_usage_event({"token_hash": "abc", "timestamp": _millis(now - timedelta(days=EVENT_MAX_AGE_DAYS + 1))})
+
+
+@pytest.mark.parametrize("value, expected", [
+    (RESPONSE_TIME_MAX_MS, RESPONSE_TIME_MAX_MS),
+    (RESPONSE_TIME_MAX_MS + 1, None),
+    (-5, None),
+    (float("inf"), None),
+    ("", None),
+])
+def test_parse_usage_event_bounds_response_time(value, expected):
+    assert parse_usage_event({"token_hash": "abc", "response_time_ms": value})[4] == expected
+
+
+def test_parse_usage_event_bounds_status_and_strips_nul():
+    record = parse_usage_event({
+        "token_hash": "a\x00b",
+        "response_status": 70000,
+        "user_agent": "x\x00" * 400,
+        "error_message": "boom\x00",
+    })
+    assert record[0] == "ab"
+    assert record[3] is None
+    assert record[6] == "x" * 400
+    assert record[8] == "boom"
+
+
+def test_parse_usage_event_drops_invalid_ip():
+    assert parse_usage_event({"token_hash": "abc", "ip_address": "not-an-ip"})[5] is None
+
+
+def _counter(**overrides):
+    counter = {
+        "token_hash": "abc",
+        "route": "/api/test",
+        "status_class": "2xx",
+        "minute": 1700000040000,
+        "count": 3,
+        "latency_count": 3,
+        "latency_sum_ms": 30,
+        "latency_max_ms": 15,
+        "latency_histogram": {"10": 3},
+    }
+    counter.update(overrides)
+    return counter
+
+
+def test_parse_usage_counters_merges_minutes_into_hour():
+    rows, activity = parse_usage_counters({"counters": [
+        _counter(),
+        _counter(minute="2023-11-14T22:59:00Z", status_class="5xx", count=2, latency_count=None,
+                 latency_sum_ms=None, latency_max_ms=None, latency_histogram=None),
+        _counter(token_hash="other", count=0),
+    ]})
+    assert len(rows) == 1
+    hour, token_hash, route_path, calls, errors, timed, sum_ms, max_ms, first_at, last_at, histogram = rows[0]
+    assert (hour, token_hash, route_path) == (datetime(2023, 11, 14, 22), "abc", "/api/test")
+    assert (calls, errors, timed, sum_ms, max_ms) == (5, 2, 3, 30, 15)
+    assert (first_at, last_at) == (datetime(2023, 11, 14, 22, 14), datetime(2023, 11, 14, 22, 59))
+    assert histogram[10] == 3
+    assert activity == {"abc": [datetime(2023, 11, 14, 22, 59), 5]}
+
+
+@pytest.mark.parametrize("counter", [
+    _counter(token_hash=None),
+    _counter(status_class="7xx"),
+    _counter(minute=1e20),
+    _counter(minute=None),
+    _counter(latency_histogram={"99": 1}),
+])
+def test_parse_usage_counters_rejects_invalid_counter(counter):
+    with pytest.raises(ValueError, match=r"counters\[0\]"):
+        parse_usage_counters({"counters": [counter]})
+
+
+def test_parse_usage_counters_requires_array():
+    with pytest.raises(ValueError):
+        parse_usage_counters({"counters": {}})
+
+
+@pytest.mark.parametrize("first, second", [
+    ("User 12345 not found", "User 67890 not found"),
+    ("GET https://a.example/x?id=1 failed", "GET http://b.example/y failed"),
+    ("token 3f2a9c1e-8b7d-4e6f-a5c4-1b2d3e4f5a6b expired", "token 00000000-0000-4000-8000-000000000000 expired"),
+    ("connect 10.0.0.1:5432 refused", "connect 192.168.1.20:6543 refused"),
+    ("key 'alpha' missing", "key \"beta\" missing"),
+    ("trace deadbeef01 at  line 3", "trace 0xcafe1234ab at line 99"),
+])
+def test_error_fingerprint_groups_variable_parts(first, second):
+    assert error_fingerprint(first, 500) == error_fingerprint(second, 500)
+
+
+def test_error_fingerprint_keeps_http_status():
+    assert error_fingerprint("HTTP 404", 404) == error_fingerprint(None, 404)
+    assert error_fingerprint("HTTP 404", 404)[0] != error_fingerprint("HTTP 502", 502)[0]
+    assert error_fingerprint("HTTP 502: upstream took 31s", 502)[1] == "HTTP 502: upstream took <n>s"
+
+
+def test_error_fingerprint_without_error():
+    assert error_fingerprint(None, 200) is None
+    assert error_fingerprint("", None) is None
+
+
+def test_error_fingerprint_limits_template_length():
+    fingerprint, template = error_fingerprint("x" * 2000, 500)
+    assert len(fingerprint) == 16
+    assert len(template) == ERROR_TEMPLATE_MAX_LENGTH
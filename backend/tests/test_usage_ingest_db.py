@@ -0,0 +1,51 @@
+"""
+usage_logs 寫入的整合測試（需要真實的 Postgres schema）
+
+設定 TEST_DATABASE_URL 指向一個可以隨意寫入的測試數據庫才會執行，否則略過
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime
+
+import pytest
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+
+def _record(token_hash: str, event_id: str):
+    return (
+        token_hash, "/api/test", datetime.utcnow().replace(microsecond=0), 200, 12,
+        "127.0.0.1", "pytest", "GET", None, event_id,
+    )
+
+
+def test_write_usage_records_with_event_ids_deduplicates():
+    os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+    from database import db
+    from usage_ingest import write_usage_records
+
+    async def run():
+        await db.connect()
+        try:
+            token_hash = uuid.uuid4().hex
+            records = [_record(token_hash, str(uuid.uuid4())) for _ in range(3)]
+            async with db.pool.acquire() as conn:
+                first = await write_usage_records(conn, records)
+                # 重送同一批（Worker 重試、日誌回放）全部被唯一索引擋下
+                second = await write_usage_records(conn, records + [_record(token_hash, str(uuid.uuid4()))])
+                stored = await conn.fetchval("""
+                    SELECT COUNT(*) FROM usage_logs l
+                    JOIN usage_dict_tokens t ON t.id = l.token_id
+                    WHERE t.token_hash = $1
+                """, token_hash)
+            return first, second, stored
+        finally:
+            await db.disconnect()
+
+    first, second, stored = asyncio.run(run())
+    assert first == 0
+    assert second == 3
+    assert stored == 4
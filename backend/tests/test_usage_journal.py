@@ -0,0 +1,76 @@
+"""本地溢寫日誌的 frame 格式與損壞處理"""
+import os
+from datetime import datetime
+
+import pytest
+
+from usage_journal import CORRUPT_SUFFIX, FRAME_HEADER, UsageJournal
+
+
+def _record(index: int):
+    return ("hash", "/r", datetime(2024, 1, 1, 0, 0, index), 200, index, "10.0.0.1", "ua", "GET", "é", None)
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = UsageJournal()
+    journal.enabled = True
+    journal.directory = str(tmp_path)
+    journal.fsync_policy = "off"
+    journal.open()
+    yield journal
+    os.close(journal._fd)
+
+
+def _sealed(journal, batches):
+    for batch in batches:
+        journal.append(batch)
+    journal.rotate()
+    return journal.sealed_segments()[0]
+
+
+def test_round_trip(journal):
+    batches = [[_record(0), _record(1)], [_record(2)]]
+    segment = _sealed(journal, batches)
+    frames = list(journal.read_frames(segment))
+    assert [records for _, records in frames] == batches
+    # offset 指向下一個 frame，可從中間繼續讀取
+    assert [records for _, records in journal.read_frames(segment, frames[0][0])] == batches[1:]
+
+
+def test_ignores_truncated_tail(journal):
+    segment = _sealed(journal, [[_record(0)], [_record(1)]])
+    path = os.path.join(journal.directory, segment)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+    assert [records for _, records in journal.read_frames(segment)] == [[_record(0)]]
+    assert journal.counters["corrupt_frames"] == 0
+
+
+@pytest.mark.parametrize("position", ["payload", "length"])
+def test_resyncs_after_corrupt_frame(journal, position):
+    segment = _sealed(journal, [[_record(0)], [_record(1)], [_record(2)]])
+    path = os.path.join(journal.directory, segment)
+    data = bytearray(open(path, "rb").read())
+    data[FRAME_HEADER.size + 5 if position == "payload" else 1] ^= 0xFF
+    with open(path, "wb") as f:
+        f.write(data)
+
+    assert [records for _, records in journal.read_frames(segment)] == [[_record(1)], [_record(2)]]
+    assert journal.counters["corrupt_frames"] == 1
+
+    # 有損壞 frame 的 segment 回放後保留為 .corrupt
+    journal.remove_segment(segment)
+    assert not os.path.exists(path)
+    assert os.path.exists(path + CORRUPT_SUFFIX)
+    assert segment not in journal.segments()
+
+
+def test_remove_segment_deletes_clean_segment(journal):
+    segment = _sealed(journal, [[_record(0)]])
+    list(journal.read_frames(segment))
+    journal.save_position(segment, 10)
+    journal.remove_segment(segment)
+    assert segment not in journal.segments()
+    assert journal.load_position() == (None, 0)
+    assert not journal.has_pending()
@@ -0,0 +1,43 @@
+"""LTTB 降採樣"""
+import math
+
+import pytest
+
+from usage_series import downsample_series, lttb_indices
+
+
+def test_returns_all_indices_when_under_threshold():
+    assert lttb_indices([1, 2, 3], 3) == [0, 1, 2]
+    assert lttb_indices([1, 2, 3], 10) == [0, 1, 2]
+
+
+@pytest.mark.parametrize("count, threshold", [(10, 3), (100, 10), (1000, 37), (5000, 1000)])
+def test_keeps_endpoints_and_threshold_points(count, threshold):
+    values = [math.sin(index / 7) for index in range(count)]
+    indices = lttb_indices(values, threshold)
+    assert len(indices) == threshold
+    assert indices[0] == 0
+    assert indices[-1] == count - 1
+    assert indices == sorted(set(indices))
+
+
+def test_keeps_spike():
+    values = [0.0] * 500
+    values[123] = 100.0
+    assert 123 in lttb_indices(values, 20)
+
+
+def test_none_counts_as_zero():
+    values = [None, 1, None, 5, None, 2, None, 0]
+    indices = lttb_indices(values, 4)
+    assert len(indices) == 4
+    assert 3 in indices
+
+
+def test_downsample_series_uses_metric_shape():
+    points = [{"t": index, "calls": 0, "errors": 0} for index in range(300)]
+    points[200]["errors"] = 9
+    sampled = downsample_series(points, "errors", 10)
+    assert len(sampled) == 10
+    assert any(point["t"] == 200 for point in sampled)
+    assert downsample_series(points[:5], "errors", 10) == points[:5]
@@ -0,0 +1,43 @@
+"""HyperLogLog sketch"""
+import pytest
+
+from usage_sketch import HLL_REGISTERS, hll_add, hll_estimate, hll_merge, hll_new
+
+
+def _sketch(values):
+    registers = hll_new()
+    for value in values:
+        hll_add(registers, value)
+    return registers
+
+
+def test_empty_sketch():
+    assert len(hll_new()) == HLL_REGISTERS
+    assert hll_estimate(hll_new()) == 0
+    assert hll_estimate(None) == 0
+
+
+@pytest.mark.parametrize("count", [1, 10, 100, 1000, 50000])
+def test_estimate_within_error(count):
+    estimate = hll_estimate(_sketch(f"10.0.{index // 256}.{index % 256}-{index}" for index in range(count)))
+    # 標準誤差約 3.3%，容許 4 倍
+    assert abs(estimate - count) <= max(1, count * 0.13)
+
+
+def test_adding_duplicates_does_not_change_sketch():
+    once = _sketch(str(index) for index in range(500))
+    twice = _sketch([str(index) for index in range(500)] * 2)
+    assert once == twice
+
+
+def test_merge_equals_union():
+    left = _sketch(f"a{index}" for index in range(3000))
+    right = _sketch(f"a{index}" for index in range(2000, 6000))
+    merged = hll_merge([bytes(left), None, bytes(right)])
+    assert merged == _sketch(f"a{index}" for index in range(6000))
+    assert abs(hll_estimate(merged) - 6000) <= 6000 * 0.13
+
+
+def test_merge_without_sketches():
+    assert hll_merge([]) is None
+    assert hll_merge([None, b""]) is None
@@ -0,0 +1,327 @@
+"""
+Token 使用異常偵測（調用量突增 / 驟降、錯誤率突增）
+
+寫入路徑接受事件時累加到該 Token 當前分鐘的計數（以收到事件的時間分桶，延遲送達的事件算在收到的那一分鐘）；
+每分鐘結束時以該分鐘的調用數與錯誤率更新 EWMA 基準線，沒有調用的分鐘也算一次觀測（調用數 0）：
+- spike：調用數高於基準線 z_threshold 個標準差以上（且至少 min_calls 次）
+- drop：基準線至少 drop_min_rate 次/分鐘，但該分鐘的調用數不到基準線的 drop_ratio
+- error_spike：錯誤率（4xx/5xx）比基準線高出 error_rate_delta 以上（且至少 min_calls 次）
+標準差取 max(EWMA 變異數, 平均值)（Poisson 下限），低流量的 Token 不會因偶發的幾次調用被判為異常。
+觀測不足 warmup_minutes 分鐘的 Token 只更新基準線、不判斷異常。
+
+同一 Token 同一類型的異常持續期間只有一筆記錄（更新 last_seen_at），條件不再成立的第一分鐘標記為結束。
+基準線與異常每 checkpoint_interval 秒寫入 usage_anomaly_baselines / usage_anomalies，
+重啟後由 load() 接續（停機期間不計入觀測）；多個 worker 進程時每個進程只看到自己收到的事件。
+"""
+import asyncio
+import math
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from database import db
+
+ANOMALY_KINDS = ("spike", "drop", "error_spike")
+# 長時間沒有 tick（例如事件迴圈被阻塞）時，最多補算的分鐘數
+_MAX_CATCH_UP_MINUTES = 1440
+_EPOCH = datetime(1970, 1, 1)
+
+
+class _Baseline:
+    """單一 Token 的 EWMA 基準線與當前分鐘的計數"""
+
+    __slots__ = (
+        "rate_mean", "rate_var", "error_rate_mean", "observations", "minute", "calls", "errors", "dirty", "version"
+    )
+
+    def __init__(self, minute: int, rate_mean: float = 0.0, rate_var: float = 0.0,
+                 error_rate_mean: float = 0.0, observations: int = 0):
+        self.rate_mean = rate_mean
+        self.rate_var = rate_var
+        self.error_rate_mean = error_rate_mean
+        self.observations = observations
+        self.minute = minute
+        self.calls = 0
+        self.errors = 0
+        self.dirty = False
+        # 每次更新基準線加一，checkpoint 寫入期間有更新時不清除 dirty
+        self.version = 0
+
+
+def _anomaly_row(anomaly: Dict[str, Any]) -> Tuple:
+    """異常寫入 usage_anomalies 的欄位值"""
+    return (
+        anomaly["id"], anomaly["token_hash"], anomaly["kind"], anomaly["started_at"],
+        anomaly["last_seen_at"], anomaly["resolved_at"], anomaly["observed"],
+        anomaly["expected"], anomaly["score"]
+    )
+
+
+class UsageAnomalyDetector:
+    """每個 Token 的調用量與錯誤率基準線及異常狀態"""
+
+    def __init__(self):
+        self.enabled = os.getenv("USAGE_ANOMALY_ENABLED", "true").lower() == "true"
+        self.alpha = float(os.getenv("USAGE_ANOMALY_ALPHA", "0.05"))
+        self.warmup_minutes = int(os.getenv("USAGE_ANOMALY_WARMUP_MINUTES", "60"))
+        self.z_threshold = float(os.getenv("USAGE_ANOMALY_Z_THRESHOLD", "4"))
+        self.min_calls = int(os.getenv("USAGE_ANOMALY_MIN_CALLS", "20"))
+        self.drop_ratio = float(os.getenv("USAGE_ANOMALY_DROP_RATIO", "0.2"))
+        self.drop_min_rate = float(os.getenv("USAGE_ANOMALY_DROP_MIN_RATE", "5"))
+        self.error_rate_delta = float(os.getenv("USAGE_ANOMALY_ERROR_RATE_DELTA", "0.2"))
+        self.checkpoint_interval = int(os.getenv("USAGE_ANOMALY_CHECKPOINT_SECONDS", "60"))
+        self._baselines: Dict[str, _Baseline] = {}
+        # (token_hash, kind) → 進行中的異常
+        self._active: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # 待寫入數據庫的異常 id → 異常
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        # 基準線已歸零而移出記憶體、待從數據庫刪除的 Token
+        self._evicted: set = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, token_hash: str, calls: int = 1, errors: int = 0):
+        """累加 Token 在當前分鐘的調用數與錯誤數"""
+        if not self.enabled:
+            return
+        minute = int(time.time() // 60)
+        baseline = self._baselines.get(token_hash)
+        if baseline is None:
+            baseline = self._baselines[token_hash] = _Baseline(minute)
+            self._evicted.discard(token_hash)
+        elif baseline.minute < minute:
+            self._advance(token_hash, baseline, minute)
+        baseline.calls += calls
+        baseline.errors += errors
+
+    def tick(self):
+        """結束所有 Token 已過去的分鐘（背景任務每分鐘呼叫）"""
+        minute = int(time.time() // 60)
+        for token_hash, baseline in list(self._baselines.items()):
+            if baseline.minute < minute:
+                self._advance(token_hash, baseline, minute)
+                if (baseline.rate_mean < 0.01 and not baseline.calls
+                        and baseline.observations >= self.warmup_minutes
+                        and not any((token_hash, kind) in self._active for kind in ANOMALY_KINDS)):
+                    # 長期沒有調用，基準線已與新 Token 無異
+                    del self._baselines[token_hash]
+                    self._evicted.add(token_hash)
+
+    def _advance(self, token_hash: str, baseline: _Baseline, minute: int):
+        gap = minute - baseline.minute
+        for offset in range(min(gap, _MAX_CATCH_UP_MINUTES)):
+            closed = minute - min(gap, _MAX_CATCH_UP_MINUTES) + offset
+            self._observe(token_hash, baseline, closed)
+            baseline.calls = 0
+            baseline.errors = 0
+        baseline.minute = minute
+
+    def _observe(self, token_hash: str, baseline: _Baseline, minute: int):
+        """以一分鐘的觀測判斷異常，再更新基準線（判斷用的是更新前的基準線）"""
+        calls, errors = baseline.calls, baseline.errors
+        error_rate = errors / calls if calls else 0.0
+        at = _EPOCH + timedelta(minutes=minute)
+        rate_alpha = error_alpha = self.alpha
+
+        if baseline.observations >= self.warmup_minutes:
+            expected = baseline.rate_mean
+            std = math.sqrt(max(baseline.rate_var, expected, 1.0))
+            score = (calls - expected) / std
+            spike = calls >= self.min_calls and score >= self.z_threshold
+            drop = expected >= self.drop_min_rate and calls <= expected * self.drop_ratio
+            error_spike = calls >= self.min_calls and error_rate - baseline.error_rate_mean >= self.error_rate_delta
+            self._update(token_hash, "spike", at, spike, calls, expected, score)
+            self._update(token_hash, "drop", at, drop, calls, expected, score)
+            self._update(
+                token_hash, "error_spike", at, error_spike,
+                error_rate, baseline.error_rate_mean, error_rate - baseline.error_rate_mean
+            )
+            # 異常期間的觀測只以 1/10 權重納入基準線：短暫異常不會立刻被吸收，持續的水位變化最終仍會成為新基準
+            if spike or drop:
+                rate_alpha /= 10
+            if error_spike:
+                error_alpha /= 10
+
+        diff = calls - baseline.rate_mean
+        increment = rate_alpha * diff
+        baseline.rate_mean += increment
+        baseline.rate_var = (1 - rate_alpha) * (baseline.rate_var + diff * increment)
+        if calls:
+            baseline.error_rate_mean += error_alpha * (error_rate - baseline.error_rate_mean)
+        baseline.observations += 1
+        baseline.dirty = True
+        baseline.version += 1
+
+    def _update(self, token_hash: str, kind: str, at: datetime, triggered: bool,
+                observed: float, expected: float, score: float):
+        key = (token_hash, kind)
+        anomaly = self._active.get(key)
+        if triggered:
+            if anomaly is None:
+                anomaly = self._active[key] = {
+                    "id": str(uuid.uuid4()),
+                    "token_hash": token_hash,
+                    "kind": kind,
+                    "started_at": at,
+                    "resolved_at": None,
+                    "score": score
+                }
+                print(f"⚠️ Usage anomaly: {kind} on token {token_hash[:8]} (observed {observed:.2f}, expected {expected:.2f})")
+            anomaly.update(last_seen_at=at, observed=observed, expected=expected)
+            if abs(score) > abs(anomaly["score"]):
+                anomaly["score"] = score
+            self._pending[anomaly["id"]] = anomaly
+        elif anomaly is not None:
+            anomaly["resolved_at"] = at
+            del self._active[key]
+            self._pending[anomaly["id"]] = anomaly
+
+    def active(self, token_hashes: Optional[set] = None) -> List[Dict[str, Any]]:
+        """進行中的異常（依開始時間由新到舊），token_hashes 不為 None 時只返回這些 Token 的"""
+        items = [
+            dict(anomaly) for anomaly in self._active.values()
+            if token_hashes is None or anomaly["token_hash"] in token_hashes
+        ]
+        items.sort(key=lambda anomaly: anomaly["started_at"], reverse=True)
+        return items
+
+    def baseline(self, token_hash: str) -> Optional[Dict[str, Any]]:
+        """Token 目前的基準線（調用數 / 分鐘與錯誤率）"""
+        baseline = self._baselines.get(token_hash)
+        if baseline is None:
+            return None
+        return {
+            "calls_per_minute": round(baseline.rate_mean, 3),
+            "calls_per_minute_stddev": round(math.sqrt(baseline.rate_var), 3),
+            "error_rate": round(baseline.error_rate_mean, 4),
+            "observations": baseline.observations,
+            "warmed_up": baseline.observations >= self.warmup_minutes
+        }
+
+    async def load(self, conn):
+        """從數據庫恢復基準線與進行中的異常（啟動時、開始接受事件前呼叫）"""
+        if not self.enabled:
+            return
+        minute = int(time.time() // 60)
+        rows = await conn.fetch("""
+            SELECT token_hash, rate_mean, rate_var, error_rate_mean, observations
+            FROM usage_anomaly_baselines
+        """)
+        self._baselines = {
+            row['token_hash']: _Baseline(
+                minute, row['rate_mean'], row['rate_var'], row['error_rate_mean'], row['observations']
+            )
+            for row in rows
+        }
+        active = await conn.fetch("""
+            SELECT id::text as id, token_hash, kind, started_at, last_seen_at, resolved_at,
+                   observed, expected, score
+            FROM usage_anomalies
+            WHERE resolved_at IS NULL
+        """)
+        self._active = {(row['token_hash'], row['kind']): dict(row) for row in active}
+        print(f"✅ Usage anomaly baselines loaded ({len(rows)} tokens, {len(active)} active anomalies)")
+
+    async def checkpoint(self, conn):
+        """把有變動的基準線與異常寫入數據庫"""
+        now = datetime.utcnow()
+        # 先取出要寫入的值：寫入期間（await）基準線與異常可能被更新，完成後以版本與快照比對
+        dirty = [
+            (token_hash, baseline, baseline.version)
+            for token_hash, baseline in self._baselines.items() if baseline.dirty
+        ]
+        baseline_columns = [list(column) for column in zip(*(
+            (token_hash, baseline.rate_mean, baseline.rate_var, baseline.error_rate_mean, baseline.observations)
+            for token_hash, baseline, _ in dirty
+        ))]
+        pending = [_anomaly_row(anomaly) for anomaly in self._pending.values()]
+        evicted = list(self._evicted)
+        if not dirty and not pending and not evicted:
+            return
+
+        async with conn.transaction():
+            if dirty:
+                await conn.execute("""
+                    INSERT INTO usage_anomaly_baselines
+                        (token_hash, rate_mean, rate_var, error_rate_mean, observations, updated_at)
+                    SELECT token_hash, rate_mean, rate_var, error_rate_mean, observations, $6
+                    FROM unnest($1::text[], $2::float8[], $3::float8[], $4::float8[], $5::int[])
+                        AS t(token_hash, rate_mean, rate_var, error_rate_mean, observations)
+                    ON CONFLICT (token_hash) DO UPDATE SET
+                        rate_mean = EXCLUDED.rate_mean,
+                        rate_var = EXCLUDED.rate_var,
+                        error_rate_mean = EXCLUDED.error_rate_mean,
+                        observations = EXCLUDED.observations,
+                        updated_at = EXCLUDED.updated_at
+                """, *baseline_columns, now)
+            if pending:
+                await conn.executemany("""
+                    INSERT INTO usage_anomalies
+                        (id, token_hash, kind, started_at, last_seen_at, resolved_at, observed, expected, score)
+                    VALUES ($1::uuid, $2, $3, $4, $5, $6, $7, $8, $9)
+                    ON CONFLICT (id) DO UPDATE SET
+                        last_seen_at = EXCLUDED.last_seen_at,
+                        resolved_at = EXCLUDED.resolved_at,
+                        observed = EXCLUDED.observed,
+                        expected = EXCLUDED.expected,
+                        score = EXCLUDED.score
+                """, pending)
+            if evicted:
+                await conn.execute(
+                    "DELETE FROM usage_anomaly_baselines WHERE token_hash = ANY($1::text[])", evicted
+                )
+
+        # 寫入期間有新變動的項目留到下次
+        for _, baseline, version in dirty:
+            if baseline.version == version:
+                baseline.dirty = False
+        for row in pending:
+            anomaly = self._pending.get(row[0])
+            if anomaly is not None and _anomaly_row(anomaly) == row:
+                del self._pending[row[0]]
+        self._evicted.difference_update(evicted)
+
+    def start(self):
+        """啟動每分鐘結算與定期 checkpoint 的背景任務"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+            print(f"✅ Usage anomaly detector started (alpha={self.alpha}, z={self.z_threshold})")
+
+    async def stop(self):
+        """停止背景任務並寫入最後一次 checkpoint"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            async with db.pool.acquire() as conn:
+                await self.checkpoint(conn)
+
+    async def _run(self):
+        checkpoint_at = time.monotonic() + self.checkpoint_interval
+        while True:
+            # 對齊到下一分鐘開始後一秒
+            await asyncio.sleep(61 - time.time() % 60)
+            self.tick()
+            if time.monotonic() >= checkpoint_at:
+                checkpoint_at = time.monotonic() + self.checkpoint_interval
+                try:
+                    async with db.pool.acquire() as conn:
+                        await self.checkpoint(conn)
+                except Exception as e:
+                    print(f"Warning: Failed to checkpoint usage anomaly baselines: {e}")
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "tokens": len(self._baselines),
+            "active": len(self._active),
+            "pending_writes": len(self._pending)
+        }
+
+
+# 全局偵測實例
+usage_anomaly_detector = UsageAnomalyDetector()
@@ -0,0 +1,147 @@
+"""
+使用記錄的 ASGI 快速寫入端點
+
+POST /api/usage-ingest 直接以 ASGI handler 處理，不經過 FastAPI 的 Request / 依賴注入 / 回應模型，
+JSON 使用 orjson 解析（未安裝時退回標準庫 json），並可接受 msgpack（需安裝 msgpack）。
+事件格式與 /api/usage-log 相同，解析後放入同一個寫入緩衝。
+
+Body 可為：
+- 單一事件物件，或事件陣列 / {"events": [...]}（application/json）
+- NDJSON（application/x-ndjson）
+- msgpack 編碼的物件或陣列（application/msgpack）
+"""
+import json
+import os
+
+from usage_ingest import parse_usage_event, usage_buffer, UsageBufferFull
+
+try:
+    import orjson
+except ImportError:  # orjson 是可選依賴
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # msgpack 是可選依賴
+    msgpack = None
+
+
+MAX_BODY_BYTES = int(os.getenv("USAGE_INGEST_MAX_BODY_BYTES", str(5 * 1024 * 1024)))
+
+
+def _loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps(value) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode("utf-8")
+
+
+class IngestError(Exception):
+    """返回給 Worker 的錯誤（status + detail）"""
+
+    def __init__(self, status: int, detail: str, headers=None):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+        self.headers = headers or []
+
+
+def decode_events(body: bytes, content_type: str) -> list:
+    """依 Content-Type 解碼為事件列表"""
+    if not body.strip():
+        return []
+
+    try:
+        if "msgpack" in content_type:
+            if msgpack is None:
+                raise IngestError(415, "msgpack is not supported on this server")
+            parsed = msgpack.unpackb(body, raw=False)
+        elif "ndjson" in content_type or "jsonlines" in content_type:
+            return [_loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            parsed = _loads(body)
+    except IngestError:
+        raise
+    except Exception:
+        raise IngestError(400, "Invalid request body")
+
+    if isinstance(parsed, dict):
+        parsed = parsed.get("events", [parsed])
+    if not isinstance(parsed, list):
+        raise IngestError(400, "Body must be an event object or an array of events")
+    return parsed
+
+
+class UsageIngestEndpoint:
+    """POST /api/usage-ingest 的 ASGI handler"""
+
+    async def __call__(self, scope, receive, send):
+        try:
+            body = await self._read_body(receive)
+            content_type = ""
+            for name, value in scope["headers"]:
+                if name == b"content-type":
+                    content_type = value.decode("latin-1").lower()
+                    break
+
+            records = []
+            for index, event in enumerate(decode_events(body, content_type)):
+                try:
+                    records.append(parse_usage_event(event))
+                except (ValueError, TypeError) as e:
+                    raise IngestError(400, f"events[{index}]: {str(e)}")
+
+            try:
+                added = usage_buffer.add(records)
+            except UsageBufferFull as e:
+                raise IngestError(
+                    429,
+                    "Usage ingestion is overloaded, retry later",
+                    [(b"retry-after", str(e.retry_after).encode())]
+                )
+        except IngestError as e:
+            await self._respond(send, e.status, {"detail": e.detail}, e.headers)
+            return
+
+        result = {"status": "queued", "count": added["queued"]}
+        if added["dropped"]:
+            result["dropped"] = added["dropped"]
+        if added["duplicates"]:
+            result["duplicates"] = added["duplicates"]
+        await self._respond(send, 200, result)
+
+    async def _read_body(self, receive) -> bytes:
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise IngestError(400, "Client disconnected")
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                raise IngestError(413, "Request body too large")
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def _respond(self, send, status: int, content: dict, headers=None):
+        body = _dumps(content)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                *(headers or [])
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+usage_ingest_endpoint = UsageIngestEndpoint()
@@ -0,0 +1,232 @@
+"""
+使用記錄匯出（計費與離線分析用）
+
+經由數據庫的 server-side cursor 每次讀取 chunk_rows 筆，邊讀邊以 CSV / NDJSON / Parquet 串流返回，
+記憶體用量與匯出的總筆數無關。Parquet 使用 pyarrow（列在 requirements.txt，每個 chunk 寫成一個 row group）。
+
+整個匯出在一個唯讀的 REPEATABLE READ transaction 內完成，匯出期間新寫入的記錄不會混入；
+同時進行的匯出數受 max_concurrent 限制（每個匯出佔用一個連接直到結束），名額在回應返回前就佔用。
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from database import db
+
+try:
+    import orjson
+except ImportError:  # orjson 是可選依賴
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pyarrow 是可選依賴（只有 Parquet 匯出需要）
+    pyarrow = None
+
+PARQUET_AVAILABLE = pyarrow is not None
+
+
+EXPORT_FIELDS = (
+    'id', 'used_at', 'token_hash', 'route_path', 'request_method', 'response_status',
+    'response_time_ms', 'ip_address', 'user_agent', 'error_message', 'event_id'
+)
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _parquet_schema(fields: List[str]):
+    types = {
+        'id': pyarrow.int64(),
+        'used_at': pyarrow.timestamp('us'),
+        'response_status': pyarrow.int32(),
+        'response_time_ms': pyarrow.int64(),
+    }
+    return pyarrow.schema([(field, types.get(field, pyarrow.string())) for field in fields])
+
+
+class _ChunkSink:
+    """ParquetWriter 的輸出目標：收集寫入的 bytes，每個 row group 寫完後取出串流返回"""
+
+    def __init__(self):
+        self.closed = False
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ExportSlot:
+    """一個匯出名額（release() 可重複呼叫，只釋放一次）"""
+
+    __slots__ = ("_exporter",)
+
+    def __init__(self, exporter: "UsageExporter"):
+        self._exporter = exporter
+
+    def release(self):
+        if self._exporter is not None:
+            self._exporter._active -= 1
+            self._exporter = None
+
+
+class UsageExporter:
+    """以 server-side cursor 串流匯出 usage_log_entries"""
+
+    def __init__(self):
+        self.chunk_rows = int(os.getenv("USAGE_EXPORT_CHUNK_ROWS", "10000"))
+        self.max_concurrent = int(os.getenv("USAGE_EXPORT_MAX_CONCURRENT", "2"))
+        self._active = 0
+
+    def build_query(
+        self,
+        fields: List[str],
+        token_hashes: Optional[List[str]] = None,
+        route_path: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> Tuple[str, List[Any]]:
+        """
+        組合匯出查詢（不排序：依分區順序讀取，避免在數據庫排序上億筆記錄）
+
+        token_hashes 為 None 時不限 Token（按團隊匯出時為該團隊的所有 Token）
+        """
+        conditions = []
+        params: List[Any] = []
+        if token_hashes is not None:
+            params.append(token_hashes)
+            conditions.append(f"token_hash = ANY(${len(params)}::text[])")
+        if route_path:
+            params.append(route_path)
+            conditions.append(f"route_path = ${len(params)}")
+        if start:
+            params.append(start)
+            conditions.append(f"used_at >= ${len(params)}")
+        if end:
+            params.append(end)
+            conditions.append(f"used_at < ${len(params)}")
+
+        where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        columns = ["event_id::text AS event_id" if field == "event_id" else field for field in fields]
+        return f"SELECT {', '.join(columns)} FROM usage_log_entries {where_clause}", params
+
+    def try_acquire(self) -> Optional[ExportSlot]:
+        """
+        佔用一個匯出名額，已達上限時返回 None（呼叫端應返回 429）
+
+        檢查與佔用之間沒有 await，並發的請求不會同時通過；
+        名額由 stream() 結束時釋放，回應沒有開始串流時由呼叫端（BackgroundTask）釋放
+        """
+        if self._active >= self.max_concurrent:
+            return None
+        self._active += 1
+        return ExportSlot(self)
+
+    async def stream(
+        self, slot: ExportSlot, export_format: str, fields: List[str], sql: str, params: List[Any]
+    ) -> AsyncIterator[bytes]:
+        """
+        逐 chunk 產生匯出內容，結束時釋放 slot
+
+        客戶端中斷時 generator 被關閉，transaction 與連接隨之釋放
+        """
+        try:
+            async with db.pool.acquire() as conn:
+                async with conn.transaction(isolation='repeatable_read', readonly=True):
+                    cursor = await conn.cursor(sql, *params)
+                    if export_format == "parquet":
+                        async for chunk in self._parquet_chunks(cursor, fields):
+                            yield chunk
+                    else:
+                        encode = self._csv_chunk if export_format == "csv" else self._ndjson_chunk
+                        if export_format == "csv":
+                            yield encode([fields])
+                        while True:
+                            rows = await cursor.fetch(self.chunk_rows)
+                            if not rows:
+                                break
+                            yield encode(rows)
+                            # 讓出事件迴圈，避免大量匯出佔滿 CPU
+                            await asyncio.sleep(0)
+        finally:
+            slot.release()
+
+    def _csv_chunk(self, rows) -> bytes:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(
+                value.isoformat() if isinstance(value, datetime) else value
+                for value in row
+            )
+        return buffer.getvalue().encode("utf-8")
+
+    def _ndjson_chunk(self, rows) -> bytes:
+        if orjson is not None:
+            return b"".join(
+                orjson.dumps(dict(row), option=orjson.OPT_APPEND_NEWLINE)
+                for row in rows
+            )
+        return "".join(
+            json.dumps(dict(row), default=_json_default, ensure_ascii=False) + "\n"
+            for row in rows
+        ).encode("utf-8")
+
+    async def _parquet_chunks(self, cursor, fields: List[str]) -> AsyncIterator[bytes]:
+        schema = _parquet_schema(fields)
+        sink = _ChunkSink()
+        writer = pyarrow.parquet.ParquetWriter(sink, schema, compression="zstd")
+        try:
+            while True:
+                rows = await cursor.fetch(self.chunk_rows)
+                if not rows:
+                    break
+                columns = {field: [row[field] for row in rows] for field in fields}
+                writer.write_table(pyarrow.Table.from_pydict(columns, schema=schema))
+                yield sink.take()
+                await asyncio.sleep(0)
+        finally:
+            writer.close()
+        yield sink.take()
+
+
+# 全局匯出實例
+usage_exporter = UsageExporter()
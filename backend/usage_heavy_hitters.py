@@ -0,0 +1,185 @@
+"""
+最常使用的 Token / 路由（heavy hitters）即時追蹤
+
+寫入緩衝接受事件時同步累加到記憶體中的 Space-Saving 摘要，
+Top N 列表直接由記憶體合併得出，不需要在數據庫 GROUP BY 一週的數據。
+
+滑動窗口以時間片實作：
+- 1h：最近 60 個分鐘片
+- 24h / 7d：最近 24 / 168 個小時片（以整點對齊，與彙總表一致）
+每個時間片各有一個容量為 capacity 的 Space-Saving 摘要，查詢時把窗口內的時間片合併。
+
+啟動時由 load() 從 usage_rollup_hourly（小時片）與最近一小時的原始記錄（分鐘片）重建，
+之後只靠寫入路徑更新；多個 worker 進程時每個進程只看到自己收到的事件。
+"""
+import heapq
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+
+class SpaceSaving:
+    """
+    Space-Saving top-k 摘要（Metwally et al.）
+
+    最多追蹤 capacity 個 key；新的 key 在摘要已滿時取代計數最小的 key，
+    並繼承其計數作為誤差上限（error）。真實次數介於 count - error 與 count 之間。
+
+    計數最小的 key 以最小堆找出：每個 key 在堆中只有一個 (計數, key) 項目，累加時不更新堆
+    （堆中的計數只會偏小），取代時若堆頂的計數已過時就以實際計數放回再看下一個，
+    累加為 O(1)，取代為攤銷 O(log k)
+    """
+
+    __slots__ = ("capacity", "counts", "errors", "_heap")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self._heap: List[Tuple[int, str]] = []
+
+    def add(self, key: str, count: int = 1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return
+        if len(counts) < self.capacity:
+            counts[key] = count
+            self.errors[key] = 0
+            heapq.heappush(self._heap, (count, key))
+            return
+
+        heap = self._heap
+        floor, victim = heap[0]
+        while counts[victim] != floor:
+            heapq.heapreplace(heap, (counts[victim], victim))
+            floor, victim = heap[0]
+        del counts[victim]
+        del self.errors[victim]
+        counts[key] = floor + count
+        self.errors[key] = floor
+        heapq.heapreplace(heap, (floor + count, key))
+
+
+WINDOWS = {
+    "1h": ("minute", 60),
+    "24h": ("hour", 24),
+    "7d": ("hour", 168),
+}
+DIMENSIONS = ("token", "route")
+_SLICE_SECONDS = {"minute": 60, "hour": 3600}
+_EPOCH = datetime(1970, 1, 1)
+
+
+class HeavyHitters:
+    """各時間窗口的 Top Token / 路由"""
+
+    def __init__(self):
+        self.enabled = os.getenv("USAGE_HEAVY_HITTERS_ENABLED", "true").lower() == "true"
+        self.capacity = int(os.getenv("USAGE_HEAVY_HITTERS_CAPACITY", "200"))
+        # 是否已從數據庫重建（未重建時呼叫端應改用 SQL）
+        self.loaded = False
+        # 粒度 → {時間片起點（epoch 秒）: {維度: SpaceSaving}}
+        self._slices: Dict[str, Dict[int, Dict[str, SpaceSaving]]] = {"minute": {}, "hour": {}}
+        self._retention = {"minute": 60, "hour": 168}
+
+    def _slice(self, granularity: str, start: int) -> Dict[str, SpaceSaving]:
+        slices = self._slices[granularity]
+        current = slices.get(start)
+        if current is None:
+            current = slices[start] = {dimension: SpaceSaving(self.capacity) for dimension in DIMENSIONS}
+            # 移除超出最長窗口的時間片
+            oldest = start - self._retention[granularity] * _SLICE_SECONDS[granularity]
+            for expired in [slice_start for slice_start in slices if slice_start <= oldest]:
+                del slices[expired]
+        return current
+
+    def add(self, token_hash: str, route_path: Optional[str], used_at: datetime, count: int = 1):
+        """累加一筆（或 count 筆）調用，used_at 為 naive UTC"""
+        if not self.enabled:
+            return
+        now = time.time()
+        timestamp = min((used_at - _EPOCH).total_seconds(), now)
+        for granularity, seconds in _SLICE_SECONDS.items():
+            # 早於最長窗口的延遲事件不計入
+            if timestamp > now - self._retention[granularity] * seconds:
+                self._add_to_slice(granularity, timestamp, token_hash, route_path, count)
+
+    def top(self, dimension: str, window: str, limit: int = 10) -> List[Tuple[str, int, int]]:
+        """
+        窗口內次數最多的 key
+
+        Returns:
+            依次數遞減的 [(key, count, error)]，真實次數介於 count - error 與 count 之間
+        """
+        granularity, size = WINDOWS[window]
+        seconds = _SLICE_SECONDS[granularity]
+        oldest = (int(time.time()) // seconds - size + 1) * seconds
+
+        counts: Dict[str, int] = {}
+        errors: Dict[str, int] = {}
+        for start, summaries in list(self._slices[granularity].items()):
+            if start < oldest:
+                continue
+            summary = summaries[dimension]
+            for key, count in summary.counts.items():
+                counts[key] = counts.get(key, 0) + count
+                errors[key] = errors.get(key, 0) + summary.errors[key]
+
+        ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(key, count, errors[key]) for key, count in ranked]
+
+    async def load(self, conn):
+        """從每小時彙總與最近一小時的原始記錄重建時間片（啟動時、開始接受事件前呼叫）"""
+        if not self.enabled:
+            return
+        self._slices = {"minute": {}, "hour": {}}
+
+        now = datetime.utcnow()
+        since_hour = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=self._retention["hour"] - 1)
+        hourly = await conn.fetch("""
+            SELECT hour, token_hash, NULLIF(route_path, '') as route_path, calls
+            FROM usage_rollup_hourly
+            WHERE hour >= $1
+        """, since_hour)
+        for row in hourly:
+            self._add_to_slice(
+                "hour", (row['hour'] - _EPOCH).total_seconds(), row['token_hash'], row['route_path'], row['calls']
+            )
+
+        since_minute = now.replace(second=0, microsecond=0) - timedelta(minutes=self._retention["minute"] - 1)
+        recent = await conn.fetch("""
+            SELECT DATE_TRUNC('minute', used_at) as minute, token_hash, route_path, COUNT(*) as calls
+            FROM usage_log_entries
+            WHERE used_at >= $1
+            GROUP BY 1, 2, 3
+        """, since_minute)
+        for row in recent:
+            self._add_to_slice(
+                "minute", (row['minute'] - _EPOCH).total_seconds(), row['token_hash'], row['route_path'], row['calls']
+            )
+
+        self.loaded = True
+        print(f"✅ Usage heavy hitters loaded ({len(hourly)} hourly rows, {len(recent)} minute rows)")
+
+    def _add_to_slice(self, granularity: str, timestamp: float, token_hash: str, route_path: Optional[str], count: int):
+        seconds = _SLICE_SECONDS[granularity]
+        start = int(timestamp // seconds) * seconds
+        summaries = self._slice(granularity, start)
+        summaries["token"].add(token_hash, count)
+        if route_path:
+            summaries["route"].add(route_path, count)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "loaded": self.loaded,
+            "capacity": self.capacity,
+            "minute_slices": len(self._slices["minute"]),
+            "hour_slices": len(self._slices["hour"])
+        }
+
+
+# 全局追蹤實例
+heavy_hitters = HeavyHitters()
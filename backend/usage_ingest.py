@@ -0,0 +1,1254 @@
+"""
+Token 使用記錄寫入模塊
+
+負責解析 Cloudflare Worker 送來的使用事件，先放入記憶體緩衝區，
+再由背景任務以批量方式寫入 usage_logs（字典編碼）
+"""
+import asyncio
+import hashlib
+import ipaddress
+import json
+import math
+import os
+import random
+import re
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from database import db
+from usage_anomaly import usage_anomaly_detector
+from usage_heavy_hitters import heavy_hitters
+from usage_journal import usage_journal
+from usage_sketch import hll_add, hll_estimate, hll_merge, hll_new
+
+
+# parse_usage_event 回傳的欄位順序（解碼前的邏輯欄位，與 usage_log_entries 視圖一致）
+USAGE_EVENT_FIELDS = [
+    'token_hash', 'route_path', 'used_at', 'response_status',
+    'response_time_ms', 'ip_address', 'user_agent', 'request_method', 'error_message',
+    'event_id'
+]
+
+# usage_logs 的寫入欄位（順序需與 encode_usage_record 的回傳 tuple 一致）
+USAGE_LOG_COLUMNS = [
+    'token_id', 'route_id', 'used_at', 'response_status',
+    'response_time_ms', 'ip_address', 'user_agent_id', 'method_code', 'error_message',
+    'event_id'
+]
+
+# HTTP 方法代碼（與 usage_http_methods 表一致），其他方法記為 0
+HTTP_METHOD_CODES = {
+    'GET': 1, 'POST': 2, 'PUT': 3, 'DELETE': 4, 'PATCH': 5,
+    'HEAD': 6, 'OPTIONS': 7, 'CONNECT': 8, 'TRACE': 9,
+}
+OTHER_METHOD_CODE = 0
+
+
+# usage_logs 數值欄位的範圍（response_status 為 SMALLINT，response_time_ms 為 INTEGER）
+RESPONSE_STATUS_MAX = 32767
+RESPONSE_TIME_MAX_MS = 2147483647
+
+
+def _to_int(value: Any, minimum: int = None, maximum: int = None) -> Optional[int]:
+    """
+    將數值欄位轉為 int（COPY 不會做隱式轉型）
+
+    超出 [minimum, maximum] 的值記為 None，避免單筆超出欄位範圍導致整批寫入失敗
+    """
+    if value is None or value == "":
+        return None
+    try:
+        number = int(value)
+    except OverflowError:
+        # inf
+        return None
+    if (minimum is not None and number < minimum) or (maximum is not None and number > maximum):
+        return None
+    return number
+
+
+def _to_text(value: Any, max_length: int = None) -> Optional[str]:
+    """
+    將文字欄位轉為 str，並截斷到欄位長度、移除 NUL 字元（Postgres 的 text 不接受 \\x00），
+    避免單筆資料導致整批寫入失敗
+    """
+    if value is None:
+        return None
+    text = str(value)
+    if "\x00" in text:
+        text = text.replace("\x00", "")
+    if max_length is not None:
+        text = text[:max_length]
+    return text
+
+
+def _to_ip(value: Any) -> Optional[str]:
+    """驗證 IP 位址（usage_logs.ip_address 為 INET），無效值記為 None"""
+    if not value:
+        return None
+    try:
+        return str(ipaddress.ip_address(str(value).strip()))
+    except ValueError:
+        return None
+
+
+# 非 UUID 格式的 event_id 以 uuid5 轉為 UUID（相同字串得到相同 id）
+EVENT_ID_NAMESPACE = uuid.UUID('6f1c3a52-5d0e-4b7a-9c1e-2f8d4b6a7e90')
+
+
+def _to_event_id(value: Any) -> Optional[str]:
+    """事件 id（用於去重），統一為 UUID 字串"""
+    if value is None or value == "":
+        return None
+    text = str(value).strip()
+    try:
+        return str(uuid.UUID(text))
+    except ValueError:
+        return str(uuid.uuid5(EVENT_ID_NAMESPACE, text))
+
+
+# 事件時間的允許範圍：超過已預先建立的每日分區（USAGE_PARTITION_PRECREATE_DAYS）的未來時間會落入預設分區，
+# 之後該日期的分區無法建立、也不會被保留策略清除；過舊的事件同樣只會落入預設（或舊版歷史）分區
+EVENT_MAX_FUTURE_DAYS = max(int(os.getenv("USAGE_PARTITION_PRECREATE_DAYS", "7")), 1)
+EVENT_MAX_AGE_DAYS = int(os.getenv("USAGE_EVENT_MAX_AGE_DAYS", "30"))
+
+
+def _check_event_time(used_at: datetime) -> datetime:
+    """
+    檢查事件時間是否在允許範圍內
+
+    上限為今天 00:00 + EVENT_MAX_FUTURE_DAYS 天（前一天的維護任務已建立到這一天之前的分區），
+    下限為 EVENT_MAX_AGE_DAYS 天前（0 表示不限）
+
+    Raises:
+        ValueError: 超出範圍
+    """
+    now = datetime.utcnow()
+    latest = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=EVENT_MAX_FUTURE_DAYS)
+    if used_at >= latest:
+        raise ValueError(f"timestamp is too far in the future: {used_at.isoformat()}")
+    if EVENT_MAX_AGE_DAYS > 0 and used_at < now - timedelta(days=EVENT_MAX_AGE_DAYS):
+        raise ValueError(f"timestamp is older than {EVENT_MAX_AGE_DAYS} days: {used_at.isoformat()}")
+    return used_at
+
+
+def _from_millis(value: Any) -> datetime:
+    """毫秒時間戳轉為 UTC 時間（naive）；超出可表示範圍（例如 1e20）時 ValueError"""
+    try:
+        return datetime.utcfromtimestamp(float(value) / 1000)
+    except (OverflowError, OSError):
+        raise ValueError(f"timestamp out of range: {value}")
+
+
+def parse_usage_event(data: Dict[str, Any]) -> Tuple:
+    """
+    將 Worker 的使用事件 payload 轉為一筆使用記錄（欄位見 USAGE_EVENT_FIELDS）
+
+    payload 格式與 /api/usage-log 相同：
+    token_hash, route, timestamp(毫秒), response_status, response_time_ms,
+    ip_address, user_agent, request_method, error_message,
+    event_id（可選，Worker 重送時帶相同的 id 即可去重；需同時帶 timestamp）
+
+    Raises:
+        ValueError: 缺少 token_hash、欄位格式錯誤或 timestamp 超出允許範圍（見 _check_event_time）
+    """
+    if not isinstance(data, dict):
+        raise ValueError("event must be a JSON object")
+
+    token_hash = data.get('token_hash')
+    if not token_hash:
+        raise ValueError("token_hash is required")
+
+    timestamp = data.get('timestamp')
+    if timestamp is not None:
+        used_at = _check_event_time(_from_millis(timestamp))
+    else:
+        used_at = datetime.utcnow()
+
+    return (
+        _to_text(token_hash, 64),
+        _to_text(data.get('route'), 255),
+        used_at,
+        _to_int(data.get('response_status'), 0, RESPONSE_STATUS_MAX),
+        _to_int(data.get('response_time_ms'), 0, RESPONSE_TIME_MAX_MS),
+        _to_ip(data.get('ip_address')),
+        _to_text(data.get('user_agent'), 512),
+        _to_text(data.get('request_method'), 10),
+        _to_text(data.get('error_message')),
+        _to_event_id(data.get('event_id')),
+    )
+
+
+def parse_usage_batch(body: bytes, content_type: str = "") -> List[Dict[str, Any]]:
+    """
+    解析批量使用事件
+
+    支援兩種格式：
+    - JSON 陣列：[{...}, {...}]（或 {"events": [...]}）
+    - NDJSON：每行一個 JSON 物件（Content-Type: application/x-ndjson）
+
+    Raises:
+        ValueError: 無法解析的 body
+    """
+    text = body.decode('utf-8').strip()
+    if not text:
+        return []
+
+    is_ndjson = 'ndjson' in content_type or 'jsonlines' in content_type
+    if not is_ndjson and text[0] in '[{':
+        try:
+            parsed = json.loads(text)
+        except json.JSONDecodeError:
+            # 多行 JSON 物件但沒有設定 Content-Type，當作 NDJSON 處理
+            if text[0] != '{':
+                raise ValueError("Invalid JSON body")
+        else:
+            if isinstance(parsed, dict):
+                parsed = parsed.get('events', [parsed])
+            if not isinstance(parsed, list):
+                raise ValueError("Batch body must be a JSON array of events")
+            return parsed
+
+    events = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            events.append(json.loads(line))
+        except json.JSONDecodeError:
+            raise ValueError(f"Invalid JSON on line {line_no}")
+    return events
+
+
+# 延遲直方圖：對數分桶（DDSketch 形式），第 i 桶涵蓋 (γ^(i-1), γ^i] 毫秒，第 0 桶為 ≤ 1ms，
+# 超過 γ^LATENCY_MAX_BUCKET（約 70 秒）的都記在最後一桶。
+# 以 BIGINT[] 儲存（第 i 桶在 SQL 中是 [i + 1]，省略尾端的 0），逐桶相加即可合併
+LATENCY_GAMMA = 1.25
+LATENCY_MAX_BUCKET = 50
+_LOG_GAMMA = math.log(LATENCY_GAMMA)
+
+
+def latency_bucket(ms: float) -> int:
+    """延遲（毫秒）所屬的直方圖桶（與 SQL 函數 usage_latency_bucket 一致）"""
+    if ms <= 1:
+        return 0
+    return min(math.ceil(math.log(ms) / _LOG_GAMMA), LATENCY_MAX_BUCKET)
+
+
+def add_to_histogram(histogram: List[int], index: int, count: int = 1):
+    """在直方圖的第 index 桶加上 count（必要時延長）"""
+    if index >= len(histogram):
+        histogram.extend([0] * (index + 1 - len(histogram)))
+    histogram[index] += count
+
+
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+def latency_percentiles(histogram: Optional[List[int]], max_ms: Optional[float] = None) -> Dict[str, Optional[float]]:
+    """
+    由合併後的直方圖估算 p50 / p95 / p99（毫秒）
+
+    在目標排名所在的桶內線性插值，相對誤差不超過一個桶寬（γ - 1，約 25%），
+    已知實際最大值時不會超過 max_ms。沒有延遲資料時為 None。
+
+    Returns:
+        {"p50_response_time": ..., "p95_response_time": ..., "p99_response_time": ...}
+    """
+    histogram = [count or 0 for count in histogram or []]
+    total = sum(histogram)
+    result = {}
+    for percentile in LATENCY_PERCENTILES:
+        key = f"p{percentile}_response_time"
+        if total <= 0:
+            result[key] = None
+            continue
+
+        rank = total * percentile / 100
+        cumulative = 0
+        value = None
+        for index, count in enumerate(histogram):
+            if count and cumulative + count >= rank:
+                lower = 0.0 if index == 0 else LATENCY_GAMMA ** (index - 1)
+                upper = 1.0 if index == 0 else LATENCY_GAMMA ** index
+                value = lower + (upper - lower) * (rank - cumulative) / count
+                break
+            cumulative += count
+        if max_ms is not None:
+            value = min(value, float(max_ms))
+        result[key] = round(value, 1)
+    return result
+
+
+def _histogram_literal(histogram: Optional[List[int]]) -> Optional[str]:
+    """轉為 Postgres 陣列文字（unnest 無法展開二維陣列，直方圖以文字傳入再轉型）"""
+    if not histogram:
+        return None
+    return '{' + ','.join(str(count) for count in histogram) + '}'
+
+
+# usage_rollup_hourly 的欄位與累加規則（寫入緩衝、預彙總端點與回填共用）
+ROLLUP_HOURLY_COLUMNS = (
+    'hour, token_hash, route_path, calls, errors, timed_calls, sum_ms, max_ms, first_at, last_at, '
+    'latency_buckets'
+)
+ROLLUP_HOURLY_MERGE = """
+    ON CONFLICT (hour, token_hash, route_path) DO UPDATE SET
+        calls = usage_rollup_hourly.calls + EXCLUDED.calls,
+        errors = usage_rollup_hourly.errors + EXCLUDED.errors,
+        timed_calls = usage_rollup_hourly.timed_calls + EXCLUDED.timed_calls,
+        sum_ms = usage_rollup_hourly.sum_ms + EXCLUDED.sum_ms,
+        max_ms = GREATEST(usage_rollup_hourly.max_ms, EXCLUDED.max_ms),
+        first_at = LEAST(usage_rollup_hourly.first_at, EXCLUDED.first_at),
+        last_at = GREATEST(usage_rollup_hourly.last_at, EXCLUDED.last_at),
+        latency_buckets = usage_merge_buckets(usage_rollup_hourly.latency_buckets, EXCLUDED.latency_buckets)
+"""
+
+
+def aggregate_hourly(records: List[Tuple]) -> List[Tuple]:
+    """
+    將一批使用記錄彙總為 (hour, token_hash, route_path) 的小時統計
+
+    Returns:
+        依 key 排序的 [(hour, token_hash, route_path, calls, errors, timed_calls,
+        sum_ms, max_ms, first_at, last_at, latency_buckets)]，排序讓並發的 upsert 以相同順序鎖列
+    """
+    buckets: Dict[Tuple, List] = {}
+    for token_hash, route_path, used_at, status, response_ms, *_ in records:
+        key = (used_at.replace(minute=0, second=0, microsecond=0), token_hash, route_path or '')
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [0, 0, 0, 0, None, used_at, used_at, []]
+
+        bucket[0] += 1
+        if status is not None and status >= 400:
+            bucket[1] += 1
+        if response_ms is not None:
+            bucket[2] += 1
+            bucket[3] += response_ms
+            if bucket[4] is None or response_ms > bucket[4]:
+                bucket[4] = response_ms
+            add_to_histogram(bucket[7], latency_bucket(response_ms))
+        if used_at < bucket[5]:
+            bucket[5] = used_at
+        if used_at > bucket[6]:
+            bucket[6] = used_at
+
+    return [key + tuple(buckets[key]) for key in sorted(buckets)]
+
+
+def _to_minute(value: Any) -> datetime:
+    """預彙總計數的時間（毫秒時間戳或 ISO 字串），截斷到分鐘"""
+    if isinstance(value, (int, float)):
+        minute = _from_millis(value)
+    elif isinstance(value, str):
+        minute = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if minute.tzinfo is not None:
+            minute = minute.astimezone(timezone.utc).replace(tzinfo=None)
+    else:
+        raise ValueError("minute must be a millisecond timestamp or ISO string")
+    return minute.replace(second=0, microsecond=0)
+
+
+def _status_class(value: Any) -> int:
+    """狀態類別：'2xx' / 2 / 200 → 2"""
+    text = str(value).strip().lower()
+    if text.endswith('xx'):
+        text = text[:-2]
+    status_class = int(text)
+    if status_class >= 100:
+        status_class //= 100
+    if not 1 <= status_class <= 5:
+        raise ValueError("status_class must be 1xx-5xx")
+    return status_class
+
+
+def parse_usage_counters(data: Dict[str, Any]) -> Tuple[List[Tuple], Dict[str, List]]:
+    """
+    解析 Worker 預先彙總的使用計數（/api/usage-aggregate）
+
+    每個計數為 (token_hash, route, status_class, minute) 一組：
+    count, latency_count（預設等於 count）, latency_sum_ms, latency_max_ms,
+    latency_histogram（{桶編號: 次數}，分桶方式見 latency_bucket）
+
+    Returns:
+        (小時統計列（格式同 aggregate_hourly）, token_hash → [最後使用時間, 調用次數])
+
+    Raises:
+        ValueError: 欄位缺少或格式錯誤
+    """
+    if not isinstance(data, dict):
+        raise ValueError("body must be a JSON object")
+    counters = data.get('counters')
+    if not isinstance(counters, list):
+        raise ValueError("counters must be an array")
+
+    buckets: Dict[Tuple, List] = {}
+    activity: Dict[str, List] = {}
+    for index, counter in enumerate(counters):
+        try:
+            if not isinstance(counter, dict):
+                raise ValueError("counter must be a JSON object")
+            token_hash = _to_text(counter.get('token_hash'), 64)
+            if not token_hash:
+                raise ValueError("token_hash is required")
+            minute = _to_minute(counter.get('minute'))
+            status_class = _status_class(counter.get('status_class'))
+            calls = _to_int(counter.get('count')) or 0
+            if calls <= 0:
+                continue
+            timed = _to_int(counter.get('latency_count'))
+            sum_ms = _to_int(counter.get('latency_sum_ms')) or 0
+            max_ms = _to_int(counter.get('latency_max_ms'))
+            if timed is None:
+                timed = calls if sum_ms or max_ms is not None else 0
+
+            histogram: List[int] = []
+            for bucket_index, count in (counter.get('latency_histogram') or {}).items():
+                bucket_index, count = int(bucket_index), int(count)
+                if not 0 <= bucket_index <= LATENCY_MAX_BUCKET or count < 0:
+                    raise ValueError(f"invalid latency_histogram bucket {bucket_index}")
+                add_to_histogram(histogram, bucket_index, count)
+        except (ValueError, TypeError, AttributeError) as e:
+            raise ValueError(f"counters[{index}]: {str(e)}")
+
+        route_path = _to_text(counter.get('route'), 255) or ''
+        key = (minute.replace(minute=0), token_hash, route_path)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [0, 0, 0, 0, None, minute, minute, []]
+
+        bucket[0] += calls
+        if status_class >= 4:
+            bucket[1] += calls
+        bucket[2] += timed
+        bucket[3] += sum_ms
+        if max_ms is not None and (bucket[4] is None or max_ms > bucket[4]):
+            bucket[4] = max_ms
+        bucket[5] = min(bucket[5], minute)
+        bucket[6] = max(bucket[6], minute)
+        for bucket_index, count in enumerate(histogram):
+            if count:
+                add_to_histogram(bucket[7], bucket_index, count)
+
+        current = activity.get(token_hash)
+        if current is None:
+            activity[token_hash] = [minute, calls]
+        else:
+            current[0] = max(current[0], minute)
+            current[1] += calls
+
+    rows = [key + tuple(buckets[key]) for key in sorted(buckets)]
+    return rows, activity
+
+
+async def write_hourly_rollups(conn, rows: List[Tuple]):
+    """以單條 upsert 將小時統計累加到 usage_rollup_hourly（已降採樣的日期記入 usage_rollup_dirty_days）"""
+    if not rows:
+        return
+
+    columns = [list(column) for column in zip(*rows)]
+    columns[10] = [_histogram_literal(histogram) for histogram in columns[10]]
+    await conn.execute(f"""
+        INSERT INTO usage_rollup_hourly ({ROLLUP_HOURLY_COLUMNS})
+        SELECT 
+            hour, token_hash, route_path, calls, errors, timed_calls, sum_ms, max_ms,
+            first_at, last_at, latency_buckets::bigint[]
+        FROM unnest(
+            $1::timestamp[], $2::text[], $3::text[], $4::bigint[], $5::bigint[],
+            $6::bigint[], $7::bigint[], $8::int[], $9::timestamp[], $10::timestamp[], $11::text[]
+        ) AS v(
+            hour, token_hash, route_path, calls, errors, timed_calls, sum_ms, max_ms,
+            first_at, last_at, latency_buckets
+        )
+        {ROLLUP_HOURLY_MERGE}
+    """, *columns)
+
+    # 已降採樣到每日彙總的日期又有新的小時統計（延遲送達、日誌回放）時標記，由維護任務重新降採樣
+    today = datetime.utcnow().date()
+    past_days = sorted({hour.date() for hour in columns[0] if hour.date() < today})
+    if past_days:
+        await conn.execute("""
+            INSERT INTO usage_rollup_dirty_days (day)
+            SELECT day FROM unnest($1::date[]) AS d(day)
+            WHERE day < (SELECT value::date FROM usage_maintenance_state WHERE key = 'rollup_daily_folded_until')
+            ON CONFLICT (day) DO NOTHING
+        """, past_days)
+
+
+ROLLUP_TEAM_MERGE = """
+    ON CONFLICT (team_id, hour, route_path) DO UPDATE SET
+        calls = usage_rollup_team_hourly.calls + EXCLUDED.calls,
+        errors = usage_rollup_team_hourly.errors + EXCLUDED.errors,
+        timed_calls = usage_rollup_team_hourly.timed_calls + EXCLUDED.timed_calls,
+        sum_ms = usage_rollup_team_hourly.sum_ms + EXCLUDED.sum_ms,
+        max_ms = GREATEST(usage_rollup_team_hourly.max_ms, EXCLUDED.max_ms),
+        latency_buckets = usage_merge_buckets(usage_rollup_team_hourly.latency_buckets, EXCLUDED.latency_buckets)
+"""
+
+
+async def write_team_rollups(conn, rows: List[Tuple]):
+    """
+    將小時統計（格式同 aggregate_hourly）依 Token 目前所屬的團隊累加到 usage_rollup_team_hourly
+
+    團隊在寫入時由 tokens 決定（沒有團隊的 Token 為 ''），同一團隊的多個 Token 先在 SQL 內合併再 upsert
+    """
+    if not rows:
+        return
+
+    columns = [list(column) for column in zip(*rows)]
+    await conn.execute(f"""
+        INSERT INTO usage_rollup_team_hourly (
+            hour, team_id, route_path, calls, errors, timed_calls, sum_ms, max_ms, latency_buckets
+        )
+        SELECT 
+            v.hour, COALESCE(t.team_id, ''), v.route_path, SUM(v.calls), SUM(v.errors),
+            SUM(v.timed_calls), SUM(v.sum_ms), MAX(v.max_ms), usage_sum_buckets(v.latency_buckets::bigint[])
+        FROM unnest(
+            $1::timestamp[], $2::text[], $3::text[], $4::bigint[], $5::bigint[],
+            $6::bigint[], $7::bigint[], $8::int[], $9::text[]
+        ) AS v(hour, token_hash, route_path, calls, errors, timed_calls, sum_ms, max_ms, latency_buckets)
+        LEFT JOIN tokens t ON t.token_hash = v.token_hash
+        GROUP BY 2, 1, 3
+        ORDER BY 2, 1, 3
+        {ROLLUP_TEAM_MERGE}
+    """, *columns[:8], [_histogram_literal(histogram) for histogram in columns[10]])
+
+
+# usage_distinct_hourly 的維度：t = Token（key 為 token_hash），r = 路由（key 為 route_path）
+DISTINCT_DIMENSION_TOKEN = 't'
+DISTINCT_DIMENSION_ROUTE = 'r'
+
+
+def aggregate_distinct_hourly(records: List[Tuple]) -> List[Tuple]:
+    """
+    將一批使用記錄彙總為每小時、每個 Token / 路由的不同 IP 與 User-Agent sketch
+
+    Returns:
+        依 key 排序的 [(hour, dimension, key, ip_sketch, user_agent_sketch)]，
+        沒有任何 IP（或 User-Agent）時該 sketch 為 None
+    """
+    values: Dict[Tuple, Tuple[set, set]] = {}
+    for record in records:
+        ip_address, user_agent = record[5], record[6]
+        if ip_address is None and user_agent is None:
+            continue
+        hour = record[2].replace(minute=0, second=0, microsecond=0)
+        keys = [(hour, DISTINCT_DIMENSION_TOKEN, record[0])]
+        if record[1]:
+            keys.append((hour, DISTINCT_DIMENSION_ROUTE, record[1]))
+        for key in keys:
+            ips, user_agents = values.setdefault(key, (set(), set()))
+            if ip_address is not None:
+                ips.add(ip_address)
+            if user_agent is not None:
+                user_agents.add(user_agent)
+
+    rows = []
+    for key in sorted(values):
+        sketches = []
+        for distinct_values in values[key]:
+            if not distinct_values:
+                sketches.append(None)
+                continue
+            registers = hll_new()
+            for value in distinct_values:
+                hll_add(registers, value)
+            sketches.append(bytes(registers))
+        rows.append(key + tuple(sketches))
+    return rows
+
+
+async def write_distinct_sketches(conn, rows: List[Tuple]):
+    """以單條 upsert 將 sketch 合併到 usage_distinct_hourly（合併具冪等性，重送不會重複計算）"""
+    if not rows:
+        return
+
+    await conn.execute("""
+        INSERT INTO usage_distinct_hourly (hour, dimension, key, ip_sketch, user_agent_sketch)
+        SELECT * FROM unnest($1::timestamp[], $2::text[], $3::text[], $4::bytea[], $5::bytea[])
+        ON CONFLICT (dimension, key, hour) DO UPDATE SET
+            ip_sketch = usage_hll_merge(usage_distinct_hourly.ip_sketch, EXCLUDED.ip_sketch),
+            user_agent_sketch = usage_hll_merge(usage_distinct_hourly.user_agent_sketch, EXCLUDED.user_agent_sketch)
+    """, *[list(column) for column in zip(*rows)])
+
+
+async def fetch_distinct_counts(
+    conn, dimension: str, key: str, start: datetime, end: datetime
+) -> Dict[str, Any]:
+    """
+    合併 [start, end) 內每小時的 sketch，估計不同 IP / User-Agent 數（時間以整點對齊）
+
+    Returns:
+        {"unique_ips": ..., "unique_user_agents": ..., "from": ..., "to": ...}
+    """
+    rows = await conn.fetch("""
+        SELECT ip_sketch, user_agent_sketch
+        FROM usage_distinct_hourly
+        WHERE dimension = $1 AND key = $2
+          AND hour >= DATE_TRUNC('hour', $3::timestamp) AND hour < $4
+    """, dimension, key, start, end)
+    return {
+        "unique_ips": hll_estimate(hll_merge(row['ip_sketch'] for row in rows)),
+        "unique_user_agents": hll_estimate(hll_merge(row['user_agent_sketch'] for row in rows)),
+        "from": start.isoformat(),
+        "to": end.isoformat()
+    }
+
+
+# 錯誤訊息正規化：把每次都不同的部分換成佔位符，同一類錯誤得到相同的指紋（依序套用）
+_ERROR_NORMALIZERS = [
+    (re.compile(r'\b[a-z][a-z0-9+.-]*://\S+', re.IGNORECASE), '<url>'),
+    (re.compile(r'\b[\w.+-]+@[\w-]+\.[\w.-]+\b'), '<email>'),
+    (re.compile(r'\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b', re.IGNORECASE), '<uuid>'),
+    (re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b'), '<ip>'),
+    (re.compile(r'\b(?:0x)?(?=[0-9a-f]*\d)[0-9a-f]{8,}\b', re.IGNORECASE), '<hex>'),
+    (re.compile(r'"[^"]*"|\'[^\']*\''), '<str>'),
+    (re.compile(r'\d+(?:\.\d+)*'), '<n>'),
+    (re.compile(r'\s+'), ' '),
+]
+# 開頭的 HTTP 狀態碼（Worker 的錯誤訊息為 "HTTP 502" 或 "HTTP 502: ..."）保留原值，不換成 <n>，
+# 不同狀態碼的錯誤不會合併成同一個指紋，且與沒有訊息時的 "HTTP <狀態碼>" 樣板一致
+_ERROR_STATUS_PREFIX = re.compile(r'^\s*HTTP[ /]?(\d{3})\b', re.IGNORECASE)
+ERROR_TEMPLATE_MAX_LENGTH = 500
+
+
+def error_fingerprint(error_message: Optional[str], status: Optional[int]) -> Optional[Tuple[str, str]]:
+    """
+    錯誤的指紋（URL、email、UUID、IP、十六進位 id、引號內的值與數字換成佔位符後的雜湊）
+
+    訊息開頭的 "HTTP <狀態碼>" 保留原值；沒有錯誤訊息但狀態碼 >= 400 的以 "HTTP <狀態碼>" 為樣板；
+    不是錯誤時返回 None
+
+    Returns:
+        (16 字元的指紋, 正規化後的樣板)
+    """
+    if error_message:
+        prefix = ""
+        template = error_message
+        match = _ERROR_STATUS_PREFIX.match(template)
+        if match:
+            prefix = f"HTTP {match.group(1)}"
+            template = template[match.end():]
+        for pattern, placeholder in _ERROR_NORMALIZERS:
+            template = pattern.sub(placeholder, template)
+        template = (prefix + template.rstrip() if prefix else template.strip())[:ERROR_TEMPLATE_MAX_LENGTH]
+    elif status is not None and status >= 400:
+        template = f"HTTP {status}"
+    else:
+        return None
+    return hashlib.blake2b(template.encode("utf-8"), digest_size=8).hexdigest(), template
+
+
+def aggregate_error_hourly(records: List[Tuple]) -> List[Tuple]:
+    """
+    將一批使用記錄的錯誤彙總為 (hour, fingerprint, route_path) 的小時統計
+
+    Returns:
+        依 key 排序的 [(hour, fingerprint, route_path, template, sample_message, last_status,
+        count, first_seen, last_seen)]
+    """
+    buckets: Dict[Tuple, List] = {}
+    for record in records:
+        fingerprint = error_fingerprint(record[8], record[3])
+        if fingerprint is None:
+            continue
+        used_at = record[2]
+        key = (used_at.replace(minute=0, second=0, microsecond=0), fingerprint[0], record[1] or '')
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [fingerprint[1], record[8], record[3], 1, used_at, used_at]
+            continue
+        bucket[3] += 1
+        if used_at < bucket[4]:
+            bucket[4] = used_at
+        if used_at >= bucket[5]:
+            bucket[5] = used_at
+            bucket[2] = record[3]
+    return [key + tuple(buckets[key]) for key in sorted(buckets)]
+
+
+async def write_error_rollups(conn, rows: List[Tuple]):
+    """以單條 upsert 將錯誤次數累加到 usage_error_hourly（樣板與範例訊息保留第一次寫入的）"""
+    if not rows:
+        return
+
+    await conn.execute("""
+        INSERT INTO usage_error_hourly (
+            hour, fingerprint, route_path, template, sample_message, last_status, count, first_seen, last_seen
+        )
+        SELECT * FROM unnest(
+            $1::timestamp[], $2::text[], $3::text[], $4::text[], $5::text[], $6::int[],
+            $7::bigint[], $8::timestamp[], $9::timestamp[]
+        )
+        ON CONFLICT (fingerprint, route_path, hour) DO UPDATE SET
+            count = usage_error_hourly.count + EXCLUDED.count,
+            first_seen = LEAST(usage_error_hourly.first_seen, EXCLUDED.first_seen),
+            last_seen = GREATEST(usage_error_hourly.last_seen, EXCLUDED.last_seen),
+            last_status = CASE WHEN EXCLUDED.last_seen >= usage_error_hourly.last_seen
+                THEN EXCLUDED.last_status ELSE usage_error_hourly.last_status END
+    """, *[list(column) for column in zip(*rows)])
+
+
+class UsageDictionary:
+    """
+    字串 → 整數 id 的字典編碼（usage_dict_* 表），帶本地快取
+
+    新值以 INSERT ... ON CONFLICT DO NOTHING 寫入（依排序插入，並發時不會死鎖），
+    在寫入使用記錄的 transaction 之外提交，快取中的 id 一定已存在於數據庫
+    """
+
+    def __init__(self, table: str, column: str, max_cached: int = 100000):
+        self.table = table
+        self.column = column
+        self.max_cached = max_cached
+        self._ids: Dict[str, int] = {}
+
+    async def lookup(self, conn, values) -> Dict[str, int]:
+        """取得 values 對應的 id（不存在的值會先建立）"""
+        wanted = {value for value in values if value is not None}
+        missing = sorted(value for value in wanted if value not in self._ids)
+        # 快取過大時整個清空（例如大量不同的 User-Agent）
+        if missing and len(self._ids) + len(missing) > self.max_cached:
+            self._ids.clear()
+            missing = sorted(wanted)
+
+        if missing:
+            await conn.execute(f"""
+                INSERT INTO {self.table} ({self.column})
+                SELECT unnest($1::text[])
+                ON CONFLICT ({self.column}) DO NOTHING
+            """, missing)
+            rows = await conn.fetch(f"""
+                SELECT id, {self.column} AS value FROM {self.table}
+                WHERE {self.column} = ANY($1::text[])
+            """, missing)
+            for row in rows:
+                self._ids[row['value']] = row['id']
+        return self._ids
+
+
+token_dictionary = UsageDictionary('usage_dict_tokens', 'token_hash')
+route_dictionary = UsageDictionary('usage_dict_routes', 'route_path')
+user_agent_dictionary = UsageDictionary('usage_dict_user_agents', 'user_agent')
+
+
+def _method_code(method: Optional[str]) -> Optional[int]:
+    if not method:
+        return None
+    return HTTP_METHOD_CODES.get(method.upper(), OTHER_METHOD_CODE)
+
+
+def _status_code(status: Optional[int]) -> Optional[int]:
+    """response_status 為 SMALLINT，超出範圍的值記為 None（舊版本寫入日誌的記錄未在解析時檢查）"""
+    if status is None or not 0 <= status <= RESPONSE_STATUS_MAX:
+        return None
+    return status
+
+
+async def encode_usage_records(conn, records: List[Tuple]) -> List[Tuple]:
+    """將使用記錄編碼為 usage_logs 的列（欄位見 USAGE_LOG_COLUMNS）"""
+    token_ids = await token_dictionary.lookup(conn, (record[0] for record in records))
+    route_ids = await route_dictionary.lookup(conn, (record[1] for record in records))
+    user_agent_ids = await user_agent_dictionary.lookup(conn, (record[6] for record in records))
+
+    return [
+        (
+            token_ids[token_hash],
+            route_ids.get(route_path) if route_path is not None else None,
+            used_at,
+            _status_code(status),
+            response_ms,
+            ip,
+            user_agent_ids.get(user_agent) if user_agent is not None else None,
+            _method_code(method),
+            error_message,
+            event_id,
+        )
+        for token_hash, route_path, used_at, status, response_ms, ip, user_agent, method, error_message, event_id
+        in records
+    ]
+
+
+def drop_batch_duplicates(records: List[Tuple]) -> List[Tuple]:
+    """移除同一批中 event_id 重複的事件（保留第一筆）"""
+    seen = set()
+    unique = []
+    for record in records:
+        event_id = record[9]
+        if event_id is not None:
+            if event_id in seen:
+                continue
+            seen.add(event_id)
+        unique.append(record)
+    return unique
+
+
+async def _insert_deduplicated(conn, rows: List[Tuple]) -> set:
+    """
+    經由暫存表寫入 usage_logs，已存在的 (event_id, used_at) 會被略過（COPY 不支援 ON CONFLICT）
+
+    Returns:
+        實際寫入的 event_id
+    """
+    # 暫存表只建 COPY 寫入的欄位（LIKE usage_logs 會帶上沒有預設值的 id NOT NULL，COPY 必定失敗）
+    columns = ', '.join(USAGE_LOG_COLUMNS)
+    await conn.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS usage_logs_staging
+        ON COMMIT DELETE ROWS
+        AS SELECT {columns} FROM usage_logs WITH NO DATA
+    """)
+    await conn.copy_records_to_table(
+        'usage_logs_staging',
+        records=rows,
+        columns=USAGE_LOG_COLUMNS
+    )
+    inserted = await conn.fetch(f"""
+        INSERT INTO usage_logs ({columns})
+        SELECT {columns} FROM usage_logs_staging
+        ON CONFLICT DO NOTHING
+        RETURNING event_id::text AS event_id
+    """)
+    return {row['event_id'] for row in inserted}
+
+
+async def write_usage_records(conn, records: List[Tuple]) -> int:
+    """
+    批量寫入使用記錄
+
+    1. 字典編碼（新的 token / 路由 / User-Agent 先寫入字典表並提交）
+    2. 在同一個 transaction 中：寫入 usage_logs，彙總後累加到 usage_rollup_hourly 與 usage_rollup_team_hourly，
+       合併不同 IP / User-Agent 的 sketch 到 usage_distinct_hourly，並按錯誤指紋累加到 usage_error_hourly，
+       確保原始記錄與彙總一致
+
+    沒有 event_id 的批次直接 COPY；帶 event_id 的批次經由暫存表寫入，
+    已寫入過的事件（重送、日誌回放）會被唯一索引擋下，也不會重複計入彙總。
+    Token 的 last_used / call_count 不在這裡更新，由 UsageBuffer 合併後定期寫入 token_activity
+
+    Returns:
+        因重複而略過的事件數
+    """
+    if not records:
+        return 0
+
+    unique = drop_batch_duplicates(records)
+    rows = await encode_usage_records(conn, unique)
+    async with conn.transaction():
+        if any(record[9] is not None for record in unique):
+            inserted = await _insert_deduplicated(conn, rows)
+            unique = [record for record in unique if record[9] is None or record[9] in inserted]
+        else:
+            await conn.copy_records_to_table(
+                'usage_logs',
+                records=rows,
+                columns=USAGE_LOG_COLUMNS
+            )
+        hourly = aggregate_hourly(unique)
+        await write_hourly_rollups(conn, hourly)
+        await write_team_rollups(conn, hourly)
+        await write_distinct_sketches(conn, aggregate_distinct_hourly(unique))
+        await write_error_rollups(conn, aggregate_error_hourly(unique))
+    return len(records) - len(unique)
+
+
+async def write_token_activity(conn, activity: Dict[str, List]):
+    """
+    以單條 upsert 批量更新多個 Token 的活動記錄（token_activity 表）
+
+    activity: token_hash → [最大使用時間, 調用次數]
+    last_used 只會往後推進，較舊的時間戳（例如延遲送達的事件）不會覆蓋較新的值；
+    不存在於 tokens 的 token_hash 會被忽略
+    """
+    if not activity:
+        return
+
+    token_hashes = list(activity.keys())
+    timestamps = [activity[token_hash][0] for token_hash in token_hashes]
+    counts = [activity[token_hash][1] for token_hash in token_hashes]
+    await conn.execute("""
+        INSERT INTO token_activity (token_hash, last_used, call_count)
+        SELECT v.token_hash, v.last_used, v.calls
+        FROM unnest($1::text[], $2::timestamp[], $3::bigint[]) AS v(token_hash, last_used, calls)
+        JOIN tokens t ON t.token_hash = v.token_hash
+        ON CONFLICT (token_hash) DO UPDATE
+        SET last_used = GREATEST(token_activity.last_used, EXCLUDED.last_used),
+            call_count = token_activity.call_count + EXCLUDED.call_count
+    """, token_hashes, timestamps, counts)
+
+
+class EventIdWindow:
+    """
+    最近看過的 event_id（記憶體去重窗口）
+
+    最多保留 max_size 個 id，超過 ttl 秒的 id 會過期；
+    窗口外的重送由 usage_logs 的唯一索引擋下
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._seen: "OrderedDict[str, float]" = OrderedDict()
+
+    def __contains__(self, event_id: str) -> bool:
+        self._expire()
+        return event_id in self._seen
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def add(self, event_id: str):
+        self._seen[event_id] = time.monotonic()
+        self._seen.move_to_end(event_id)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+    def discard(self, event_id: str):
+        """移除 id（寫入失敗時，讓重送不被當成重複）"""
+        self._seen.pop(event_id, None)
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._seen:
+            event_id, seen_at = next(iter(self._seen.items()))
+            if seen_at >= cutoff:
+                break
+            self._seen.popitem(last=False)
+
+
+# 由記錄內容造成、重試也不會成功的寫入錯誤（欄位值無效、超出範圍、違反約束）
+RECORD_ERRORS = (
+    asyncpg.DataError, asyncpg.IntegrityConstraintViolationError,
+    ValueError, TypeError, OverflowError
+)
+
+
+class UsageWriteInterrupted(Exception):
+    """
+    拆批隔離壞記錄的過程中數據庫失敗，前面的子批次已寫入
+
+    remaining 為尚未寫入的記錄，呼叫端只需處理這些記錄（避免重複寫入已寫入的部分）
+    """
+
+    def __init__(self, remaining: List[Tuple], cause: Exception):
+        super().__init__(str(cause))
+        self.remaining = remaining
+
+
+class UsageBufferFull(Exception):
+    """緩衝區已滿，呼叫端應返回 429 並帶上 Retry-After"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Usage buffer is full")
+        self.retry_after = retry_after
+
+
+class UsageBuffer:
+    """
+    使用事件的 write-behind 緩衝區
+
+    API 收到事件後只放入記憶體並立即返回，由背景任務在以下任一條件成立時
+    批量寫入數據庫：
+    - 累積達 max_batch 筆
+    - 距離上次寫入超過 flush_interval 秒
+
+    Token 的活動記錄（last_used、call_count）另外以 token_hash 為 key 在記憶體合併，
+    每 activity_interval 秒才寫入一次 token_activity，避免熱門 Token 的同一列被反覆改寫
+
+    緩衝區有上限（max_events），數據庫變慢或中斷時不會無限增長：
+    - 寫入失敗的批次與超過上限的事件溢寫到本地日誌（usage_journal），數據庫恢復後批量回放
+    - 日誌也已滿（或停用）時拒絕寫入（UsageBufferFull → 429 + Retry-After）
+    - overload_policy = "sample" 時，超過 high_water 後只保留 sample_rate 比例的事件，其餘丟棄
+
+    應用關閉時 stop() 會把剩餘事件全部寫入
+    """
+
+    def __init__(self):
+        self.max_batch = int(os.getenv("USAGE_BUFFER_MAX_BATCH", "5000"))
+        self.flush_interval = int(os.getenv("USAGE_BUFFER_FLUSH_MS", "250")) / 1000
+        self.activity_interval = int(os.getenv("USAGE_LAST_USED_FLUSH_MS", "5000")) / 1000
+        self.max_events = int(os.getenv("USAGE_BUFFER_MAX_EVENTS", "100000"))
+        self.overload_policy = os.getenv("USAGE_OVERLOAD_POLICY", "reject").lower()
+        self.high_water = int(self.max_events * float(os.getenv("USAGE_BUFFER_HIGH_WATER", "0.8")))
+        self.sample_rate = float(os.getenv("USAGE_OVERLOAD_SAMPLE_RATE", "0.1"))
+        self.retry_after = int(os.getenv("USAGE_RETRY_AFTER_SECONDS", "5"))
+        self.counters = {
+            "queued": 0, "flushed": 0, "dropped": 0, "rejected": 0, "duplicates": 0, "flush_errors": 0
+        }
+        self.seen_event_ids = EventIdWindow(
+            int(os.getenv("USAGE_DEDUP_WINDOW_SIZE", "100000")),
+            float(os.getenv("USAGE_DEDUP_WINDOW_SECONDS", "600"))
+        )
+        self._records: List[Tuple] = []
+        self._activity: Dict[str, List] = {}
+        self._activity_flushed_at = 0.0
+        self._replay_retry_at = 0.0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._activity_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, records: List[Tuple]) -> Dict[str, int]:
+        """
+        將事件放入緩衝區（不等待寫入）
+
+        event_id 在去重窗口內已出現過的事件直接略過
+
+        Returns:
+            {"queued": 實際放入數, "dropped": sample 策略丟棄數, "duplicates": 重複略過數}
+
+        Raises:
+            UsageBufferFull: 放入後會超過 max_events（整批拒絕）
+        """
+        unique = []
+        batch_ids = set()
+        for record in records:
+            event_id = record[9]
+            if event_id is not None:
+                if event_id in batch_ids or event_id in self.seen_event_ids:
+                    continue
+                batch_ids.add(event_id)
+            unique.append(record)
+        duplicates = len(records) - len(unique)
+        records = unique
+        dropped = 0
+
+        if len(self._records) + len(records) > self.max_events:
+            # 數據庫跟不上時先溢寫到本地日誌，日誌也滿了才拒絕
+            if not usage_journal.has_room():
+                self.counters["rejected"] += len(records)
+                raise UsageBufferFull(self.retry_after)
+            usage_journal.append(records)
+        else:
+            if self.overload_policy == "sample" and len(self._records) >= self.high_water:
+                kept = [record for record in records if random.random() < self.sample_rate]
+                dropped = len(records) - len(kept)
+                records = kept
+            self._records.extend(records)
+
+        # 只記錄已接受的事件，被拒絕的事件重送時不會被當成重複
+        for record in records:
+            if record[9] is not None:
+                self.seen_event_ids.add(record[9])
+            self._merge_activity(record[0], record[2], 1)
+            heavy_hitters.add(record[0], record[1], record[2])
+            usage_anomaly_detector.add(record[0], 1, 1 if record[3] is not None and record[3] >= 400 else 0)
+
+        self.counters["queued"] += len(records)
+        self.counters["dropped"] += dropped
+        self.counters["duplicates"] += duplicates
+        if len(self._records) >= self.max_batch:
+            self._wakeup.set()
+        return {"queued": len(records), "dropped": dropped, "duplicates": duplicates}
+
+    def stats(self) -> Dict[str, Any]:
+        """緩衝區狀態與累計計數"""
+        return {
+            "buffered": len(self._records),
+            "max_events": self.max_events,
+            "overload_policy": self.overload_policy,
+            "dedup_window": len(self.seen_event_ids),
+            **self.counters,
+            "journal": usage_journal.stats()
+        }
+
+    def record_activity(self, activity: Dict[str, List]):
+        """合併其他來源（例如預彙總計數）的 Token 活動記錄，與事件一起定期寫入"""
+        for token_hash, (used_at, calls) in activity.items():
+            self._merge_activity(token_hash, used_at, calls)
+
+    def _merge_activity(self, token_hash: str, used_at: datetime, calls: int):
+        current = self._activity.get(token_hash)
+        if current is None:
+            self._activity[token_hash] = [used_at, calls]
+        else:
+            if used_at > current[0]:
+                current[0] = used_at
+            current[1] += calls
+
+    def start(self):
+        """啟動背景寫入任務"""
+        if self._task is None:
+            usage_journal.open()
+            self._activity_flushed_at = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+            print(f"✅ Usage buffer started (batch={self.max_batch}, interval={int(self.flush_interval * 1000)}ms)")
+
+    async def stop(self):
+        """停止背景任務並寫入剩餘事件"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        remaining = len(self._records)
+        try:
+            await self.flush()
+        finally:
+            # 寫不進數據庫的事件已溢寫到日誌，下次啟動後回放
+            await usage_journal.close()
+        await self.flush_activity()
+        if remaining:
+            print(f"✅ Usage buffer drained ({remaining} events)")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                # 寫入失敗的事件已溢寫到日誌（或放回緩衝區），之後重試
+                print(f"Warning: Failed to flush usage buffer: {e}")
+            else:
+                # 數據庫正常且緩衝區不忙時才回放日誌
+                if (usage_journal.has_pending() and len(self._records) < self.high_water
+                        and time.monotonic() >= self._replay_retry_at):
+                    try:
+                        await self.replay_journal()
+                    except Exception as e:
+                        self._replay_retry_at = time.monotonic() + self.retry_after
+                        print(f"Warning: Failed to replay usage journal: {e}")
+
+            if time.monotonic() - self._activity_flushed_at >= self.activity_interval:
+                self._activity_flushed_at = time.monotonic()
+                try:
+                    await self.flush_activity()
+                except Exception as e:
+                    print(f"Warning: Failed to flush token activity: {e}")
+
+    async def flush(self):
+        """將緩衝區內的事件分批寫入數據庫（每批最多 max_batch 筆）"""
+        async with self._flush_lock:
+            while self._records:
+                batch = self._records[:self.max_batch]
+                del self._records[:self.max_batch]
+
+                try:
+                    written = await self._write_batch(batch)
+                except Exception as e:
+                    self.counters["flush_errors"] += 1
+                    if isinstance(e, UsageWriteInterrupted):
+                        batch = e.remaining
+                    if usage_journal.has_room():
+                        usage_journal.append(batch)
+                    else:
+                        # 放回緩衝區最前面，保持事件順序
+                        self._records[:0] = batch
+                    raise
+                self.counters["flushed"] += written
+
+    async def _write_batch(self, records: List[Tuple]) -> int:
+        """
+        寫入一批使用記錄
+
+        整批因某筆記錄的內容被拒絕（RECORD_ERRORS）時二分拆批重寫，只把無法寫入的單筆記錄
+        隔離到 usage_journal 的 quarantine 檔，其餘記錄照常寫入，一筆壞資料不會讓整批卡住
+
+        Returns:
+            寫入（含重複略過）的筆數
+
+        Raises:
+            UsageWriteInterrupted: 拆批寫入到一半時數據庫失敗
+        """
+        chunks = [records]
+        written = 0
+        while chunks:
+            chunk = chunks.pop()
+            try:
+                async with db.pool.acquire() as conn:
+                    self.counters["duplicates"] += await write_usage_records(conn, chunk)
+            except RECORD_ERRORS as e:
+                if len(chunk) > 1:
+                    middle = len(chunk) // 2
+                    chunks.append(chunk[middle:])
+                    chunks.append(chunk[:middle])
+                    continue
+                usage_journal.quarantine(chunk)
+                print(f"⚠️  Quarantined usage record rejected by the database: {e}")
+                continue
+            except Exception as e:
+                if chunk is records:
+                    raise
+                remaining = [record for pending in reversed(chunks) for record in pending]
+                raise UsageWriteInterrupted(chunk + remaining, e) from e
+            written += len(chunk)
+        return written
+
+    async def replay_journal(self):
+        """
+        將日誌中最舊的一個 segment 批量寫回數據庫
+
+        每寫入一批就記錄進度，回放中斷後從該位置繼續；正在寫入的 segment 先封存再回放
+        """
+        segments = usage_journal.sealed_segments()
+        if not segments:
+            usage_journal.rotate()
+            segments = usage_journal.sealed_segments()
+            if not segments:
+                return
+
+        segment = segments[0]
+        position_segment, offset = usage_journal.load_position()
+        if position_segment != segment:
+            offset = 0
+
+        pending: List[Tuple] = []
+        pending_offset = offset
+        for next_offset, records in usage_journal.read_frames(segment, offset):
+            pending.extend(records)
+            pending_offset = next_offset
+            if len(pending) >= self.max_batch:
+                await self._replay_batch(pending, segment, pending_offset)
+                pending = []
+        if pending:
+            await self._replay_batch(pending, segment, pending_offset)
+
+        usage_journal.remove_segment(segment)
+        print(f"✅ Replayed usage journal segment {segment}")
+
+    async def _replay_batch(self, records: List[Tuple], segment: str, next_offset: int):
+        """回放一批並記錄進度；寫到一半中斷時，未寫入的記錄重新追加到日誌後再記錄進度"""
+        try:
+            written = await self._write_batch(records)
+        except UsageWriteInterrupted as e:
+            usage_journal.append(e.remaining)
+            usage_journal.save_position(segment, next_offset)
+            usage_journal.counters["replayed"] += len(records) - len(e.remaining)
+            raise
+        usage_journal.save_position(segment, next_offset)
+        usage_journal.counters["replayed"] += written
+
+    async def flush_activity(self):
+        """將合併後的 Token 活動記錄以單條 upsert 寫入 token_activity"""
+        async with self._activity_lock:
+            if not self._activity:
+                return
+
+            pending = self._activity
+            self._activity = {}
+
+            try:
+                async with db.pool.acquire() as conn:
+                    await write_token_activity(conn, pending)
+            except Exception:
+                # 合併回去，下次再寫
+                for token_hash, (used_at, calls) in pending.items():
+                    self._merge_activity(token_hash, used_at, calls)
+                raise
+
+
+# 全局緩衝區實例
+usage_buffer = UsageBuffer()
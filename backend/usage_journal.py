@@ -0,0 +1,297 @@
+"""
+使用記錄的本地溢寫日誌（spill journal）
+
+數據庫變慢或中斷時，寫入緩衝把事件追加寫入本地磁碟，數據庫恢復後再批量回放，
+Postgres 故障切換期間不會遺失使用記錄，也不會阻塞 Worker。
+
+檔案格式：
+- 目錄下依序編號的 segment 檔（segment-000000000001.log），寫滿 segment_bytes 後切換新檔
+- 每個 frame = 8 bytes header（payload 長度、CRC32，big-endian）+ JSON payload（一批事件）
+- 讀取時遇到不完整或 CRC 不符的 frame，往後搜尋下一個有效的 frame 繼續讀取（payload 一定以 "[[" 開頭），
+  找不到才視為寫入中斷的尾端；有損壞 frame 的 segment 回放後改名為 .corrupt 保留，不直接刪除
+- replay.pos 記錄回放進度（segment 名稱與 offset），回放中斷後從該位置繼續
+- 數據庫拒絕寫入的單筆記錄（欄位值無效等）以相同格式追加到 quarantine.log，不會再回放，供人工檢查
+"""
+import asyncio
+import json
+import os
+import struct
+import zlib
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+
+FRAME_HEADER = struct.Struct(">II")
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+POSITION_FILE = "replay.pos"
+QUARANTINE_FILE = "quarantine.log"
+CORRUPT_SUFFIX = ".corrupt"
+# _encode_records 的輸出（事件陣列的陣列）固定以此開頭，用於損壞後搜尋下一個 frame
+PAYLOAD_MARKER = b"[["
+
+
+def _encode_records(records: List[Tuple]) -> bytes:
+    """事件 tuple 轉為 JSON（used_at 以 ISO 格式儲存）"""
+    return json.dumps(
+        [[value.isoformat() if isinstance(value, datetime) else value for value in record] for record in records],
+        ensure_ascii=False,
+        separators=(",", ":")
+    ).encode("utf-8")
+
+
+def _decode_records(payload: bytes) -> List[Tuple]:
+    records = []
+    for values in json.loads(payload):
+        values[2] = datetime.fromisoformat(values[2])
+        records.append(tuple(values))
+    return records
+
+
+class UsageJournal:
+    """
+    追加寫入的本地日誌
+
+    fsync 策略（USAGE_JOURNAL_FSYNC）：
+    - always：每次追加後立即 fsync（最安全，每次溢寫多一次磁碟同步）
+    - interval：由背景任務每 USAGE_JOURNAL_FSYNC_MS 毫秒 fsync 一次（預設）
+    - off：交給作業系統，只保證程序崩潰不遺失，主機斷電可能遺失
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("USAGE_JOURNAL_ENABLED", "true").lower() == "true"
+        self.directory = os.getenv("USAGE_JOURNAL_DIR", "usage_journal")
+        self.segment_bytes = int(os.getenv("USAGE_JOURNAL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+        self.max_bytes = int(os.getenv("USAGE_JOURNAL_MAX_BYTES", str(1024 * 1024 * 1024)))
+        self.fsync_policy = os.getenv("USAGE_JOURNAL_FSYNC", "interval").lower()
+        self.fsync_interval = int(os.getenv("USAGE_JOURNAL_FSYNC_MS", "1000")) / 1000
+        self.counters = {"spilled": 0, "replayed": 0, "corrupt_frames": 0, "quarantined": 0}
+        self._fd: Optional[int] = None
+        self._active: Optional[str] = None
+        self._active_size = 0
+        self._total_bytes = 0
+        self._dirty = False
+        self._fsync_task: Optional[asyncio.Task] = None
+        self._corrupt_segments = set()
+
+    # ========== 寫入 ==========
+
+    def open(self):
+        """建立目錄並開啟新的 segment（既有的 segment 保留等待回放）"""
+        if not self.enabled or self._fd is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._total_bytes = sum(
+            os.path.getsize(os.path.join(self.directory, name)) for name in self.segments()
+        )
+        self._open_segment()
+
+        if self._total_bytes:
+            print(f"🔄 Usage journal has {self._total_bytes} bytes pending replay")
+        if self.fsync_policy == "interval":
+            self._fsync_task = asyncio.create_task(self._fsync_loop())
+
+    async def close(self):
+        """停止 fsync 任務並關閉目前的 segment"""
+        if self._fsync_task:
+            self._fsync_task.cancel()
+            try:
+                await self._fsync_task
+            except asyncio.CancelledError:
+                pass
+            self._fsync_task = None
+
+        if self._fd is not None:
+            self._sync()
+            os.close(self._fd)
+            self._fd = None
+            # 空的 segment 不需要保留
+            if self._active_size == 0:
+                os.remove(os.path.join(self.directory, self._active))
+            self._active = None
+
+    def has_room(self) -> bool:
+        """日誌是否仍可寫入（超過 max_bytes 時呼叫端應改為拒絕）"""
+        return self._fd is not None and self._total_bytes < self.max_bytes
+
+    def append(self, records: List[Tuple]):
+        """追加一批事件（同步寫入 page cache，依 fsync 策略落盤）"""
+        if not records:
+            return
+        payload = _encode_records(records)
+        frame = FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        if self._active_size > 0 and self._active_size + len(frame) > self.segment_bytes:
+            self.rotate()
+
+        os.write(self._fd, frame)
+        self._active_size += len(frame)
+        self._total_bytes += len(frame)
+        self.counters["spilled"] += len(records)
+
+        if self.fsync_policy == "always":
+            os.fsync(self._fd)
+        else:
+            self._dirty = True
+
+    def quarantine(self, records: List[Tuple]):
+        """將無法寫入數據庫的記錄追加到 quarantine 檔（日誌停用時只計數）"""
+        self.counters["quarantined"] += len(records)
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        payload = _encode_records(records)
+        with open(os.path.join(self.directory, QUARANTINE_FILE), "ab") as f:
+            f.write(FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+
+    def rotate(self):
+        """封存目前的 segment 並開啟新檔（空的 segment 不切換）"""
+        if self._fd is None or self._active_size == 0:
+            return
+        self._sync()
+        os.close(self._fd)
+        self._open_segment()
+
+    def _open_segment(self):
+        existing = self.segments()
+        next_number = int(existing[-1][len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) + 1 if existing else 1
+        self._active = f"{SEGMENT_PREFIX}{next_number:012d}{SEGMENT_SUFFIX}"
+        self._fd = os.open(
+            os.path.join(self.directory, self._active),
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+            0o600
+        )
+        self._active_size = 0
+
+    def _sync(self):
+        if self._fd is not None and self._dirty:
+            os.fsync(self._fd)
+            self._dirty = False
+
+    async def _fsync_loop(self):
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            if self._dirty and self._fd is not None:
+                self._dirty = False
+                try:
+                    await asyncio.to_thread(os.fsync, self._fd)
+                except OSError as e:
+                    self._dirty = True
+                    print(f"Warning: Failed to fsync usage journal: {e}")
+
+    # ========== 回放 ==========
+
+    def segments(self) -> List[str]:
+        """所有 segment 檔名（依編號排序）"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def sealed_segments(self) -> List[str]:
+        """已封存、可以回放的 segment（不含正在寫入的檔案）"""
+        return [name for name in self.segments() if name != self._active]
+
+    def has_pending(self) -> bool:
+        return self._total_bytes > 0
+
+    def read_frames(self, segment: str, offset: int = 0):
+        """
+        依序讀取 segment 中的 frame（跳過損壞的 frame）
+
+        Yields:
+            (下一個 frame 的 offset, 事件列表)
+        """
+        path = os.path.join(self.directory, segment)
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(FRAME_HEADER.size)
+                if not header:
+                    return
+                payload = None
+                if len(header) == FRAME_HEADER.size:
+                    length, checksum = FRAME_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != checksum:
+                        payload = None
+
+                if payload is None:
+                    next_offset = self._find_next_frame(f, offset + 1)
+                    if next_offset is None:
+                        # 寫入中斷造成的不完整尾端（或損壞到結尾）
+                        print(f"⚠️  Usage journal {segment}: invalid frame at offset {offset}, ignoring tail")
+                        return
+                    self.counters["corrupt_frames"] += 1
+                    self._corrupt_segments.add(segment)
+                    print(f"⚠️  Usage journal {segment}: corrupt frame at offset {offset}, resuming at {next_offset}")
+                    offset = next_offset
+                    f.seek(offset)
+                    continue
+
+                offset = f.tell()
+                yield offset, _decode_records(payload)
+
+    @staticmethod
+    def _find_next_frame(f, start: int) -> Optional[int]:
+        """從 start 往後搜尋第一個 CRC 正確的 frame，返回其 offset"""
+        f.seek(start)
+        data = f.read()
+        index = data.find(PAYLOAD_MARKER, FRAME_HEADER.size)
+        while index != -1:
+            header_at = index - FRAME_HEADER.size
+            length, checksum = FRAME_HEADER.unpack_from(data, header_at)
+            payload = data[index:index + length]
+            if len(payload) == length and zlib.crc32(payload) == checksum:
+                return start + header_at
+            index = data.find(PAYLOAD_MARKER, index + 1)
+        return None
+
+    def load_position(self) -> Tuple[Optional[str], int]:
+        """讀取回放進度"""
+        try:
+            with open(os.path.join(self.directory, POSITION_FILE)) as f:
+                segment, offset = f.read().split()
+            return segment, int(offset)
+        except (OSError, ValueError):
+            return None, 0
+
+    def save_position(self, segment: str, offset: int):
+        """寫入回放進度（先寫暫存檔再改名，避免寫到一半）"""
+        path = os.path.join(self.directory, POSITION_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{segment} {offset}")
+        os.replace(path + ".tmp", path)
+
+    def remove_segment(self, segment: str):
+        """回放完成後刪除 segment（有損壞 frame 的 segment 改名為 .corrupt 保留）"""
+        path = os.path.join(self.directory, segment)
+        try:
+            self._total_bytes -= os.path.getsize(path)
+            if segment in self._corrupt_segments:
+                os.replace(path, path + CORRUPT_SUFFIX)
+                print(f"⚠️  Usage journal {segment} had corrupt frames, kept as {segment}{CORRUPT_SUFFIX}")
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        self._corrupt_segments.discard(segment)
+        position_segment, _ = self.load_position()
+        if position_segment == segment:
+            os.remove(os.path.join(self.directory, POSITION_FILE))
+        self._total_bytes = max(self._total_bytes, 0)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "pending_bytes": self._total_bytes,
+            "segments": len(self.segments()) if self.enabled else 0,
+            "fsync_policy": self.fsync_policy,
+            **self.counters
+        }
+
+
+# 全局日誌實例
+usage_journal = UsageJournal()
@@ -0,0 +1,436 @@
+"""
+使用記錄維護任務
+
+定期在背景執行：
+- usage_logs 的分區管理（預先建立未來分區、移除過期分區）
+- 將舊版 token_usage_logs_v1 的記錄分批轉換為字典編碼的 usage_logs
+- 將建立彙總表之前的原始記錄分批回填到 usage_rollup_hourly
+- 將每小時彙總降採樣為每日彙總（含降採樣後才寫入的延遲資料），並移除超過保留期限的每小時彙總
+
+保留策略：
+- 原始記錄保留 USAGE_LOG_RETENTION_DAYS 天（以分區為單位刪除）
+- 每小時彙總（含不同 IP / User-Agent 的 sketch 與錯誤指紋統計）保留 USAGE_ROLLUP_HOURLY_RETENTION_MONTHS 個月
+- 每日彙總與按團隊的每小時彙總永久保留
+- Worker 彙總批次的 batch_id（去重用）保留 USAGE_AGGREGATE_BATCH_RETENTION_HOURS 小時
+（設為 0 表示永久保留）
+"""
+import asyncio
+import os
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from database import db
+from usage_ingest import ROLLUP_HOURLY_COLUMNS, ROLLUP_HOURLY_MERGE, ROLLUP_TEAM_MERGE
+
+
+class UsageMaintenance:
+    """使用記錄的背景維護任務（每 USAGE_MAINTENANCE_INTERVAL_SECONDS 秒執行一次）"""
+
+    def __init__(self):
+        self.interval = int(os.getenv("USAGE_MAINTENANCE_INTERVAL_SECONDS", "3600"))
+        self.backfill_chunk = int(os.getenv("USAGE_ROLLUP_BACKFILL_CHUNK", "50000"))
+        self.migration_chunk = int(os.getenv("USAGE_LOG_MIGRATION_CHUNK", "50000"))
+        self.hourly_retention_months = int(os.getenv("USAGE_ROLLUP_HOURLY_RETENTION_MONTHS", "0"))
+        # 已降採樣的最近幾天每次都重新計算，涵蓋延遲送達的事件
+        self.daily_lookback_days = int(os.getenv("USAGE_ROLLUP_DAILY_LOOKBACK_DAYS", "2"))
+        # Worker 重送批次的期限遠短於此，超過後不需要再去重
+        self.aggregate_batch_retention_hours = int(os.getenv("USAGE_AGGREGATE_BATCH_RETENTION_HOURS", "168"))
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """啟動背景維護任務"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止背景維護任務"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Warning: Usage maintenance failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """執行一次維護"""
+        async with db.pool.acquire() as conn:
+            await db.ensure_usage_partitions(conn)
+            migration_done = await self.migrate_legacy_usage_logs(conn)
+            backfill_done = await self.backfill_hourly_rollups(conn)
+            await self.fold_daily_rollups(conn)
+            await self.prune_hourly_rollups(conn)
+            await self.prune_aggregate_batches(conn)
+            
+            # 原始記錄要先完成轉換、完整計入彙總才能刪除
+            if migration_done and backfill_done:
+                await db.drop_expired_usage_partitions(conn)
+
+    async def migrate_legacy_usage_logs(self, conn):
+        """
+        將舊版 token_usage_logs_v1 的記錄分批轉換到 usage_logs（沿用原本的 id）
+
+        每批與進度（usage_logs_migration_done_id）在同一個 transaction 內提交，
+        usage_log_entries 視圖依進度決定從哪張表讀取，轉換期間查詢結果不會重複或遺漏。
+        全部轉換後移除舊表
+
+        Returns:
+            轉換是否已完成
+        """
+        if not await db.has_legacy_usage_logs(conn):
+            return True
+
+        target = await db.get_usage_state(conn, 'usage_logs_migration_target_id')
+        done = await db.get_usage_state(conn, 'usage_logs_migration_done_id')
+        target_id, done_id = int(target or 0), int(done or 0)
+
+        if done_id < target_id:
+            print(f"🔄 Converting legacy usage logs (ids {done_id + 1}..{target_id})...")
+        while done_id < target_id:
+            upper_id = min(done_id + self.migration_chunk, target_id)
+            async with conn.transaction():
+                # 先把這批出現的值寫入字典表（依排序插入，與寫入緩衝並發時不會死鎖）
+                await conn.execute("""
+                    INSERT INTO usage_dict_tokens (token_hash)
+                    SELECT DISTINCT token_hash FROM token_usage_logs_v1
+                    WHERE id > $1 AND id <= $2
+                    ORDER BY 1
+                    ON CONFLICT (token_hash) DO NOTHING
+                """, done_id, upper_id)
+                await conn.execute("""
+                    INSERT INTO usage_dict_routes (route_path)
+                    SELECT DISTINCT route_path FROM token_usage_logs_v1
+                    WHERE id > $1 AND id <= $2 AND route_path IS NOT NULL
+                    ORDER BY 1
+                    ON CONFLICT (route_path) DO NOTHING
+                """, done_id, upper_id)
+                await conn.execute("""
+                    INSERT INTO usage_dict_user_agents (user_agent)
+                    SELECT DISTINCT LEFT(user_agent, 512) FROM token_usage_logs_v1
+                    WHERE id > $1 AND id <= $2 AND user_agent IS NOT NULL
+                    ORDER BY 1
+                    ON CONFLICT (user_agent) DO NOTHING
+                """, done_id, upper_id)
+                
+                await conn.execute("""
+                    INSERT INTO usage_logs (
+                        id, used_at, token_id, route_id, user_agent_id, response_time_ms,
+                        response_status, method_code, ip_address, error_message
+                    )
+                    SELECT 
+                        o.id, o.used_at, t.id, r.id, ua.id, o.response_time_ms,
+                        CASE WHEN o.response_status BETWEEN 0 AND 32767 THEN o.response_status END,
+                        CASE WHEN o.request_method IS NOT NULL THEN COALESCE(m.code, 0) END,
+                        usage_try_inet(o.ip_address),
+                        o.error_message
+                    FROM token_usage_logs_v1 o
+                    JOIN usage_dict_tokens t ON t.token_hash = o.token_hash
+                    LEFT JOIN usage_dict_routes r ON r.route_path = o.route_path
+                    LEFT JOIN usage_dict_user_agents ua ON ua.user_agent = LEFT(o.user_agent, 512)
+                    LEFT JOIN usage_http_methods m ON m.method = UPPER(o.request_method)
+                    WHERE o.id > $1 AND o.id <= $2
+                """, done_id, upper_id)
+                await db.set_usage_state(conn, 'usage_logs_migration_done_id', upper_id)
+            done_id = upper_id
+            await asyncio.sleep(0)
+
+        # 視圖不再讀取舊表後才能移除
+        async with conn.transaction():
+            await db.create_usage_log_view(conn, include_legacy=False)
+            await conn.execute("DROP TABLE token_usage_logs_v1")
+        print("✅ Legacy usage logs converted, token_usage_logs_v1 dropped")
+        return True
+
+    async def backfill_hourly_rollups(self, conn):
+        """
+        將彙總表建立前的原始記錄（id <= rollup_backfill_target_id）分批累加到 usage_rollup_hourly
+        與 usage_rollup_team_hourly（以目前的 token → team 對應）
+
+        經由 usage_log_entries 視圖讀取，舊表轉換中或轉換後都能以相同的 id 範圍回填
+
+        每批與進度記錄在同一個 transaction 內提交，中斷後可從上次進度繼續，不會重複累加
+
+        Returns:
+            回填是否已完成
+        """
+        target = await db.get_usage_state(conn, 'rollup_backfill_target_id')
+        done = await db.get_usage_state(conn, 'rollup_backfill_done_id')
+        if target is None or done is None:
+            return True
+
+        target_id, done_id = int(target), int(done)
+        if done_id >= target_id:
+            return True
+
+        print(f"🔄 Backfilling hourly usage rollup (ids {done_id + 1}..{target_id})...")
+        while done_id < target_id:
+            upper_id = min(done_id + self.backfill_chunk, target_id)
+            async with conn.transaction():
+                await conn.execute(f"""
+                    INSERT INTO usage_rollup_hourly ({ROLLUP_HOURLY_COLUMNS})
+                    SELECT
+                        DATE_TRUNC('hour', used_at),
+                        token_hash,
+                        COALESCE(route_path, ''),
+                        COUNT(*),
+                        COUNT(*) FILTER (WHERE response_status >= 400),
+                        COUNT(response_time_ms),
+                        COALESCE(SUM(response_time_ms), 0),
+                        MAX(response_time_ms),
+                        MIN(used_at),
+                        MAX(used_at),
+                        usage_sum_buckets(usage_latency_histogram(response_time_ms))
+                    FROM usage_log_entries
+                    WHERE id > $1 AND id <= $2
+                    GROUP BY 1, 2, 3
+                    ORDER BY 1, 2, 3
+                    {ROLLUP_HOURLY_MERGE}
+                """, done_id, upper_id)
+                await conn.execute(f"""
+                    INSERT INTO usage_rollup_team_hourly (
+                        hour, team_id, route_path, calls, errors, timed_calls, sum_ms, max_ms, latency_buckets
+                    )
+                    SELECT
+                        DATE_TRUNC('hour', e.used_at),
+                        COALESCE(t.team_id, ''),
+                        COALESCE(e.route_path, ''),
+                        COUNT(*),
+                        COUNT(*) FILTER (WHERE e.response_status >= 400),
+                        COUNT(e.response_time_ms),
+                        COALESCE(SUM(e.response_time_ms), 0),
+                        MAX(e.response_time_ms),
+                        usage_sum_buckets(usage_latency_histogram(e.response_time_ms))
+                    FROM usage_log_entries e
+                    LEFT JOIN tokens t ON t.token_hash = e.token_hash
+                    WHERE e.id > $1 AND e.id <= $2
+                    GROUP BY 2, 1, 3
+                    ORDER BY 2, 1, 3
+                    {ROLLUP_TEAM_MERGE}
+                """, done_id, upper_id)
+                await conn.execute("""
+                    INSERT INTO usage_rollup_dirty_days (day)
+                    SELECT DISTINCT used_at::date FROM usage_log_entries
+                    WHERE id > $1 AND id <= $2
+                      AND used_at < (
+                          SELECT value::timestamp FROM usage_maintenance_state
+                          WHERE key = 'rollup_daily_folded_until'
+                      )
+                    ON CONFLICT (day) DO NOTHING
+                """, done_id, upper_id)
+                await db.set_usage_state(conn, 'rollup_backfill_done_id', upper_id)
+            done_id = upper_id
+            # 讓出事件迴圈，避免長時間佔用
+            await asyncio.sleep(0)
+
+        print("✅ Hourly usage rollup backfill completed")
+        return True
+
+    async def fold_daily_rollups(self, conn):
+        """
+        將已結束的日期從 usage_rollup_hourly 降採樣到 usage_rollup_daily
+
+        每次處理一天，與 rollup_daily_folded_until 進度在同一個 transaction 內提交，
+        usage_rollup_combined 視圖因此不會重複或遺漏。
+        每日彙總以覆寫方式寫入，最近 daily_lookback_days 天會重新計算；
+        更早的日期之後又寫入小時統計的（標記在 usage_rollup_dirty_days）由 refold_dirty_days 重新計算
+        """
+        folded_until = await db.get_usage_state(conn, 'rollup_daily_folded_until')
+        if folded_until is not None:
+            start_day = date.fromisoformat(folded_until) - timedelta(days=self.daily_lookback_days)
+        else:
+            first_hour = await conn.fetchval("SELECT MIN(hour) FROM usage_rollup_hourly")
+            if first_hour is None:
+                return
+            start_day = first_hour.date()
+
+        today = datetime.utcnow().date()
+        day = start_day
+        while day < today:
+            async with conn.transaction():
+                await self._fold_day(conn, day)
+                
+                # 進度只前進不後退
+                if folded_until is None or day + timedelta(days=1) > date.fromisoformat(folded_until):
+                    folded_until = (day + timedelta(days=1)).isoformat()
+                    await db.set_usage_state(conn, 'rollup_daily_folded_until', folded_until)
+            day += timedelta(days=1)
+            await asyncio.sleep(0)
+
+        await self.refold_dirty_days(conn)
+
+    async def refold_dirty_days(self, conn):
+        """
+        重新降採樣 usage_rollup_dirty_days 中的日期（降採樣後又寫入小時統計，由 write_hourly_rollups 標記）
+
+        每天一個 transaction，並鎖住 usage_rollup_hourly 阻擋寫入（一天的計算很短），
+        重新計算期間寫入的小時統計會在之後重新標記，不會遺漏
+        """
+        days = [row['day'] for row in await conn.fetch(
+            "SELECT day FROM usage_rollup_dirty_days ORDER BY day"
+        )]
+        if not days:
+            return
+
+        pruned_before = await self._pruned_before(conn)
+        for day in days:
+            async with conn.transaction():
+                await conn.execute("LOCK TABLE usage_rollup_hourly IN SHARE ROW EXCLUSIVE MODE")
+                await self._refold_day(conn, day, pruned_before)
+            await asyncio.sleep(0)
+        print(f"🔄 Refolded {len(days)} daily usage rollups with late hourly data")
+
+    async def _refold_day(self, conn, day: date, pruned_before: Optional[date]):
+        """
+        重新降採樣一天（需已鎖住 usage_rollup_hourly）
+
+        每小時彙總仍完整的日期整天覆寫；已移除每小時彙總的日期（早於 pruned_before）
+        小時表中只有移除後才寫入的部分，累加到每日彙總後刪除
+        """
+        await conn.execute("DELETE FROM usage_rollup_dirty_days WHERE day = $1", day)
+        if pruned_before is None or day >= pruned_before:
+            await self._fold_day(conn, day)
+            return
+
+        await conn.execute("""
+            WITH moved AS (
+                DELETE FROM usage_rollup_hourly
+                WHERE hour >= $1::date AND hour < $1::date + 1
+                RETURNING *
+            )
+            INSERT INTO usage_rollup_daily (
+                day, token_hash, route_path, calls, errors, timed_calls,
+                sum_ms, max_ms, first_at, last_at, latency_buckets
+            )
+            SELECT 
+                $1::date, token_hash, route_path, SUM(calls), SUM(errors), SUM(timed_calls),
+                SUM(sum_ms), MAX(max_ms), MIN(first_at), MAX(last_at),
+                usage_sum_buckets(latency_buckets)
+            FROM moved
+            GROUP BY token_hash, route_path
+            ORDER BY token_hash, route_path
+            ON CONFLICT (day, token_hash, route_path) DO UPDATE SET
+                calls = usage_rollup_daily.calls + EXCLUDED.calls,
+                errors = usage_rollup_daily.errors + EXCLUDED.errors,
+                timed_calls = usage_rollup_daily.timed_calls + EXCLUDED.timed_calls,
+                sum_ms = usage_rollup_daily.sum_ms + EXCLUDED.sum_ms,
+                max_ms = GREATEST(usage_rollup_daily.max_ms, EXCLUDED.max_ms),
+                first_at = LEAST(usage_rollup_daily.first_at, EXCLUDED.first_at),
+                last_at = GREATEST(usage_rollup_daily.last_at, EXCLUDED.last_at),
+                latency_buckets = usage_merge_buckets(usage_rollup_daily.latency_buckets, EXCLUDED.latency_buckets)
+        """, day)
+        await self._delete_hourly_extras(conn, day)
+
+    async def _fold_day(self, conn, day: date):
+        """以覆寫方式將一天的每小時彙總寫入 usage_rollup_daily"""
+        await conn.execute("""
+            INSERT INTO usage_rollup_daily (
+                day, token_hash, route_path, calls, errors, timed_calls,
+                sum_ms, max_ms, first_at, last_at, latency_buckets
+            )
+            SELECT 
+                $1::date, token_hash, route_path, SUM(calls), SUM(errors), SUM(timed_calls),
+                SUM(sum_ms), MAX(max_ms), MIN(first_at), MAX(last_at),
+                usage_sum_buckets(latency_buckets)
+            FROM usage_rollup_hourly
+            WHERE hour >= $1::date AND hour < $1::date + 1
+            GROUP BY token_hash, route_path
+            ORDER BY token_hash, route_path
+            ON CONFLICT (day, token_hash, route_path) DO UPDATE SET
+                calls = EXCLUDED.calls,
+                errors = EXCLUDED.errors,
+                timed_calls = EXCLUDED.timed_calls,
+                sum_ms = EXCLUDED.sum_ms,
+                max_ms = EXCLUDED.max_ms,
+                first_at = EXCLUDED.first_at,
+                last_at = EXCLUDED.last_at,
+                latency_buckets = EXCLUDED.latency_buckets
+        """, day)
+
+    async def _pruned_before(self, conn) -> Optional[date]:
+        value = await db.get_usage_state(conn, 'rollup_hourly_pruned_before')
+        return date.fromisoformat(value) if value else None
+
+    async def _delete_hourly_extras(self, conn, day: date):
+        """不同 IP / User-Agent 的 sketch 與錯誤指紋統計只有每小時粒度，與每小時彙總一起移除"""
+        await conn.execute("""
+            DELETE FROM usage_distinct_hourly
+            WHERE hour >= $1::date AND hour < $1::date + 1
+        """, day)
+        await conn.execute("""
+            DELETE FROM usage_error_hourly
+            WHERE hour >= $1::date AND hour < $1::date + 1
+        """, day)
+
+    async def prune_hourly_rollups(self, conn):
+        """
+        移除超過保留期限的每小時彙總（每次刪除一天，避免長時間鎖表）
+
+        只刪除已降採樣到每日彙總的日期
+        """
+        if self.hourly_retention_months <= 0:
+            return
+
+        folded_until = await db.get_usage_state(conn, 'rollup_daily_folded_until')
+        if folded_until is None:
+            return
+
+        cutoff = await conn.fetchval("""
+            SELECT LEAST(
+                DATE_TRUNC('day', NOW() AT TIME ZONE 'UTC' - make_interval(months => $1)),
+                $2::date
+            )::date
+        """, self.hourly_retention_months, date.fromisoformat(folded_until))
+
+        first_hour = await conn.fetchval("SELECT MIN(hour) FROM usage_rollup_hourly")
+        if first_hour is None or first_hour.date() >= cutoff:
+            return
+
+        pruned_before = await self._pruned_before(conn)
+        deleted = 0
+        day = first_hour.date()
+        while day < cutoff:
+            async with conn.transaction():
+                # 鎖住小時表：刪除前先把已標記的延遲資料計入每日彙總，刪除期間也不會有新的小時統計寫入
+                await conn.execute("LOCK TABLE usage_rollup_hourly IN SHARE ROW EXCLUSIVE MODE")
+                if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM usage_rollup_dirty_days WHERE day = $1)", day):
+                    await self._refold_day(conn, day, pruned_before)
+                result = await conn.execute("""
+                    DELETE FROM usage_rollup_hourly
+                    WHERE hour >= $1::date AND hour < $1::date + 1
+                """, day)
+                deleted += int(result.split()[-1])
+                await self._delete_hourly_extras(conn, day)
+                # 之後再寫入這一天的小時統計只有延遲資料，重新降採樣時改為累加
+                if pruned_before is None or day >= pruned_before:
+                    pruned_before = day + timedelta(days=1)
+                    await db.set_usage_state(conn, 'rollup_hourly_pruned_before', pruned_before.isoformat())
+            day += timedelta(days=1)
+            await asyncio.sleep(0)
+
+        if deleted:
+            print(f"🗑️  Pruned {deleted} hourly usage rollup rows before {cutoff}")
+
+    async def prune_aggregate_batches(self, conn):
+        """移除超過保留期限的 Worker 彙總批次 batch_id"""
+        if self.aggregate_batch_retention_hours <= 0:
+            return
+
+        result = await conn.execute("""
+            DELETE FROM usage_aggregate_batches
+            WHERE received_at < NOW() AT TIME ZONE 'UTC' - make_interval(hours => $1)
+        """, self.aggregate_batch_retention_hours)
+        deleted = int(result.split()[-1])
+        if deleted:
+            print(f"🗑️  Pruned {deleted} usage aggregate batch ids")
+
+
+# 全局維護任務實例
+usage_maintenance = UsageMaintenance()
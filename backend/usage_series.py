@@ -0,0 +1,111 @@
+"""
+使用量時間序列（圖表用）
+
+彙總查詢只返回有調用的時間桶，fill_series 依解析度補齊沒有調用的桶（調用數 0），
+得到等距的序列；點數超過上限時以 LTTB（Largest-Triangle-Three-Buckets，Steinarsson 2013）降採樣：
+保留首尾兩點，其餘點平均分成 threshold - 2 組，每組選出與前一個選中點、下一組平均點構成最大三角形的點，
+峰值與谷值會被保留，長期間的圖表形狀與原序列一致。
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence
+
+SERIES_RESOLUTIONS = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+}
+# 未指定 from 時的預設區間，與各解析度可查詢的最長區間（minute 讀原始記錄）
+SERIES_DEFAULT_RANGE = {
+    "minute": timedelta(days=1),
+    "hour": timedelta(days=7),
+    "day": timedelta(days=90),
+}
+SERIES_MAX_RANGE = {
+    "minute": timedelta(days=7),
+    "hour": timedelta(days=366 * 5),
+    "day": None,
+}
+SERIES_METRICS = ("calls", "errors", "avg_response_time")
+SERIES_MAX_POINTS = 1000
+
+
+def truncate_to_resolution(value: datetime, resolution: str) -> datetime:
+    """時間對齊到時間桶的起點"""
+    if resolution == "minute":
+        return value.replace(second=0, microsecond=0)
+    if resolution == "hour":
+        return value.replace(minute=0, second=0, microsecond=0)
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def fill_series(rows, start: datetime, end: datetime, resolution: str) -> List[Dict[str, Any]]:
+    """
+    將彙總查詢的結果補齊為 [start, end) 內等距的序列
+
+    Args:
+        rows: 含 bucket, calls, errors, timed_calls, sum_ms 的查詢結果（bucket 已對齊到解析度）
+
+    Returns:
+        [{"t", "calls", "errors", "avg_response_time"}]，沒有調用的桶為 0 / None
+    """
+    by_bucket = {row['bucket']: row for row in rows}
+    step = SERIES_RESOLUTIONS[resolution]
+    points = []
+    bucket = truncate_to_resolution(start, resolution)
+    while bucket < end:
+        row = by_bucket.get(bucket)
+        if row is None:
+            points.append({"t": bucket.isoformat(), "calls": 0, "errors": 0, "avg_response_time": None})
+        else:
+            points.append({
+                "t": bucket.isoformat(),
+                "calls": row['calls'],
+                "errors": row['errors'],
+                "avg_response_time": round(row['sum_ms'] / row['timed_calls'], 2) if row['timed_calls'] else None
+            })
+        bucket += step
+    return points
+
+
+def lttb_indices(values: Sequence[Optional[float]], threshold: int) -> List[int]:
+    """
+    LTTB 降採樣，返回要保留的點的索引（遞增）
+
+    x 為等距的索引；values 中的 None 以 0 計算。threshold 至少為 3
+    """
+    count = len(values)
+    if threshold >= count:
+        return list(range(count))
+
+    ys = [value or 0 for value in values]
+    every = (count - 2) / (threshold - 2)
+    selected = [0]
+    previous = 0
+    for group in range(threshold - 2):
+        # 下一組的平均點（最後一組以最後一點為準）
+        next_start = int((group + 1) * every) + 1
+        next_end = min(int((group + 2) * every) + 1, count)
+        if next_start >= next_end:
+            next_start, next_end = count - 1, count
+        avg_x = (next_start + next_end - 1) / 2
+        avg_y = sum(ys[next_start:next_end]) / (next_end - next_start)
+
+        start = int(group * every) + 1
+        end = min(int((group + 1) * every) + 1, count - 1)
+        previous_y = ys[previous]
+        best, best_area = start, -1.0
+        for index in range(start, end):
+            area = abs((previous - avg_x) * (ys[index] - previous_y) - (previous - index) * (avg_y - previous_y))
+            if area > best_area:
+                best, best_area = index, area
+        selected.append(best)
+        previous = best
+    selected.append(count - 1)
+    return selected
+
+
+def downsample_series(points: List[Dict[str, Any]], metric: str, max_points: int) -> List[Dict[str, Any]]:
+    """點數超過 max_points 時依 metric 的形狀以 LTTB 選點（其他欄位取同一個時間桶的值）"""
+    if len(points) <= max_points:
+        return points
+    return [points[index] for index in lttb_indices([point[metric] for point in points], max_points)]
@@ -0,0 +1,58 @@
+"""
+HyperLogLog 基數估計（不同 IP / User-Agent 數）
+
+每個 sketch 是 HLL_REGISTERS 個 1 byte 的暫存器（以 BYTEA 儲存），
+合併兩個 sketch 只要逐個暫存器取最大值，因此每小時的 sketch 可以合併成任意時間區間的估計；
+重複加入同一個值不會改變 sketch，批次重送或日誌回放不會重複計算。
+標準誤差約為 1.04 / sqrt(HLL_REGISTERS)（約 3.3%）。
+
+注意：HLL_PRECISION 與雜湊函數變更後，已儲存的 sketch 無法再與新的合併。
+"""
+import hashlib
+import math
+from typing import Iterable, Optional
+
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+_VALUE_BITS = 64 - HLL_PRECISION
+_VALUE_MASK = (1 << _VALUE_BITS) - 1
+_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+
+
+def hll_new() -> bytearray:
+    """空的 sketch"""
+    return bytearray(HLL_REGISTERS)
+
+
+def hll_add(registers: bytearray, value: str):
+    """加入一個值（64-bit blake2b 雜湊，前 HLL_PRECISION 位選暫存器，其餘位的前導零數 + 1 為 rank）"""
+    hashed = int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+    index = hashed >> _VALUE_BITS
+    rank = _VALUE_BITS - (hashed & _VALUE_MASK).bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+
+def hll_merge(sketches: Iterable[Optional[bytes]]) -> Optional[bytearray]:
+    """合併多個 sketch（逐暫存器取最大值），全部為 None 時返回 None"""
+    merged = None
+    for sketch in sketches:
+        if not sketch:
+            continue
+        if merged is None:
+            merged = bytearray(sketch)
+        else:
+            merged = bytearray(map(max, merged, sketch))
+    return merged
+
+
+def hll_estimate(registers: Optional[bytes]) -> int:
+    """估計不同值的個數（小基數時改用 linear counting）"""
+    if not registers:
+        return 0
+    harmonic = sum(2.0 ** -rank for rank in registers)
+    estimate = _ALPHA * HLL_REGISTERS * HLL_REGISTERS / harmonic
+    zeros = registers.count(0)
+    if estimate <= 2.5 * HLL_REGISTERS and zeros:
+        estimate = HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+    return round(estimate)
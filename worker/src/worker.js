@@ -260,18 +260,29 @@ export default {
       
       // 14. 記錄 Token 使用情況（異步，不阻塞響應）
       // 使用 ctx.waitUntil 確保在響應返回後繼續執行
-      ctx.waitUntil(
-        logTokenUsage({
+      // 預彙總模式下只累積計數，每分鐘送出一次
+      if (env.USAGE_AGGREGATE_MODE === 'true') {
+        recordUsageCounter({
           tokenHash,
           routePath: matchedPath,
           responseStatus: finalResponse.status,
-          responseTime,
-          ipAddress: request.headers.get('cf-connecting-ip'),
-          userAgent: request.headers.get('user-agent'),
-          requestMethod: request.method,
-          errorMessage: finalResponse.ok ? null : `HTTP ${finalResponse.status}`
-        }, env)
-      );
+          responseTime
+        });
+        ctx.waitUntil(flushUsageCounters(env));
+      } else {
+        ctx.waitUntil(
+          logTokenUsage({
+            tokenHash,
+            routePath: matchedPath,
+            responseStatus: finalResponse.status,
+            responseTime,
+            ipAddress: request.headers.get('cf-connecting-ip'),
+            userAgent: request.headers.get('user-agent'),
+            requestMethod: request.method,
+            errorMessage: finalResponse.ok ? null : `HTTP ${finalResponse.status}`
+          }, env)
+        );
+      }
       
       return finalResponse;
       
@@ -376,7 +387,8 @@ async function logTokenUsage(usageData, env) {
       error_message: usageData.errorMessage
     };
     
-    const response = await fetch(`${backendUrl}/api/usage-log`, {
+    // /api/usage-ingest 是低開銷的 ASGI 寫入端點（格式與 /api/usage-log 相同）
+    const response = await fetch(`${backendUrl}/api/usage-ingest`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
@@ -395,3 +407,117 @@ async function logTokenUsage(usageData, env) {
   }
 }
 
+// ========== 預彙總模式（USAGE_AGGREGATE_MODE = "true"） ==========
+// 同一個 isolate 內以 (token_hash, route, 狀態類別, 分鐘) 累積計數，
+// 分鐘結束後由下一個請求送出到 /api/usage-aggregate，每分鐘每個 isolate 只需一次 HTTP 調用。
+// 不產生逐筆使用記錄（IP / User-Agent 等），isolate 被回收時尚未送出的計數會遺失
+
+const usageCounters = new Map();
+// 已封裝、等待送出的批次：{ batch_id, counters }（依封裝順序）
+const pendingUsageBatches = [];
+const MAX_PENDING_USAGE_BATCHES = 60;
+let usageFlushInFlight = false;
+
+// 延遲直方圖分桶，與後端 usage_ingest.latency_bucket 一致：第 i 桶涵蓋 (1.25^(i-1), 1.25^i] 毫秒
+const LATENCY_LOG_GAMMA = Math.log(1.25);
+const LATENCY_MAX_BUCKET = 50;
+
+function latencyBucket(ms) {
+  if (ms <= 1) return 0;
+  return Math.min(Math.ceil(Math.log(ms) / LATENCY_LOG_GAMMA), LATENCY_MAX_BUCKET);
+}
+
+/**
+ * 累積一次請求的計數
+ */
+function recordUsageCounter(usageData) {
+  const minute = Math.floor(Date.now() / 60000) * 60000;
+  const statusClass = `${Math.floor(usageData.responseStatus / 100)}xx`;
+  const key = `${usageData.tokenHash}|${usageData.routePath}|${statusClass}|${minute}`;
+  
+  let counter = usageCounters.get(key);
+  if (!counter) {
+    counter = {
+      token_hash: usageData.tokenHash,
+      route: usageData.routePath,
+      status_class: statusClass,
+      minute,
+      count: 0,
+      latency_count: 0,
+      latency_sum_ms: 0,
+      latency_max_ms: 0,
+      latency_histogram: {}
+    };
+    usageCounters.set(key, counter);
+  }
+  
+  counter.count += 1;
+  if (typeof usageData.responseTime === 'number') {
+    const ms = Math.round(usageData.responseTime);
+    counter.latency_count += 1;
+    counter.latency_sum_ms += ms;
+    counter.latency_max_ms = Math.max(counter.latency_max_ms, ms);
+    const bucket = latencyBucket(ms);
+    counter.latency_histogram[bucket] = (counter.latency_histogram[bucket] || 0) + 1;
+  }
+}
+
+/**
+ * 送出已結束分鐘的計數
+ * 
+ * 已結束分鐘的計數先封裝成帶固定 batch_id 的批次，送出失敗時整批保留、下次以同一個 batch_id 重送
+ * （後端依 batch_id 去重，超時但其實已寫入的批次不會重複計算）。
+ * 後端以 4xx 拒絕的批次（429 除外）重送也不會成功，直接丟棄；最多保留 MAX_PENDING_USAGE_BATCHES 批
+ */
+async function flushUsageCounters(env) {
+  if (usageFlushInFlight) return;
+  
+  const currentMinute = Math.floor(Date.now() / 60000) * 60000;
+  const ready = [];
+  for (const [key, counter] of usageCounters) {
+    if (counter.minute < currentMinute) {
+      ready.push(counter);
+      usageCounters.delete(key);
+    }
+  }
+  if (ready.length > 0) {
+    pendingUsageBatches.push({ batch_id: crypto.randomUUID(), counters: ready });
+    if (pendingUsageBatches.length > MAX_PENDING_USAGE_BATCHES) {
+      const dropped = pendingUsageBatches.shift();
+      console.error('Dropped unsent usage counters batch:', dropped.batch_id);
+    }
+  }
+  if (pendingUsageBatches.length === 0) return;
+  
+  usageFlushInFlight = true;
+  try {
+    const backendUrl = env.TOKEN_MANAGER_BACKEND || 'https://tapi.blocktempo.ai';
+    while (pendingUsageBatches.length > 0) {
+      const batch = pendingUsageBatches[0];
+      const response = await fetch(`${backendUrl}/api/usage-aggregate`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(batch),
+        signal: AbortSignal.timeout(5000)
+      });
+      
+      if (!response.ok) {
+        const message = `HTTP ${response.status}: ${await response.text()}`;
+        if (response.status >= 400 && response.status < 500 && response.status !== 429) {
+          pendingUsageBatches.shift();
+          console.error('Usage counters batch rejected:', batch.batch_id, message);
+          continue;
+        }
+        throw new Error(message);
+      }
+      pendingUsageBatches.shift();
+    }
+  } catch (error) {
+    // 批次保留在 pendingUsageBatches，下次以相同的 batch_id 重送
+    console.error('Failed to send usage counters:', error.message);
+  } finally {
+    usageFlushInFlight = false;
+  }
+}